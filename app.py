@@ -1,322 +1,315 @@
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 from flask_cors import CORS
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
-import qrcode
-import string
-import random
+from functools import wraps
+import gzip
 import os
-import uuid
+import re
+import secrets
+import threading
+import time
 import json
-import base64
-
-# SendGrid
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment, TrackingSettings, ClickTracking, OpenTracking
+import logging
+
+from logging_setup import configure_logging, init_app, should_capture_payload
+from metrics import metrics, etapa
+from jobs import JobQueue
+from sheets_writer import SheetsWriter
+from coupon_index import CANJE_ERROR, CANJE_NO_EXISTE, CANJE_YA_CANJEADO
+from storage import SQLiteStorage, SheetsStorage, SheetsMirror, RedemptionLocks, DuplicateCodeError, CANJE_CONFLICTO
+from coupon_codes import CodeAllocator, LARGO_CODIGO
+from qr_store import QRStore
+from qr_render import RenderPool
+from http_pool import HTTPPool
+from email_dispatch import EmailDispatcher
+from sheets_client import LazyWorksheet, abrir_hoja
+from wix_payload import clean_wix_value, extract_real_data_from_wix_payload, idempotency_key
+from idempotency import IdempotencyIndex, DUPLICADO, EN_CURSO
+from snapshots import RedemptionSnapshots
+from reporting import csv_stream, ndjson_stream, resumir
+
+configure_logging()
+logger = logging.getLogger("app")
 
 app = Flask(__name__)
 CORS(app)
+init_app(app)
+
+# Métricas por etapa y de APIs externas, agregadas entre workers en /metrics
+metrics.configure(os.getenv("METRICS_DB", "metrics.sqlite3"))
+
+# --- Endpoints internos (cola, envíos, reportes) ---
+# Piden "Authorization: Bearer <token>"; sin el token configurado quedan cerrados
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+if not ADMIN_TOKEN:
+    logger.warning("ADMIN_TOKEN no está configurado; /jobs y los envíos masivos quedan deshabilitados")
+
+
+def _token_valido(token):
+    if not token:
+        return False
+    enviado = request.headers.get("Authorization", "").encode("utf-8")
+    return secrets.compare_digest(enviado, f"Bearer {token}".encode("utf-8"))
+
+
+def requiere_token(token):
+    def decorador(vista):
+        @wraps(vista)
+        def protegida(*args, **kwargs):
+            if not _token_valido(token):
+                response = jsonify({"status": "error", "message": "No autorizado"})
+                response.headers["WWW-Authenticate"] = "Bearer"
+                return response, 401
+            return vista(*args, **kwargs)
+        return protegida
+    return decorador
+
+
+# --- Conexiones HTTP salientes ---
+# Un pool keep-alive por host, compartido por todos los hilos del worker
+# Hilos de la cola de pedidos: antes eran 8 para que la etapa "sheet" juntara pedidos
+# en cada lote del SheetsWriter. Esa etapa ya no existe (las filas las agrupan la
+# réplica o SheetsStorage, fuera de la cola): alcanza con cubrir QR y correos en paralelo.
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", 4))
+http_pool = HTTPPool({
+    # Cada hilo de la cola puede estar enviando un correo
+    "api.sendgrid.com": {"size": JOBS_WORKERS, "timeout": (5, 30), "retries": 2},
+    # Escritor por lotes + índice/réplica + lecturas de /validar
+    "sheets.googleapis.com": {"size": int(os.getenv("SHEETS_POOL_SIZE", 4)), "timeout": (5, 60), "retries": 2},
+    "oauth2.googleapis.com": {"size": 1, "timeout": (5, 30), "retries": 2},
+    "www.googleapis.com": {"size": 2, "timeout": (5, 30), "retries": 2},
+})
 
 # --- Configuración de Google Sheets ---
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-
-# Cargar credenciales desde la variable de entorno en Render
-json_creds = os.environ.get("GOOGLE_CREDENTIALS")
-creds_dict = json.loads(json_creds)
-
-creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-client = gspread.authorize(creds)
+# La conexión se abre en segundo plano (o en el primer uso): la app arranca y
+# acepta pedidos aunque Google todavía no responda. /ready indica cuándo está lista.
 SPREADSHEET_ID = "1huOU__jhatsGiP7RZ4zxDeevbYmI8fgh83B4fIJJNew"
-sheet = client.open_by_key(SPREADSHEET_ID).sheet1
-
-# Índices de columnas (basados en el orden de append_row)
-CODE_COL = 4       # columna del código único
-CANJEADO_COL = 8   # columna "Canjeado"
+sheet = LazyWorksheet(lambda: abrir_hoja(SPREADSHEET_ID, pool=http_pool))
+sheet.warm_up()
+
+# Escrituras agrupadas: un append_rows / batch_update por lote en vez de una llamada por evento
+SHEETS_WRITE_TIMEOUT = int(os.getenv("SHEETS_WRITE_TIMEOUT", 60))
+escritor_sheet = SheetsWriter(
+    sheet,
+    flush_interval_ms=int(os.getenv("SHEETS_FLUSH_MS", 500)),
+    max_batch=int(os.getenv("SHEETS_MAX_BATCH", 200)),
+)
+escritor_sheet.start()
+
+# --- Almacenamiento de pedidos/cupones ---
+# "sqlite" (por defecto): registro local con réplica asíncrona en la hoja
+# "sheets": todo contra Google Sheets con índice en memoria
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+if STORAGE_BACKEND == "sheets":
+    storage = SheetsStorage(
+        sheet, escritor_sheet,
+        refresh_interval=int(os.getenv("INDEX_REFRESH_SECONDS", 30)),
+        write_timeout=SHEETS_WRITE_TIMEOUT,
+        # Tabla local de canjes: evita que dos workers canjeen el mismo código
+        locks=RedemptionLocks(os.getenv("REDEEM_LOCK_DB", "canjes.sqlite3")),
+    )
+else:
+    # Hasta que la réplica importe los cupones que ya estaban en la hoja, /ready da 503
+    storage = SQLiteStorage(os.getenv("STORAGE_DB", "cupones.sqlite3"), requires_import=True)
+    espejo_sheet = SheetsMirror(
+        storage, sheet, escritor_sheet,
+        interval=int(os.getenv("SHEETS_MIRROR_SECONDS", 5)),
+        write_timeout=SHEETS_WRITE_TIMEOUT,
+    )
+    espejo_sheet.start()
+storage.start()
+
+# --- Idempotencia del webhook (reintentos de Wix) ---
+dedup = IdempotencyIndex(
+    os.getenv("WEBHOOK_DEDUP_DB", "webhook_dedup.sqlite3"),
+    ttl=int(os.getenv("WEBHOOK_DEDUP_TTL_HOURS", 72)) * 3600,
+)
+
+# --- Cola de pedidos (QR, Sheets y correo fuera del request) ---
+JOBS_DB = os.getenv("JOBS_DB", "jobs.sqlite3")
+cola_pedidos = JobQueue(
+    JOBS_DB,
+    stages=["qr", "email"],
+    workers=JOBS_WORKERS,
+    max_attempts=int(os.getenv("JOBS_MAX_ATTEMPTS", 5)),
+    retention=int(os.getenv("JOBS_RETENTION_DAYS", 7)) * 86400,
+)
 
 # --- Configuración de SendGrid ---
 SENDGRID_KEY = os.getenv("SENDGRID_KEY")
 SENDGRID_FROM = os.getenv("SENDGRID_FROM")  # ej: tu gmail verificado en SendGrid
+correo = EmailDispatcher(
+    http_pool.session, SENDGRID_KEY, SENDGRID_FROM,
+    rate=float(os.getenv("SENDGRID_RATE", 10)),   # requests por segundo (cada uno hasta 1000 destinatarios)
+)
 
 
-# --- Generar código único ---
-def generar_codigo_unico(longitud=8):
-    caracteres = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(caracteres) for _ in range(longitud))
+# --- Códigos de cupón ---
+# Generados con `secrets` y verificados contra los ya emitidos (Bloom filter + almacenamiento)
+codigos = CodeAllocator(exists=storage.exists, length=int(os.getenv("CODE_LENGTH", LARGO_CODIGO)))
 
 
-def send_email_with_qr(to_email, nombre, producto, qr_path, codigo_unico, monto, fecha, url_qr, qr_image_url):
-    # Asunto sin caracteres especiales para evitar spam
-    subject = f"Confirmacion de compra - Many Offers - {producto}"
-    
-    print(f"🔍 DEBUG: qr_path={qr_path}, qr_image_url={qr_image_url}")
+def _cargar_codigos():
+    # Hay que esperar al índice (motor "sheets") o a la importación de la hoja (motor "sqlite")
+    while not storage.ready():
+        time.sleep(1)
+    codigos.load(storage.codes())
 
-    cuerpo_texto = f"""
-Hola {nombre},
 
-¡Gracias por tu compra en Many Offers!
+threading.Thread(target=_cargar_codigos, name="code-filter-load", daemon=True).start()
 
-Aquí tienes tu código QR para tu cupón de {producto}.
-Cada código es único y válido solo una vez.
+# --- Validador sin conexión (snapshots firmados y canjes diferidos) ---
+SNAPSHOT_SECRET = os.getenv("SNAPSHOT_SECRET")
+if not SNAPSHOT_SECRET:
+    # Cada worker tendría su propia clave: las firmas no verificarían entre procesos
+    logger.warning("SNAPSHOT_SECRET no está configurado; se usa una clave temporal por proceso")
+    SNAPSHOT_SECRET = secrets.token_hex(32)
+snapshots = RedemptionSnapshots(storage, SNAPSHOT_SECRET, log_days=int(os.getenv("SNAPSHOT_LOG_DAYS", 7)))
+# Los hashes del snapshot se pueden revertir por fuerza bruta y los endpoints por lote prueban
+# hasta 1000 códigos por request: solo los usan los validadores
+VALIDATOR_TOKEN = os.getenv("VALIDATOR_TOKEN")
+if not VALIDATOR_TOKEN:
+    logger.warning("VALIDATOR_TOKEN no está configurado; el validador solo funciona en línea "
+                   "y /validar/batch y /coupons/lookup quedan deshabilitados")
+
+
+def send_email_with_qr(to_email, nombre, producto, qr_png, codigo_unico, monto, fecha, url_qr, qr_image_url):
+    logger.debug("QR para correo: %d bytes, url=%s", len(qr_png), qr_image_url)
+    try:
+        # Las plantillas ya están compiladas; se envía por la sesión compartida (keep-alive)
+        logger.debug("Intentando enviar correo a %s desde %s", to_email, SENDGRID_FROM)
+        response = correo.send_one(
+            {"correo": to_email, "nombre": nombre, "producto": producto, "monto": monto, "fecha": fecha,
+             "codigo": codigo_unico, "url_qr": url_qr, "qr_image_url": qr_image_url},
+            qr_png=qr_png,
+        )
+        logger.info("Email enviado a %s con código %s. Status SendGrid: %s", to_email, codigo_unico, response.status_code)
+
+    except Exception as e:
+        logger.exception("Error enviando correo con SendGrid: %s", e)
+        # Propagar para que la cola de pedidos reintente el envío
+        raise
 
-Detalles de tu compra:
-- Producto: {producto}
-- Monto: ${monto}
-- Fecha: {fecha}
-- Código: {codigo_unico}
 
-Puedes presentar este código QR en el establecimiento para validar tu descuento.
+# --- Etapas del procesamiento de pedidos (se ejecutan en la cola, fuera del request) ---
+def url_validacion(codigo):
+    return f"https://botmanyoffers.onrender.com/validar?codigo={codigo}"
 
-¡Disfruta tu oferta!
-"""
 
+def url_imagen_qr(codigo):
+    return f"https://botmanyoffers.onrender.com/qr/{codigo}"
+
+
+def destinatario_pedido(pedido):
+    """Campos de las plantillas de correo para un pedido"""
+    codigo = pedido["codigo"]
+    return {
+        "correo": pedido["correo"],
+        "nombre": pedido["nombre"],
+        "producto": pedido["productos"],
+        "monto": pedido["total"],
+        "fecha": pedido["fecha"],
+        "codigo": codigo,
+        "url_qr": url_validacion(codigo),
+        "qr_image_url": url_imagen_qr(codigo),
+    }
+
+
+# Imágenes QR: caché LRU en memoria + blobs en SQLite, regeneradas a demanda
+# Con workers de muchos hilos (ver gunicorn.conf.py) conviene generar los QR en otros procesos
+render_qr = RenderPool(int(os.getenv("QR_RENDER_PROCESSES", 0)))
+qr_store = QRStore(
+    os.getenv("QR_STORE_DB", "qr.sqlite3"),
+    render=render_qr.png,
+    url_for=url_validacion,
+    max_bytes=int(os.getenv("QR_CACHE_BYTES", 8 * 1024 * 1024)),
+)
+
+
+def _precargar_qr(bloque, codigos_bloque):
+    # Los QR de una campaña se piden todos juntos (impresión, envío masivo): se generan de antemano
     try:
-        # Leer la imagen QR y convertirla a base64 para attachment inline
-        with open(qr_path, "rb") as f:
-            qr_image_data = base64.b64encode(f.read()).decode('utf-8')
-        
-        # Crear el contenido HTML usando Content-ID para attachment inline
-        # Este es el método más confiable para Gmail
-        html_content = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-</head>
-<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px; background-color: #ffffff;">
-    <div style="background-color: #ffffff; padding: 20px;">
-        <h2 style="color: #2A0066; margin-top: 0;">¡Gracias por tu compra en Many Offers!</h2>
-        
-        <p>Hola {nombre},</p>
-        
-        <p>Aquí tienes tu código QR para tu cupón de <strong>{producto}</strong>.</p>
-        <p style="color: #666; font-size: 14px;">Cada código es único y válido solo una vez.</p>
-        
-        <div style="background-color: #f5f5f5; padding: 20px; border-radius: 10px; margin: 20px 0;">
-            <h3 style="margin-top: 0; color: #2A0066;">Detalles de tu compra:</h3>
-            <ul style="list-style: none; padding: 0; margin: 0;">
-                <li style="margin: 10px 0;"><strong>Producto:</strong> {producto}</li>
-                <li style="margin: 10px 0;"><strong>Monto:</strong> ${monto}</li>
-                <li style="margin: 10px 0;"><strong>Fecha:</strong> {fecha}</li>
-                <li style="margin: 10px 0;"><strong>Código:</strong> {codigo_unico}</li>
-            </ul>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <p style="margin-bottom: 15px; font-weight: bold;">Puedes presentar este código QR en el establecimiento para validar tu descuento:</p>
-            <!-- Usar URL directa como fuente principal -->
-            <img src="{qr_image_url}" alt="QR del cupón" style="max-width: 300px; height: auto; border: 2px solid #2A0066; border-radius: 10px; padding: 10px; background-color: white; display: block; margin: 0 auto;" />
-        </div>
-        
-        <div style="margin-top: 30px; padding: 15px; background-color: #f0f0f0; border-radius: 5px;">
-            <p style="margin: 0; font-size: 14px;">O usar este enlace directo:</p>
-            <p style="margin: 10px 0 0 0;"><a href="{url_qr}" style="color: #2A0066; word-break: break-all; text-decoration: none;">{url_qr}</a></p>
-        </div>
-        
-        <p style="margin-top: 30px; color: #666; font-size: 14px;">¡Disfruta tu oferta!</p>
-        
-        <hr style="border: none; border-top: 1px solid #eee; margin: 30px 0;">
-        <p style="font-size: 12px; color: #999; text-align: center;">Este es un correo de confirmación de compra. Si no realizaste esta compra, por favor ignora este mensaje.</p>
-    </div>
-</body>
-</html>
-"""
-
-        # Crear el mensaje usando SendGrid con URL directa
-        # La URL es más confiable que attachments inline en muchos clientes
-        message = Mail(
-            from_email=SENDGRID_FROM,
-            to_emails=to_email,
-            subject=subject,
-            plain_text_content=cuerpo_texto,
-            html_content=html_content
+        with etapa("qr_preload"):
+            generados = qr_store.preload(codigos_bloque)
+        logger.info("QR del bloque '%s' precargados: %d", bloque, generados)
+    except Exception as e:
+        logger.exception("No se pudieron precargar los QR del bloque '%s': %s", bloque, e)
+
+
+def etapa_qr(pedido):
+    """Genera el QR con la URL de validación y lo guarda en el almacén de imágenes"""
+    qr_store.put(pedido["codigo"])
+
+
+def etapa_email(pedido):
+    """Envía el correo de confirmación con el QR"""
+    codigo = pedido["codigo"]
+    _, qr_png = qr_store.get(codigo)
+
+    with etapa("email_send"):
+        send_email_with_qr(
+            to_email=pedido["correo"],
+            nombre=pedido["nombre"],
+            producto=pedido["productos"],
+            qr_png=qr_png,
+            codigo_unico=codigo,
+            monto=pedido["total"],
+            fecha=pedido["fecha"],
+            url_qr=url_validacion(codigo),
+            qr_image_url=url_imagen_qr(codigo)
         )
-        
-        # Configurar reply-to para evitar spam
-        if SENDGRID_FROM:
-            message.reply_to = SENDGRID_FROM
-        
-        # Agregar attachment inline como respaldo (aunque usamos URL principal)
-        # Algunos clientes de correo prefieren attachments inline
-        try:
-            attachment = Attachment()
-            attachment.file_content = qr_image_data
-            attachment.file_type = "image/png"
-            attachment.file_name = f"qr_{codigo_unico}.png"
-            attachment.disposition = "inline"
-            attachment.content_id = "qr_cupon"
-            message.add_attachment(attachment)
-            print(f"✅ Attachment QR agregado como respaldo con Content-ID: qr_cupon")
-        except Exception as attach_error:
-            print(f"⚠️ No se pudo agregar attachment (continuando con URL): {attach_error}")
-            # No es crítico, la URL debería funcionar
-        
-        # Configurar tracking settings para mejor deliverability
-        # Comentar temporalmente para evitar errores 400
-        # try:
-        #     tracking_settings = TrackingSettings()
-        #     tracking_settings.click_tracking = ClickTracking(enable=True)
-        #     tracking_settings.open_tracking = OpenTracking(enable=True)
-        #     message.tracking_settings = tracking_settings
-        # except Exception as tracking_error:
-        #     print(f"⚠️ Advertencia: No se pudo configurar tracking settings: {tracking_error}")
-
-        # Validar que SENDGRID_FROM esté configurado
-        if not SENDGRID_FROM:
-            raise ValueError("SENDGRID_FROM no está configurado")
-        
-        # Validar que SENDGRID_KEY esté configurado
-        if not SENDGRID_KEY:
-            raise ValueError("SENDGRID_KEY no está configurado")
-        
-        # Enviar el correo
-        print(f"📧 Intentando enviar correo a {to_email} desde {SENDGRID_FROM}")
-        sg = SendGridAPIClient(SENDGRID_KEY)
-        response = sg.send(message)
-        print(f"✅ Email enviado a {to_email} con código {codigo_unico}. Status SendGrid: {response.status_code}")
 
-    except Exception as e:
-        print("❌ Error enviando correo con SendGrid:", e)
-        import traceback
-        traceback.print_exc()
+
+cola_pedidos.register("qr", etapa_qr)
+cola_pedidos.register("email", etapa_email)
+cola_pedidos.start()
 
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    import re
-    from datetime import datetime
-
-    def clean_wix_value(value):
-        """Limpia los valores que llegan desde Wix con funciones como JOIN(), TEXT(), etc."""
-        if not isinstance(value, str):
-            return value
-
-        # Si es algo como JOIN(Nombre del ítem, ", ")
-        if value.startswith("JOIN("):
-            inner = re.findall(r"JOIN\((.*)\)", value)
-            if inner:
-                inner = inner[0]
-                # eliminar comillas y paréntesis internos
-                inner = inner.replace("'", "").replace('"', "").replace(",", ", ")
-                return inner.strip()
-
-        # Si es algo como TEXT(Valor total) o TEXT(Fecha...)
-        if value.startswith("TEXT("):
-            inner = re.findall(r"TEXT\((.*)\)", value)
-            if inner:
-                return inner[0].replace("'", "").replace('"', "").strip()
-
-        return value.strip()
-    
-    def extract_real_data_from_wix_payload(data):
-        """Intenta extraer los datos reales del payload completo de Wix"""
-        result = {}
-        
-        def buscar_productos_en_objeto(obj, productos_list):
-            """Función recursiva para buscar nombres de productos en cualquier parte del objeto"""
-            if isinstance(obj, dict):
-                # Buscar directamente campos comunes de productos
-                for key in ['name', 'productName', 'title', 'product', 'itemName', 'productTitle']:
-                    if key in obj and obj[key] and isinstance(obj[key], str):
-                        nombre = obj[key].strip()
-                        # Verificar que no sea un placeholder
-                        if nombre and nombre not in ['Nombre del item', 'Nombre del ítem', 'Item Name', '']:
-                            if nombre not in productos_list:
-                                productos_list.append(nombre)
-                
-                # Buscar en arrays comunes
-                for array_key in ['lineItems', 'items', 'products', 'cartItems', 'orderItems']:
-                    if array_key in obj and isinstance(obj[array_key], list):
-                        for item in obj[array_key]:
-                            buscar_productos_en_objeto(item, productos_list)
-                
-                # Buscar recursivamente en todos los valores
-                for value in obj.values():
-                    buscar_productos_en_objeto(value, productos_list)
-            
-            elif isinstance(obj, list):
-                for item in obj:
-                    buscar_productos_en_objeto(item, productos_list)
-        
-        # Buscar productos en todo el payload
-        productos_list = []
-        buscar_productos_en_objeto(data, productos_list)
-        
-        if productos_list:
-            result['productos'] = ', '.join(productos_list)
-            print(f"✅ Productos encontrados: {result['productos']}")
-        
-        # Buscar fecha en diferentes ubicaciones
-        def buscar_fecha_en_objeto(obj):
-            """Buscar fecha en el objeto"""
-            if isinstance(obj, dict):
-                for key in ['dateCreated', 'createdDate', 'date', 'orderDate', 'purchaseDate', 'timestamp']:
-                    if key in obj and obj[key]:
-                        return obj[key]
-                # Buscar recursivamente
-                for value in obj.values():
-                    fecha = buscar_fecha_en_objeto(value)
-                    if fecha:
-                        return fecha
-            elif isinstance(obj, list):
-                for item in obj:
-                    fecha = buscar_fecha_en_objeto(item)
-                    if fecha:
-                        return fecha
-            return None
-        
-        fecha_encontrada = buscar_fecha_en_objeto(data)
-        if fecha_encontrada:
-            result['fecha'] = fecha_encontrada
-        
-        # Buscar total en diferentes ubicaciones
-        def buscar_total_en_objeto(obj):
-            """Buscar total en el objeto"""
-            if isinstance(obj, dict):
-                # Buscar en priceData
-                if 'priceData' in obj and isinstance(obj['priceData'], dict):
-                    total = obj['priceData'].get('total') or obj['priceData'].get('subtotal')
-                    if total:
-                        return str(total)
-                
-                # Buscar directamente
-                for key in ['total', 'totalPrice', 'amount', 'price', 'subtotal']:
-                    if key in obj and obj[key]:
-                        return str(obj[key])
-                
-                # Buscar recursivamente
-                for value in obj.values():
-                    total = buscar_total_en_objeto(value)
-                    if total:
-                        return total
-            elif isinstance(obj, list):
-                for item in obj:
-                    total = buscar_total_en_objeto(item)
-                    if total:
-                        return total
-            return None
-        
-        total_encontrado = buscar_total_en_objeto(data)
-        if total_encontrado:
-            result['total'] = total_encontrado
-        
-        return result
-
     # --- Recibir datos del webhook ---
-    raw_data = request.get_json(force=True, silent=True)
-    if not raw_data:
-        raw_data = request.form.to_dict()
-    
-    # Guardar una copia del payload completo para debugging
-    print("=" * 80)
-    print("📦 PAYLOAD COMPLETO DE WIX:")
-    print(json.dumps(raw_data, indent=2, ensure_ascii=False))
-    print("=" * 80)
-    
+    with etapa("parse"):
+        raw_data = request.get_json(force=True, silent=True)
+        if not raw_data:
+            raw_data = request.form.to_dict()
+    if not raw_data or not isinstance(raw_data, dict):
+        return jsonify({"status": "error", "message": "Payload vacío o inválido"}), 400
+
+    # Los reintentos de Wix reciben la respuesta original sin repetir cupón, QR ni correo
+    clave = idempotency_key(raw_data)
+    with etapa("dedup"):
+        estado, respuesta = dedup.begin(clave)
+    if estado == DUPLICADO:
+        logger.info("Webhook duplicado (%s), se devuelve la respuesta original", clave)
+        response = jsonify(respuesta)
+        response.headers["Idempotent-Replay"] = "true"
+        return response, 202
+    if estado == EN_CURSO:
+        logger.info("Webhook duplicado (%s) mientras se procesa el original", clave)
+        response = jsonify({"status": "processing", "message": "El pedido ya se está procesando"})
+        response.headers["Retry-After"] = "10"
+        return response, 409
+
+    try:
+        respuesta = procesar_pedido(raw_data)
+    except Exception:
+        # Sin respuesta guardada, el próximo reintento vuelve a procesarlo
+        dedup.abort(clave)
+        raise
+    dedup.finish(clave, respuesta)
+    return jsonify(respuesta), 202
+
+
+def procesar_pedido(raw_data):
+    """Limpia el payload, guarda el pedido y encola QR y correo. Devuelve el cuerpo de la respuesta."""
+    # El payload completo solo se guarda en modo debug o en una muestra
+    if should_capture_payload():
+        logger.info("Payload completo de Wix", extra={"payload": raw_data})
+
     # Intentar extraer datos reales del payload
-    real_data = extract_real_data_from_wix_payload(raw_data)
-    print(f"🔍 Datos reales extraídos: {real_data}")
+    with etapa("extract"):
+        real_data = extract_real_data_from_wix_payload(raw_data)
+    logger.debug("Datos reales extraídos: %s", real_data)
     
     # Usar el payload completo o el data anidado
     data = raw_data
@@ -333,13 +326,10 @@ def webhook():
     fecha = real_data.get("fecha") or clean_wix_value(data.get("fecha", raw_data.get("fecha", "")))
     
     # Log detallado de lo que se encontró
-    print(f"📊 RESUMEN DE EXTRACCIÓN:")
-    print(f"   - Productos extraídos: {real_data.get('productos', 'NO ENCONTRADO')}")
-    print(f"   - Productos después de limpiar: {productos}")
-    print(f"   - Total extraído: {real_data.get('total', 'NO ENCONTRADO')}")
-    print(f"   - Total después de limpiar: {total}")
-    print(f"   - Fecha extraída: {real_data.get('fecha', 'NO ENCONTRADO')}")
-    print(f"   - Fecha después de limpiar: {fecha}")
+    logger.debug(
+        "Resumen de extracción: productos=%r (limpio %r), total=%r (limpio %r), fecha=%r (limpio %r)",
+        real_data.get('productos'), productos, real_data.get('total'), total, real_data.get('fecha'), fecha,
+    )
     
     # Si los productos siguen siendo funciones de Wix o placeholders, usar un valor por defecto más descriptivo
     productos_lower = productos.lower() if productos else ""
@@ -356,12 +346,12 @@ def webhook():
     
     if es_placeholder:
         productos = "Producto de Many Offers"
-        print(f"⚠️ Producto detectado como placeholder: '{productos}', usando valor por defecto")
+        logger.warning("Producto detectado como placeholder, usando valor por defecto: %r", productos)
     
     # Si la fecha sigue siendo una función de Wix, usar la fecha actual
     if fecha and (fecha.startswith("TEXT(") or "Fecha de creación" in fecha or fecha.strip() == ""):
         fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print("⚠️ No se pudo extraer la fecha del pedido, usando fecha actual")
+        logger.warning("No se pudo extraer la fecha del pedido, usando fecha actual")
 
     # --- Normalizar total (intentar convertirlo a número) ---
     try:
@@ -388,45 +378,59 @@ def webhook():
                 except:
                     pass
     except Exception as fecha_error:
-        print(f"⚠️ Error normalizando fecha: {fecha_error}")
+        logger.warning("Error normalizando fecha: %s", fecha_error)
         # Si falla, usar fecha actual
         fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    print(f"\n🧾 Datos finales limpiados:\nNombre: {nombre}\nCorreo: {correo}\nProductos: {productos}\nTotal: {total_str}\nFecha: {fecha}\n")
-
-    # 1️⃣ Generar código único
-    codigo_unico = str(uuid.uuid4())[:8]  # genera un código único corto
-
-    # 2️⃣ Crear URL personalizada
-    url_qr = f"https://botmanyoffers.onrender.com/validar?codigo={codigo_unico}"
-
-    # 3️⃣ Generar el código QR
-    qr_img = qrcode.make(url_qr)
-    qr_path = f"qr_{codigo_unico}.png"
-    qr_img.save(qr_path)
-
-    # 4️⃣ Guardar datos en Google Sheets
-    sheet.append_row([nombre, correo, productos, codigo_unico, total_str, "-", fecha, "NO"])
-
-    # 5️⃣ Crear URL pública para la imagen QR
-    qr_url = f"https://botmanyoffers.onrender.com/qr/{codigo_unico}"
-
-    # 6️⃣ Enviar email al cliente (con manejo de errores interno)
-    send_email_with_qr(
-        to_email=correo,
-        nombre=nombre,
-        producto=productos,
-        qr_path=qr_path,
-        codigo_unico=codigo_unico,
-        monto=total_str,
-        fecha=fecha,
-        url_qr=url_qr,
-        qr_image_url=qr_url
+    logger.debug(
+        "Datos finales limpiados: nombre=%r correo=%r productos=%r total=%r fecha=%r",
+        nombre, correo, productos, total_str, fecha,
     )
 
-    # 7️⃣ NO eliminar el archivo QR - se necesita para servir desde la URL pública
-
-    return jsonify({"status": "success", "message": "Datos guardados, QR generado y correo procesado"}), 200
+    # 1️⃣ Generar código único
+    codigo_unico = codigos.allocate()
+
+    # 2️⃣ Guardar el pedido (la réplica en Google Sheets se hace en segundo plano)
+    pedido = {
+        "nombre": nombre,
+        "correo": correo,
+        "productos": productos,
+        "codigo": codigo_unico,
+        "total": total_str,
+        "fecha": fecha,
+    }
+    with etapa("storage_write"):
+        for intento in range(3):
+            try:
+                storage.append_order(pedido)
+                break
+            except DuplicateCodeError:
+                # Otro worker emitió el mismo código (no estaba en nuestro filtro): se pide otro
+                if intento == 2:
+                    raise
+                codigo_unico = pedido["codigo"] = codigos.allocate()
+
+    # 3️⃣ QR y correo se procesan en la cola
+    with etapa("enqueue"):
+        job_id = cola_pedidos.enqueue(pedido, key=codigo_unico)
+    logger.info("Pedido %s encolado (trabajo %s)", codigo_unico, job_id)
+
+    return {
+        "status": "accepted",
+        "message": "Pedido recibido, QR y correo en proceso",
+        "codigo": codigo_unico,
+        "job_id": job_id
+    }
+
+
+def _cargando_cupones():
+    """
+    503 para un código no encontrado mientras el almacenamiento no terminó de
+    cargar los cupones existentes: puede estar en la hoja y todavía no acá.
+    """
+    response = jsonify({"status": "error", "message": "Cargando cupones, reintentar en unos segundos"})
+    response.headers["Retry-After"] = "10"
+    return response, 503
 
 
 @app.route("/validar", methods=["POST"])
@@ -435,7 +439,7 @@ def validar():
     Recibe un JSON con {"codigo": "ABC123"}.
     Si existe y no está canjeado -> marca "SI" y responde válido.
     Si ya estaba canjeado -> responde inválido.
-    Si no existe -> 404.
+    Si no existe -> 404 (503 si todavía no se cargaron los cupones existentes).
     """
     payload = request.get_json(force=True, silent=True) or {}
     codigo = payload.get("codigo", "").strip()
@@ -444,63 +448,429 @@ def validar():
         return jsonify({"status": "error", "message": "Código no enviado"}), 400
 
     try:
-        # Traemos toda la columna de códigos
-        codigos = sheet.col_values(CODE_COL)  # incluye encabezado
+        with etapa("redeem"):
+            resultado = storage.redeem(codigo)
 
-        if codigo not in codigos:
+        if resultado == CANJE_NO_EXISTE:
+            if not storage.ready():
+                return _cargando_cupones()
             return jsonify({"status": "error", "message": "Código no encontrado"}), 404
 
-        # Fila exacta del código
-        row = codigos.index(codigo) + 1  # +1 por encabezado
+        if resultado == CANJE_YA_CANJEADO:
+            return jsonify({"status": "invalid", "message": "Este código ya fue canjeado"}), 403
 
-        # Estado actual del cupón
-        estado_actual = (sheet.cell(row, CANJEADO_COL).value or "").strip().upper()
+        return jsonify({"status": "valid", "message": "Código válido y marcado como canjeado"}), 200
 
-        if estado_actual == "SI":
-            return jsonify({"status": "invalid", "message": "Este código ya fue canjeado"}), 403
+    except Exception as e:
+        logger.exception("Error en /validar: %s", e)
+        return jsonify({"status": "error", "message": "Error interno"}), 500
 
-        # Marcar como canjeado
-        sheet.update_cell(row, CANJEADO_COL, "SI")
 
-        return jsonify({"status": "valid", "message": "Código válido y marcado como canjeado"}), 200
+# Códigos por request en /validar/batch y /coupons/lookup
+MAX_LOTE_CODIGOS = 1000
+
+
+def _lote_de_codigos():
+    """Lista "codigos" del JSON del request, o None si falta o excede MAX_LOTE_CODIGOS"""
+    payload = request.get_json(force=True, silent=True) or {}
+    codigos = payload.get("codigos")
+    if not isinstance(codigos, list) or not 0 < len(codigos) <= MAX_LOTE_CODIGOS:
+        return None
+    return [str(c).strip() for c in codigos]
+
 
+@app.route("/validar/batch", methods=["POST"])
+@requiere_token(VALIDATOR_TOKEN)
+def validar_lote():
+    """
+    Canje de varios códigos en un request: {"codigos": ["ABC123", ...]}.
+    Una pasada por el índice y una escritura agrupada; devuelve el estado de
+    cada código (valid, invalid, missing o error) en el orden recibido.
+    """
+    codigos = _lote_de_codigos()
+    if codigos is None:
+        return jsonify({"status": "error", "message": f"Se requiere codigos (1 a {MAX_LOTE_CODIGOS})"}), 400
+
+    try:
+        with etapa("redeem"):
+            estados = storage.redeem_many(codigos)
     except Exception as e:
-        print("Error en /validar:", e)
+        logger.exception("Error en /validar/batch: %s", e)
         return jsonify({"status": "error", "message": "Error interno"}), 500
 
+    if CANJE_NO_EXISTE in estados and not storage.ready():
+        # Los no encontrados pueden estar en la hoja sin importar todavía: se reintentan
+        estados = [CANJE_ERROR if e == CANJE_NO_EXISTE else e for e in estados]
+
+    conteo = {}
+    for estado in estados:
+        conteo[estado] = conteo.get(estado, 0) + 1
+    return jsonify({
+        "status": "ok",
+        "results": [{"codigo": c, "status": e} for c, e in zip(codigos, estados)],
+        "counts": conteo,
+    }), 200
+
+
+@app.route("/coupons/lookup", methods=["POST"])
+@requiere_token(VALIDATOR_TOKEN)
+def consultar_cupones():
+    """Estado de varios cupones sin canjearlos: {"codigos": [...]} -> {"results": {codigo: datos o null}}"""
+    codigos = _lote_de_codigos()
+    if codigos is None:
+        return jsonify({"status": "error", "message": f"Se requiere codigos (1 a {MAX_LOTE_CODIGOS})"}), 400
+
+    with etapa("code_lookup"):
+        encontrados = storage.lookup_many(codigos)
+    if None in encontrados.values() and not storage.ready():
+        return _cargando_cupones()
+    # Sin datos personales del comprador: alcanza con el estado del cupón
+    resultados = {
+        codigo: None if datos is None else {k: v for k, v in datos.items() if k not in ("nombre", "correo")}
+        for codigo, datos in encontrados.items()
+    }
+    return jsonify({"status": "ok", "results": resultados}), 200
+
+
+@app.route("/snapshot", methods=["GET"])
+@requiere_token(VALIDATOR_TOKEN)
+def snapshot_cupones():
+    """
+    Cupones sin canjear para el validador sin conexión: ?since=<versión>&producto=<texto>.
+    Con since=0 (o una versión ya purgada) devuelve el snapshot completo.
+    """
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"status": "error", "message": "since debe ser un número de versión"}), 400
+    if not storage.ready():
+        # Un snapshot sin los cupones de la hoja haría rechazar cupones válidos sin conexión
+        return _cargando_cupones()
+
+    try:
+        with etapa("snapshot"):
+            cuerpo = snapshots.build(since, request.args.get("producto"))
+    except NotImplementedError:
+        return jsonify({"status": "error", "message": "El almacenamiento actual no genera snapshots"}), 501
+
+    datos = json.dumps(cuerpo, separators=(",", ":")).encode("utf-8")
+    response = Response(datos, mimetype="application/json")
+    if len(datos) > 1024 and "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.set_data(gzip.compress(datos, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@app.route("/validar/sync", methods=["POST"])
+@requiere_token(VALIDATOR_TOKEN)
+def sincronizar_canjes():
+    """
+    Canjes hechos sin conexión por el validador:
+    {"device": "caja-1", "snapshot": {cabecera firmada}, "redemptions": [{"id", "codigo", "at"}]}
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    canjes = payload.get("redemptions")
+    if not isinstance(canjes, list):
+        return jsonify({"status": "error", "message": "Se requiere la lista redemptions"}), 400
+    dispositivo = str(payload.get("device") or "")[:64] or None
+    cabecera = payload.get("snapshot") if isinstance(payload.get("snapshot"), dict) else None
+
+    try:
+        with etapa("offline_sync"):
+            resultados = snapshots.sync(dispositivo, canjes, cabecera)
+    except NotImplementedError:
+        return jsonify({"status": "error", "message": "El almacenamiento actual no sincroniza canjes"}), 501
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    conflictos = sum(1 for r in resultados if r["status"] == CANJE_CONFLICTO)
+    if conflictos:
+        logger.warning("Sincronización de '%s': %d canjes dobles", dispositivo, conflictos)
+    return jsonify({"status": "ok", "results": resultados, "conflicts": conflictos}), 200
+
+
+@app.route("/validar/conflicts", methods=["GET"])
+@requiere_token(ADMIN_TOKEN)
+def listar_conflictos():
+    """Canjes dobles detectados al sincronizar, para revisarlos (?limit=100)"""
+    try:
+        limit = min(int(request.args.get("limit", 100)), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit debe ser un número"}), 400
+    try:
+        return jsonify({"conflicts": storage.offline_conflicts(limit)}), 200
+    except NotImplementedError:
+        return jsonify({"status": "error", "message": "El almacenamiento actual no registra conflictos"}), 501
+
+
+# --- Reportes ---
+# Exportación (con los códigos) y ventas: solo con "Authorization: Bearer <REPORTS_TOKEN>"
+REPORTS_TOKEN = os.getenv("REPORTS_TOKEN")
+
+
+def _filtros_reporte():
+    return {
+        "desde": request.args.get("from") or None,
+        "hasta": request.args.get("to") or None,
+        "producto": request.args.get("producto") or None,
+    }
+
+
+@app.route("/reports/export", methods=["GET"])
+@requiere_token(REPORTS_TOKEN)
+def exportar_cupones():
+    """
+    Exporta los cupones en streaming: ?format=csv|ndjson&from=AAAA-MM-DD&to=AAAA-MM-DD&producto=...
+    Lleva los códigos sin canjear (alcanzan para canjear): pide "Authorization: Bearer <REPORTS_TOKEN>".
+    """
+    formato = request.args.get("format", "csv")
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"status": "error", "message": "format debe ser csv o ndjson"}), 400
+
+    try:
+        # El primer bloque se arma antes de responder: así un error sale como 501/500 y no a mitad del archivo
+        cupones = storage.iter_coupons(**_filtros_reporte())
+        generador = (csv_stream if formato == "csv" else ndjson_stream)(cupones)
+        primero = next(generador, "")
+    except NotImplementedError:
+        return jsonify({"status": "error", "message": "El almacenamiento actual no exporta cupones"}), 501
+
+    def cuerpo():
+        yield primero
+        yield from generador
+
+    mimetype = "text/csv" if formato == "csv" else "application/x-ndjson"
+    response = Response(stream_with_context(cuerpo()), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=cupones.{formato}"
+    return response
+
+
+@app.route("/reports/summary", methods=["GET"])
+@requiere_token(REPORTS_TOKEN)
+def resumen_ventas():
+    """
+    Ventas y canjes: ?group=day|product|day_product&from=...&to=...&producto=...
+    Lee el resumen que se mantiene al escribir, sin recorrer los cupones.
+    """
+    try:
+        with etapa("report"):
+            filas = storage.report_summary(**_filtros_reporte())
+            reporte = resumir(filas, request.args.get("group", "day_product"))
+    except NotImplementedError:
+        return jsonify({"status": "error", "message": "El almacenamiento actual no tiene resumen de ventas"}), 501
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "ok", **reporte}), 200
+
+
+@app.route("/jobs", methods=["GET"])
+@requiere_token(ADMIN_TOKEN)
+def listar_trabajos():
+    """Estado de la cola de pedidos: conteo por estado y últimos trabajos (?status=failed)"""
+    status = request.args.get("status")
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit debe ser un número"}), 400
+    return jsonify({
+        "counts": cola_pedidos.counts(),
+        "jobs": cola_pedidos.list(status=status, limit=limit)
+    }), 200
+
+
+@app.route("/jobs/<int:job_id>/retry", methods=["POST"])
+@requiere_token(ADMIN_TOKEN)
+def reintentar_trabajo(job_id):
+    if cola_pedidos.retry(job_id):
+        return jsonify({"status": "queued", "job_id": job_id}), 200
+    return jsonify({"status": "error", "message": "Trabajo no encontrado o no está fallido"}), 404
+
+
+@app.route("/codes/blocks", methods=["POST"])
+@requiere_token(ADMIN_TOKEN)
+def reservar_codigos():
+    """
+    Reserva un bloque de códigos únicos para una campaña: {"count": 5000, "label": "navidad"}.
+    Los QR del bloque se generan en segundo plano.
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    try:
+        cantidad = int(payload.get("count", 0))
+    except (TypeError, ValueError):
+        cantidad = 0
+    bloque = str(payload.get("label") or "").strip()
+    if not bloque or not 0 < cantidad <= 100_000:
+        return jsonify({"status": "error", "message": "Se requiere label y count entre 1 y 100000"}), 400
+
+    reservados = []
+    try:
+        with etapa("code_block"):
+            pendientes = codigos.allocate_block(cantidad)
+            while pendientes:
+                rechazados = set(storage.reserve_codes(pendientes, bloque))
+                reservados += [c for c in pendientes if c not in rechazados]
+                # Los que ya existían (emitidos por otro worker) se reemplazan por códigos nuevos
+                pendientes = codigos.allocate_block(len(rechazados)) if rechazados else []
+    except NotImplementedError:
+        return jsonify({"status": "error", "message": "El almacenamiento actual no reserva códigos"}), 501
+
+    logger.info("Bloque de códigos '%s' reservado: %d códigos", bloque, len(reservados))
+    threading.Thread(target=_precargar_qr, args=(bloque, reservados), name="qr-preload", daemon=True).start()
+    return jsonify({"status": "ok", "block": bloque, "count": len(reservados), "codes": reservados}), 200
+
+
+@app.route("/emails/bulk", methods=["POST"])
+@requiere_token(ADMIN_TOKEN)
+def envio_masivo():
+    """
+    Envío masivo de confirmaciones, hasta 1000 destinatarios por request a SendGrid.
+
+    - {"codigos": [...]}: reenvía la confirmación de esos cupones (campañas).
+    - Sin códigos: toma los correos pendientes de la cola (con "include_failed"
+      también los fallidos) y los envía en bloque. Cada trabajo queda terminado
+      o vuelve a la cola con su error, para reintentar solo los que fallaron.
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    try:
+        limit = min(int(payload.get("limit", 1000)), 5000)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "limit debe ser un número"}), 400
+    codigos = payload.get("codigos")
+    if codigos is not None and (not isinstance(codigos, list) or not all(isinstance(c, str) for c in codigos)):
+        return jsonify({"status": "error", "message": "codigos debe ser una lista de códigos"}), 400
+    # Sin configuración de SendGrid no se toma ningún trabajo de la cola
+    try:
+        correo.check_config()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+
+    if codigos:
+        pedidos, faltantes = [], []
+        for codigo in codigos[:limit]:
+            pedido = storage.lookup(codigo)
+            # El motor "sheets" solo indexa código y canje: sin correo no se puede reenviar
+            if pedido is None or not pedido.get("correo"):
+                faltantes.append(codigo)
+            else:
+                pedidos.append(pedido)
+        with etapa("email_bulk"):
+            resultados = correo.send_bulk([destinatario_pedido(p) for p in pedidos])
+    else:
+        faltantes = []
+        trabajos = cola_pedidos.claim_batch("email", limit, include_failed=bool(payload.get("include_failed")))
+        pedidos = [pedido for _, _, pedido, _ in trabajos]
+        try:
+            with etapa("email_bulk"):
+                resultados = correo.send_bulk([destinatario_pedido(p) for p in pedidos])
+        except Exception as e:
+            # Los trabajos tomados vuelven a la cola en vez de quedar bloqueados hasta que venza el lease
+            for job_id, _, pedido, attempts in trabajos:
+                cola_pedidos.fail_stage(job_id, pedido, "email", attempts, e)
+            raise
+        for i, (job_id, _, pedido, attempts) in enumerate(trabajos):
+            if resultados[i] is None:
+                cola_pedidos.complete_stage(job_id, pedido, "email")
+            else:
+                cola_pedidos.fail_stage(job_id, pedido, "email", attempts, resultados[i])
+
+    detalle = {p["codigo"]: "sent" if resultados[i] is None else str(resultados[i]) for i, p in enumerate(pedidos)}
+    enviados = sum(1 for error in resultados.values() if error is None)
+    logger.info("Envío masivo: %d enviados, %d fallidos", enviados, len(resultados) - enviados)
+    return jsonify({
+        "sent": enviados,
+        "failed": len(resultados) - enviados,
+        "missing": faltantes,
+        "results": detalle,
+    }), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def exportar_metricas():
+    """Métricas en formato de texto de Prometheus (suma de todos los workers)"""
+    estado_cola = cola_pedidos.counts()
+    estado_dedup = dedup.stats()
+    gauges = {
+        "jobs": ("Trabajos en la cola de pedidos por estado", [({"status": s}, n) for s, n in estado_cola.items()]),
+        "http_pool_size": ("Conexiones máximas por host en cada worker",
+                           [({"host": h}, e["size"]) for h, e in http_pool.stats().items()]),
+        "webhook_duplicate_rate": ("Proporción de entregas duplicadas del webhook (ventana del TTL)",
+                                   [({}, estado_dedup["duplicate_rate"])]),
+        "webhook_dedup_keys": ("Claves de idempotencia vigentes", [({}, estado_dedup["keys"])]),
+    }
+    try:
+        totales = storage.report_totals()
+        gauges.update({
+            "coupons_issued": ("Cupones emitidos", [({}, totales["pedidos"])]),
+            "coupons_redeemed": ("Cupones canjeados", [({}, totales["canjes"])]),
+        })
+    except NotImplementedError:
+        pass
+    texto = metrics.render(gauges=gauges)
+    return Response(texto, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Liveness: el proceso responde (no consulta servicios externos)"""
+    return jsonify({"status": "ok"}), 200
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness: Google Sheets conectado y almacenamiento listo para canjear"""
+    detalle = {
+        "sheets": sheet.ready,
+        "storage": storage.ready(),
+    }
+    if sheet.last_error and not sheet.ready:
+        detalle["sheets_error"] = sheet.last_error
+    listo = detalle["sheets"] and detalle["storage"]
+    return jsonify({"status": "ready" if listo else "starting", **detalle}), 200 if listo else 503
+
 
 @app.route("/web")
 def web():
     return render_template("validador.html")
 
 
+def _headers_qr(response, etag):
+    # Headers críticos para que Gmail pueda cargar la imagen
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['ETag'] = f'"{etag}"'
+    return response
+
+
 @app.route("/qr/<codigo>")
 def servir_qr(codigo):
-    """Sirve la imagen QR desde el servidor con headers optimizados para Gmail"""
-    qr_path = f"qr_{codigo}.png"
-    print(f"🔍 Intentando servir QR: {qr_path}, existe: {os.path.exists(qr_path)}")
-    
-    if os.path.exists(qr_path):
-        response = send_file(qr_path, mimetype='image/png')
-        # Headers críticos para que Gmail pueda cargar la imagen
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
-        response.headers['Content-Type'] = 'image/png'
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        # Asegurar que la imagen sea accesible
-        response.headers['Content-Disposition'] = 'inline'
-        print(f"✅ QR servido correctamente: {qr_path}")
-        return response
-    else:
-        print(f"❌ QR no encontrado: {qr_path}")
+    """Sirve la imagen QR desde el almacén con headers optimizados para Gmail"""
+    etag = qr_store.etag(codigo)
+
+    # El proxy de Gmail revalida con If-None-Match: se responde 304 sin leer la imagen
+    if etag in request.if_none_match:
+        return _headers_qr(Response(status=304), etag)
+
+    # Solo se generan imágenes de cupones que existen
+    if storage.lookup(codigo) is None:
+        if not storage.ready():
+            return _cargando_cupones()
+        logger.debug("QR no encontrado: %s", codigo)
         return jsonify({"error": "QR no encontrado"}), 404
 
+    _, png = qr_store.get(codigo)
+    response = Response(png, mimetype='image/png')
+    # Asegurar que la imagen sea accesible
+    response.headers['Content-Disposition'] = 'inline'
+    return _headers_qr(response, etag)
+
 
 if __name__ == "__main__":
-    print("Rutas registradas en Flask:")
-    print(app.url_map)
+    logger.info("Rutas registradas en Flask: %s", app.url_map)
 
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
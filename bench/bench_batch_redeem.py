@@ -0,0 +1,108 @@
+"""
+Canje por lotes frente al canje de a un código.
+
+- engine "sqlite": a través de la app (cliente de prueba de Flask), /validar
+  con un request por código contra /validar/batch con lotes de --batch.
+- engine "sheets": a nivel de SheetsStorage, con una hoja falsa que tarda
+  --latency-ms por llamada a la API (como Google): redeem() de a uno contra
+  redeem_many() por lote. Reporta también las llamadas a la hoja.
+
+Verifica que todos los códigos queden canjeados una sola vez.
+
+    python bench/bench_batch_redeem.py --codes 5000 --batch 50 200 1000
+    python bench/bench_batch_redeem.py --engine sheets --codes 500 --latency-ms 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coupon_index import CANJE_OK  # noqa: E402
+from fakes import FakeWorksheet  # noqa: E402
+from storage import RedemptionLocks, SheetsStorage  # noqa: E402
+
+
+def cargar_app(directorio):
+    os.environ.update(LOG_LEVEL="WARNING", JOBS_WORKERS="0", STORAGE_BACKEND="sqlite", VALIDATOR_TOKEN="bench")
+    os.environ.pop("GOOGLE_CREDENTIALS", None)
+    for var, archivo in [("STORAGE_DB", "cupones"), ("JOBS_DB", "jobs"), ("QR_STORE_DB", "qr"),
+                         ("METRICS_DB", "metrics"), ("WEBHOOK_DEDUP_DB", "webhook_dedup")]:
+        os.environ[var] = os.path.join(directorio, f"{archivo}.sqlite3")
+    import app
+    return app
+
+
+def medir_sqlite(app, n, lote, prefijo):
+    codigos = [f"{prefijo}{i:07d}" for i in range(n)]
+    for codigo in codigos:
+        app.storage.append_order({"codigo": codigo})
+    cliente = app.app.test_client()
+
+    inicio = time.perf_counter()
+    if lote is None:
+        estados = [cliente.post("/validar", json={"codigo": c}).get_json()["status"] for c in codigos]
+    else:
+        estados = []
+        for i in range(0, n, lote):
+            respuesta = cliente.post("/validar/batch", json={"codigos": codigos[i:i + lote]},
+                                     headers={"Authorization": "Bearer bench"}).get_json()
+            estados += [r["status"] for r in respuesta["results"]]
+    segundos = time.perf_counter() - inicio
+    return n / segundos, sum(1 for e in estados if e == CANJE_OK), Counter()
+
+
+def medir_sheets(directorio, n, lote, prefijo, latencia):
+    codigos = [f"{prefijo}{i:07d}" for i in range(n)]
+    hoja = FakeWorksheet([["", "", "", c, "", "", "", "NO"] for c in codigos], latency=latencia)
+    storage = SheetsStorage(hoja, writer=None, locks=RedemptionLocks(os.path.join(directorio, f"{prefijo}.sqlite3")))
+    storage.index.load()
+    hoja.llamadas.clear()
+
+    inicio = time.perf_counter()
+    if lote is None:
+        estados = [storage.redeem(c) for c in codigos]
+    else:
+        estados = []
+        for i in range(0, n, lote):
+            estados += storage.redeem_many(codigos[i:i + lote])
+    segundos = time.perf_counter() - inicio
+    return n / segundos, sum(1 for e in estados if e == CANJE_OK), hoja.llamadas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["sqlite", "sheets"], default="sqlite")
+    parser.add_argument("--codes", type=int, default=5000)
+    parser.add_argument("--batch", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--latency-ms", type=float, default=50, help="latencia por llamada a la hoja (sheets)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        app = cargar_app(d) if args.engine == "sqlite" else None
+        print(f"engine={args.engine} codes={args.codes}")
+        print(f"{'camino':<22}{'códigos/s':>12}{'x':>8}{'canjes':>9}  llamadas a la hoja")
+        base = None
+        fallo = False
+        for i, lote in enumerate([None] + args.batch):
+            prefijo = f"B{i}"
+            if args.engine == "sqlite":
+                tasa, canjes, llamadas = medir_sqlite(app, args.codes, lote, prefijo)
+            else:
+                tasa, canjes, llamadas = medir_sheets(d, args.codes, lote, prefijo, args.latency_ms / 1000)
+            base = base or tasa
+            fallo |= canjes != args.codes
+            if args.engine == "sqlite":
+                camino = "/validar (de a uno)" if lote is None else f"/validar/batch x{lote}"
+            else:
+                camino = "redeem() (de a uno)" if lote is None else f"redeem_many() x{lote}"
+            detalle = ", ".join(f"{k}={v}" for k, v in sorted(llamadas.items()))
+            print(f"{camino:<22}{tasa:>12,.0f}{tasa / base:>8.1f}{canjes:>9}  {detalle}")
+    sys.exit(1 if fallo else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark del asignador de códigos de cupón.
+
+Compara el código anterior (uuid4()[:8], 32 bits de hex, sin verificar)
+con CodeAllocator (base32 de Crockford con `secrets`, verificado contra un
+Bloom filter): códigos por segundo, colisiones observadas y esperadas,
+falsos positivos del filtro y memoria frente a un set de Python. Con
+--sqlite mide también la reserva de bloques en SQLiteStorage.
+
+    python bench/bench_code_alloc.py --codes 1000000
+    python bench/bench_code_alloc.py --codes 1000000 --sqlite --block 10000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coupon_codes import ALFABETO, CodeAllocator, probabilidad_colision  # noqa: E402
+
+
+def medir_anterior(n):
+    inicio = time.perf_counter()
+    vistos = set()
+    repetidos = 0
+    for _ in range(n):
+        codigo = str(uuid.uuid4())[:8]
+        if codigo in vistos:
+            repetidos += 1
+        vistos.add(codigo)
+    return n / (time.perf_counter() - inicio), repetidos
+
+
+def medir_asignador(n, largo):
+    # `exists` respaldado por un set para distinguir colisiones reales de falsos positivos
+    emitidos = set()
+    asignador = CodeAllocator(exists=emitidos.__contains__, length=largo)
+    inicio = time.perf_counter()
+    for _ in range(n):
+        emitidos.add(asignador.allocate())
+    segundos = time.perf_counter() - inicio
+
+    # Falsos positivos: códigos nuevos que el filtro dice haber visto
+    prueba = 100_000
+    falsos = sum(1 for _ in range(prueba) if (c := asignador.generate()) in asignador and c not in emitidos)
+    bytes_filtro = sum(len(f._array) for f in asignador._filtros)
+    bytes_set = sys.getsizeof(emitidos) + sum(sys.getsizeof(c) for c in emitidos)
+    return n / segundos, asignador.stats, falsos / prueba, bytes_filtro, bytes_set, len(emitidos) == n
+
+
+def medir_sqlite(n, bloque):
+    from storage import SQLiteStorage
+
+    with tempfile.TemporaryDirectory() as d:
+        storage = SQLiteStorage(os.path.join(d, "cupones.sqlite3"))
+        asignador = CodeAllocator(exists=storage.exists)
+        inicio = time.perf_counter()
+        reservados = 0
+        while reservados < n:
+            codigos = asignador.allocate_block(min(bloque, n - reservados))
+            rechazados = storage.reserve_codes(codigos, "bench")
+            reservados += len(codigos) - len(rechazados)
+        return n / (time.perf_counter() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", type=int, default=1_000_000)
+    parser.add_argument("--length", type=int, default=10)
+    parser.add_argument("--sqlite", action="store_true", help="medir también la reserva de bloques en SQLite")
+    parser.add_argument("--block", type=int, default=10_000)
+    args = parser.parse_args()
+    n = args.codes
+
+    print(f"{'':<28}{'códigos/s':>12}{'repetidos':>11}{'P(colisión) teórica':>22}")
+    tasa, repetidos = medir_anterior(n)
+    print(f"{'uuid4()[:8] (anterior)':<28}{tasa:>12,.0f}{repetidos:>11}{probabilidad_colision(n, 8, '0123456789abcdef'):>22.3g}")
+
+    tasa, stats, fp, bytes_filtro, bytes_set, unicos = medir_asignador(n, args.length)
+    etiqueta = f"CodeAllocator ({args.length} x {len(ALFABETO)})"
+    print(f"{etiqueta:<28}{tasa:>12,.0f}{stats['collisions']:>11}{probabilidad_colision(n, args.length):>22.3g}")
+    print(f"\nsin repetidos: {unicos}   consultas al almacenamiento (filtro positivo): {stats['bloom_hits']}")
+    print(f"falsos positivos del filtro: {fp:.4%}")
+    print(f"memoria: Bloom {bytes_filtro / 2**20:.1f} MiB   set de Python {bytes_set / 2**20:.1f} MiB")
+
+    if args.sqlite:
+        print(f"\nreserva en SQLite (bloques de {args.block}): {medir_sqlite(n, args.block):,.0f} códigos/s")
+
+
+if __name__ == "__main__":
+    main()
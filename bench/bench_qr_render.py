@@ -0,0 +1,65 @@
+"""
+Benchmark de generación de QR: qrcode.make + save (lo que hacía /webhook)
+contra qr_render (configuración cacheada y PNG de 1 bit sin PIL), y el modo
+masivo con pool de procesos.
+
+    python bench/bench_qr_render.py --count 500 --bulk 5000 --processes 4
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qrcode  # noqa: E402
+
+from qr_render import render_many, render_png, render_svg  # noqa: E402
+
+
+PREFIJO = "https://botmanyoffers.onrender.com/validar?codigo="
+
+
+def qrcode_make_png(url):
+    buffer = io.BytesIO()
+    qrcode.make(url).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def medir(nombre, funcion, urls):
+    funcion(urls[0])  # calentar (config cacheada, imports)
+    inicio = time.perf_counter()
+    total_bytes = sum(len(funcion(u)) for u in urls)
+    seg = time.perf_counter() - inicio
+    print(f"{nombre:<24}{len(urls) / seg:>10.0f} QR/s{seg / len(urls) * 1000:>10.2f} ms/QR"
+          f"{total_bytes / len(urls):>10.0f} B/QR")
+    return seg
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=300, help="QR por método en el modo secuencial")
+    parser.add_argument("--bulk", type=int, default=3000, help="QR en el modo masivo (0 para omitir)")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    urls = [PREFIJO + str(uuid.uuid4())[:8] for _ in range(args.count)]
+    print(f"{'método':<24}{'throughput':>14}{'latencia':>13}{'tamaño':>12}")
+    base = medir("qrcode.make + save", qrcode_make_png, urls)
+    nuevo = medir("qr_render png", render_png, urls)
+    medir("qr_render svg", render_svg, urls)
+    print(f"aceleración PNG: x{base / nuevo:.1f}")
+
+    if args.bulk:
+        urls = [PREFIJO + str(uuid.uuid4())[:8] for _ in range(args.bulk)]
+        inicio = time.perf_counter()
+        render_many(urls, processes=args.processes)
+        seg = time.perf_counter() - inicio
+        print(f"render_many ({args.processes or os.cpu_count()} procesos): "
+              f"{args.bulk} QR en {seg:.2f}s = {args.bulk / seg:.0f} QR/s")
+
+
+if __name__ == "__main__":
+    main()
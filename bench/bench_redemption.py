@@ -0,0 +1,126 @@
+"""
+Benchmark de concurrencia del canje de cupones.
+
+Lanza varios procesos (como los workers de gunicorn), cada uno con varios
+hilos, que canjean cupones contra el mismo almacenamiento local:
+
+- "same": todos los procesos intentan canjear los mismos pocos códigos.
+- "distinct": cada código se intenta una sola vez, repartidos entre procesos.
+
+Verifica que cada código se canjee exactamente una vez y reporta el
+throughput por cantidad de workers.
+
+    python bench/bench_redemption.py --engine sqlite --workers 1 2 4 8
+    python bench/bench_redemption.py --engine sheets --requests 4000
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coupon_index import CANJE_OK  # noqa: E402
+from fakes import FakeWorksheet  # noqa: E402
+from storage import CANJEADO_COL, SQLiteStorage, SheetsStorage, RedemptionLocks  # noqa: E402
+
+
+def _abrir(engine, tmpdir, codigos):
+    if engine == "sqlite":
+        return SQLiteStorage(os.path.join(tmpdir, "cupones.sqlite3"))
+    storage = SheetsStorage(
+        FakeWorksheet([["", "", "", c, "", "", "", "NO"] for c in codigos]), writer=None,
+        locks=RedemptionLocks(os.path.join(tmpdir, "canjes.sqlite3")),
+    )
+    storage.index.load()
+    return storage
+
+
+def _worker(engine, tmpdir, codigos, intentos, hilos, salida):
+    storage = _abrir(engine, tmpdir, codigos)
+    ok = Counter()
+    lock = threading.Lock()
+
+    def correr(parte):
+        for codigo in parte:
+            if storage.redeem(codigo) == CANJE_OK:
+                with lock:
+                    ok[codigo] += 1
+
+    partes = [intentos[i::hilos] for i in range(hilos)]
+    ts = [threading.Thread(target=correr, args=(p,)) for p in partes]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    salida.put(dict(ok))
+
+
+def correr_escenario(engine, modo, workers, total, hilos, hot_codes):
+    tmpdir = tempfile.mkdtemp(prefix="bench_canje_")
+    if modo == "same":
+        codigos = [f"HOT{i:04d}" for i in range(hot_codes)]
+        por_worker = [[codigos[j % hot_codes] for j in range(total // workers)] for _ in range(workers)]
+    else:
+        codigos = [f"C{i:07d}" for i in range(total)]
+        por_worker = [codigos[w::workers] for w in range(workers)]
+
+    if engine == "sqlite":
+        storage = SQLiteStorage(os.path.join(tmpdir, "cupones.sqlite3"))
+        for codigo in codigos:
+            storage.append_order({"codigo": codigo})
+        del storage
+    else:
+        RedemptionLocks(os.path.join(tmpdir, "canjes.sqlite3"))
+
+    ctx = multiprocessing.get_context("fork")
+    salida = ctx.Queue()
+    procesos = [
+        ctx.Process(target=_worker, args=(engine, tmpdir, codigos, por_worker[w], hilos, salida))
+        for w in range(workers)
+    ]
+    inicio = time.perf_counter()
+    for p in procesos:
+        p.start()
+    resultados = [salida.get() for _ in procesos]
+    for p in procesos:
+        p.join()
+    segundos = time.perf_counter() - inicio
+
+    canjes = Counter()
+    for r in resultados:
+        canjes.update(r)
+    violaciones = sum(1 for c in codigos if canjes.get(c, 0) != 1)
+    intentos = sum(len(p) for p in por_worker)
+    return intentos, segundos, sum(canjes.values()), violaciones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["sqlite", "sheets"], default="sqlite")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, default=4, help="hilos por worker")
+    parser.add_argument("--requests", type=int, default=4000, help="intentos de canje por escenario")
+    parser.add_argument("--hot-codes", type=int, default=10, help="códigos disputados en el modo 'same'")
+    args = parser.parse_args()
+
+    print(f"engine={args.engine} threads/worker={args.threads} requests={args.requests}")
+    print(f"{'modo':<9}{'workers':>8}{'intentos':>10}{'canjes':>8}{'seg':>8}{'req/s':>10}  resultado")
+    fallo = False
+    for modo in ("same", "distinct"):
+        for workers in args.workers:
+            intentos, seg, canjes, violaciones = correr_escenario(
+                args.engine, modo, workers, args.requests, args.threads, args.hot_codes
+            )
+            estado = "OK" if violaciones == 0 else f"FALLO ({violaciones} códigos != 1 canje)"
+            fallo |= violaciones > 0
+            print(f"{modo:<9}{workers:>8}{intentos:>10}{canjes:>8}{seg:>8.2f}{intentos / seg:>10.0f}  {estado}")
+    sys.exit(1 if fallo else 0)
+
+
+if __name__ == "__main__":
+    main()
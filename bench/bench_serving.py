@@ -0,0 +1,310 @@
+"""
+Prueba de carga del servidor: gunicorn con workers sync contra gthread.
+
+Levanta gunicorn con bench/serving_app.py (Sheets y SendGrid simulados con
+latencia y, opcionalmente, errores 429) en cada modo y lo carga con
+--concurrency clientes keep-alive durante --duration segundos. Cada cliente
+repite: POST /webhook con un payload grabado de Wix (bench/fixtures, con
+el id de pedido cambiado para que no se deduplique), GET /qr/<codigo> y
+POST /validar. Al terminar espera a que la cola de pedidos (QR y correo)
+se vacíe.
+
+Reporta requests por segundo, percentiles de latencia por endpoint y las
+llamadas a las APIs externas simuladas (de /metrics, sumadas entre
+workers) por pedido. Con --output guarda todo en JSON para comparar corridas.
+
+Con --engine sheets (el camino que espera a Google dentro del request)
+conviene --workers 1: la hoja simulada vive en cada proceso.
+
+    python bench/bench_serving.py --engine sheets --modes sync gthread:64 gthread:256
+    python bench/bench_serving.py --engine sqlite --workers 2 --concurrency 128
+    python bench/bench_serving.py --modes gthread:64 --sheets-quota-rate 0.2 --sendgrid-throttle-rate 0.1
+"""
+import argparse
+import glob
+import re
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from wix_payload import idempotency_key  # noqa: E402
+
+ENDPOINTS = ("/webhook", "/qr", "/validar")
+METRICA_EXTERNA = re.compile(r'^botmanyoffers_external_(calls|errors)_total\{op="([^"]*)",service="([^"]*)"\} (\S+)$')
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def levantar(modo, args, directorio):
+    hilos = int(modo.split(":")[1]) if ":" in modo else 1
+    puerto = puerto_libre()
+    env = dict(
+        os.environ,
+        LOG_LEVEL="WARNING",
+        STORAGE_BACKEND=args.engine,
+        WEB_CONCURRENCY=str(args.workers),
+        GUNICORN_THREADS=str(hilos),
+        JOBS_WORKERS=str(args.jobs_workers),
+        QR_RENDER_PROCESSES=str(args.qr_processes),
+        BENCH_SHEETS_LATENCY_MS=str(args.sheets_latency_ms),
+        BENCH_SENDGRID_LATENCY_MS=str(args.sendgrid_latency_ms),
+        BENCH_SHEETS_QUOTA_RATE=str(args.sheets_quota_rate),
+        BENCH_SENDGRID_THROTTLE_RATE=str(args.sendgrid_throttle_rate),
+        BENCH_SEED=str(args.seed),
+        SNAPSHOT_SECRET="bench",
+        ADMIN_TOKEN="bench",
+    )
+    env.pop("GOOGLE_CREDENTIALS", None)
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join(RAIZ, "gunicorn.conf.py"),
+         "--chdir", directorio, "--pythonpath", f"{os.path.join(RAIZ, 'bench')},{RAIZ}",
+         "-b", f"127.0.0.1:{puerto}", "serving_app:app"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        try:
+            # /ready: con el motor "sheets" además espera a que cargue el índice
+            with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/ready", timeout=1) as r:
+                if r.status == 200:
+                    return proceso, puerto
+        except Exception:
+            time.sleep(0.2)
+    proceso.kill()
+    raise RuntimeError(f"gunicorn ({modo}) no quedó listo")
+
+
+def cargar_fixtures(patron):
+    """
+    Plantillas de payloads de Wix: (texto JSON, id del pedido o None). Cada
+    request usa una variante con el id cambiado, o con un eventId propio si
+    el payload no trae id (si no, el webhook lo tomaría como un reintento).
+    """
+    plantillas = []
+    for ruta in sorted(glob.glob(patron)):
+        with open(ruta, encoding="utf-8") as f:
+            payload = json.load(f)
+        tipo, _, valor = idempotency_key(payload).partition(":")
+        texto = json.dumps(payload, ensure_ascii=False)
+        plantillas.append((texto, json.dumps(valor) if tipo == "order" and json.dumps(valor) in texto else None))
+    if not plantillas:
+        raise SystemExit(f"No hay fixtures en {patron}")
+    return plantillas
+
+
+def variante(plantilla, sufijo):
+    texto, id_pedido = plantilla
+    if id_pedido is not None:
+        return json.loads(texto.replace(id_pedido, id_pedido[:-1] + f'-{sufijo}"'))
+    payload = json.loads(texto)
+    payload["eventId"] = f"bench-{sufijo}"
+    return payload
+
+
+def llamadas_externas(puerto):
+    """{(servicio, operación): [llamadas, errores]} según /metrics"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/metrics", timeout=30) as r:
+        texto = r.read().decode()
+    llamadas = {}
+    for linea in texto.splitlines():
+        m = METRICA_EXTERNA.match(linea)
+        if m:
+            tipo, operacion, servicio, valor = m.groups()
+            llamadas.setdefault((servicio, operacion), [0, 0])[tipo == "errors"] += int(float(valor))
+    return llamadas
+
+
+def esperar_cola(puerto, limite):
+    """Espera a que no queden trabajos pendientes; devuelve el conteo final por estado"""
+    fin = time.monotonic() + limite
+    while True:
+        pedido = urllib.request.Request(f"http://127.0.0.1:{puerto}/jobs?limit=1",
+                                        headers={"Authorization": "Bearer bench"})
+        with urllib.request.urlopen(pedido, timeout=30) as r:
+            conteo = json.load(r)["counts"]
+        if not conteo.get("queued") and not conteo.get("running") or time.monotonic() > fin:
+            return conteo
+        time.sleep(0.5)
+
+
+class Cliente:
+    """Conexión keep-alive; se reabre si el servidor la cierra (los workers sync no hacen keep-alive)"""
+
+    def __init__(self, puerto):
+        self.puerto = puerto
+        self.conn = None
+
+    def get(self, ruta):
+        return self.pedir("GET", ruta)
+
+    def post(self, ruta, cuerpo):
+        return self.pedir("POST", ruta, json.dumps(cuerpo), {"Content-Type": "application/json"})
+
+    def pedir(self, metodo, ruta, cuerpo=None, headers=None):
+        for intento in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.puerto, timeout=120)
+            try:
+                self.conn.request(metodo, ruta, cuerpo, headers or {})
+                respuesta = self.conn.getresponse()
+                datos = respuesta.read()
+                if respuesta.will_close:
+                    self.conn.close()
+                    self.conn = None
+                return respuesta.status, datos
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close()
+                self.conn = None
+                if intento:
+                    raise
+
+
+def cargar(puerto, concurrencia, duracion, plantillas):
+    latencias = {ruta: [] for ruta in ENDPOINTS}
+    errores = []
+    lock = threading.Lock()
+    fin = time.monotonic() + duracion
+    corrida = time.time_ns()
+
+    def correr(n):
+        cliente = Cliente(puerto)
+        propias = {ruta: [] for ruta in ENDPOINTS}
+        i = 0
+
+        def medir(ruta, esperado, llamada, *argumentos):
+            t0 = time.perf_counter()
+            status, datos = llamada(*argumentos)
+            propias[ruta].append(time.perf_counter() - t0)
+            if status != esperado:
+                errores.append((ruta, status))
+            return status == esperado, datos
+
+        while time.monotonic() < fin:
+            i += 1
+            pedido = variante(plantillas[(n + i) % len(plantillas)], f"{corrida}-{n}-{i}")
+            try:
+                ok, datos = medir("/webhook", 202, cliente.post, "/webhook", pedido)
+                if not ok:
+                    continue
+                codigo = json.loads(datos)["codigo"]
+                medir("/qr", 200, cliente.get, f"/qr/{codigo}")
+                medir("/validar", 200, cliente.post, "/validar", {"codigo": codigo})
+            except Exception as e:
+                errores.append(("red", type(e).__name__))
+        with lock:
+            for ruta, valores in propias.items():
+                latencias[ruta] += valores
+
+    hilos = [threading.Thread(target=correr, args=(n,)) for n in range(concurrencia)]
+    inicio = time.monotonic()
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    return latencias, errores, time.monotonic() - inicio
+
+
+def percentil(valores, p):
+    if not valores:
+        return float("nan")
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=["sqlite", "sheets"], default="sheets")
+    parser.add_argument("--modes", nargs="+", default=["sync", "gthread:64", "gthread:256"],
+                        help="sync o gthread:<hilos por worker>")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=128)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--jobs-workers", type=int, default=4)
+    parser.add_argument("--qr-processes", type=int, default=0)
+    parser.add_argument("--sheets-latency-ms", type=float, default=100)
+    parser.add_argument("--sendgrid-latency-ms", type=float, default=150)
+    parser.add_argument("--sheets-quota-rate", type=float, default=0,
+                        help="proporción de escrituras a la hoja que fallan con 429")
+    parser.add_argument("--sendgrid-throttle-rate", type=float, default=0,
+                        help="proporción de envíos que SendGrid rechaza con 429")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fixtures", default=os.path.join(RAIZ, "bench", "fixtures", "*.json"))
+    parser.add_argument("--drain-timeout", type=float, default=120,
+                        help="segundos máximos de espera a que se vacíe la cola de pedidos")
+    parser.add_argument("--output", help="guarda los resultados en este archivo JSON")
+    args = parser.parse_args()
+    plantillas = cargar_fixtures(args.fixtures)
+
+    print(f"engine={args.engine} workers={args.workers} concurrency={args.concurrency} "
+          f"duration={args.duration}s sheets={args.sheets_latency_ms}ms sendgrid={args.sendgrid_latency_ms}ms "
+          f"quota={args.sheets_quota_rate} throttle={args.sendgrid_throttle_rate} fixtures={len(plantillas)}")
+    resultados = []
+    for modo in args.modes:
+        with tempfile.TemporaryDirectory() as d:
+            proceso, puerto = levantar(modo, args, d)
+            try:
+                # Lo que ya se llamó al arrancar (carga del índice) no cuenta
+                antes = llamadas_externas(puerto)
+                latencias, errores, segundos = cargar(puerto, args.concurrency, args.duration, plantillas)
+                cola = esperar_cola(puerto, args.drain_timeout)
+                if args.workers > 1:
+                    # Los otros workers guardan sus métricas cada 5 s
+                    time.sleep(6)
+                despues = llamadas_externas(puerto)
+            finally:
+                proceso.terminate()
+                proceso.wait(timeout=30)
+        externas = {
+            clave: [n - antes.get(clave, [0, 0])[0], e - antes.get(clave, [0, 0])[1]]
+            for clave, (n, e) in despues.items()
+            if (n, e) != tuple(antes.get(clave, [0, 0]))
+        }
+        resultados.append({
+            "mode": modo,
+            "requests_per_s": sum(len(v) for v in latencias.values()) / segundos,
+            "orders": len(latencias["/webhook"]),
+            "errors": dict(Counter(f"{ruta} {status}" for ruta, status in errores)),
+            "jobs": cola,
+            "latency_ms": {
+                ruta: {"p50": percentil(v, 50) * 1000, "p99": percentil(v, 99) * 1000,
+                       "max": max(v, default=float("nan")) * 1000, "count": len(v)}
+                for ruta, v in latencias.items()
+            },
+            "external_calls": {f"{s}.{o}": {"calls": n, "errors": e} for (s, o), (n, e) in sorted(externas.items())},
+        })
+
+    for r in resultados:
+        print(f"\n== {r['mode']}: {r['requests_per_s']:.0f} req/s, {r['orders']} pedidos, "
+              f"trabajos {r['jobs']}")
+        if r["errors"]:
+            print("   errores: " + ", ".join(f"{k}={v}" for k, v in sorted(r["errors"].items())))
+        print(f"   {'endpoint':<12}{'n':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for ruta, l in r["latency_ms"].items():
+            print(f"   {ruta:<12}{l['count']:>8}{l['p50']:>9.1f}{l['p99']:>9.1f}{l['max']:>9.1f}")
+        print(f"   {'llamada externa':<28}{'n':>8}{'errores':>9}{'por pedido':>12}")
+        for nombre, c in r["external_calls"].items():
+            por_pedido = c["calls"] / r["orders"] if r["orders"] else float("nan")
+            print(f"   {nombre:<28}{c['calls']:>8}{c['errors']:>9}{por_pedido:>12.3f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": resultados}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
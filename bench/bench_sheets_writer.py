@@ -0,0 +1,84 @@
+"""
+SheetsWriter con la cuota de Google agotada.
+
+Una hoja falsa responde 429 a --quota-rate de las escrituras mientras un
+hilo hace append() a ritmo constante (--rate por segundo) durante --seconds.
+Con lotes chicos (--max-batch) el lote se llena antes de cumplir la espera;
+aun así, tras cada 429 el writer tiene que esperar el backoff completo.
+
+Cuenta las llamadas append_rows y falla si superan las que permite el
+backoff (1s, 2s, 4s, ... hasta --max-backoff) en ese tiempo.
+
+    python bench/bench_sheets_writer.py
+    python bench/bench_sheets_writer.py --quota-rate 0 --seconds 2
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeWorksheet  # noqa: E402
+from sheets_writer import SheetsWriter  # noqa: E402
+
+
+def llamadas_maximas(segundos, max_backoff):
+    """Envíos que caben en `segundos` si todos reciben 429 (más uno de margen)"""
+    t, backoff, envios = 0.0, 0.0, 0
+    while t <= segundos:
+        envios += 1
+        backoff = min(max_backoff, max(1.0, backoff * 2))
+        t += backoff
+    return envios + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=4)
+    parser.add_argument("--rate", type=float, default=200, help="append() por segundo")
+    parser.add_argument("--max-batch", type=int, default=5)
+    parser.add_argument("--flush-interval-ms", type=int, default=500)
+    parser.add_argument("--max-backoff", type=float, default=60)
+    parser.add_argument("--quota-rate", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    hoja = FakeWorksheet(quota_error_rate=args.quota_rate, seed=args.seed)
+    writer = SheetsWriter(hoja, flush_interval_ms=args.flush_interval_ms,
+                          max_batch=args.max_batch, max_backoff=args.max_backoff)
+    writer.start()
+
+    futures = []
+    fin = time.monotonic() + args.seconds
+
+    def productor():
+        while time.monotonic() < fin:
+            futures.append(writer.append(["", "", "", f"C{len(futures):07d}", "", "", "", "NO"]))
+            time.sleep(1 / args.rate)
+
+    hilo = threading.Thread(target=productor)
+    hilo.start()
+    hilo.join()
+
+    llamadas = hoja.llamadas["append_rows"]
+    confirmadas = sum(1 for f in futures if f.done() and not f.exception())
+    print(f"appends={len(futures)} append_rows={llamadas} 429={hoja.errores['append_rows']} "
+          f"confirmadas={confirmadas} pendientes={writer.pending()} backoff={writer._backoff:.1f}s")
+
+    if args.quota_rate >= 1:
+        maximo = llamadas_maximas(args.seconds, args.max_backoff)
+        fallo = llamadas > maximo
+        print(f"máximo con backoff: {maximo} -> {'FALLA' if fallo else 'ok'}")
+    else:
+        # Sin cuota agotada todo lo escrito antes del último intervalo queda confirmado
+        writer._lleno.set()
+        time.sleep(args.flush_interval_ms / 1000 * 2)
+        fallo = writer.pending() > 0 or any(not f.done() for f in futures)
+        print(f"pendientes al final: {writer.pending()} -> {'FALLA' if fallo else 'ok'}")
+    sys.exit(1 if fallo else 0)
+
+
+if __name__ == "__main__":
+    main()
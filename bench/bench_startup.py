@@ -0,0 +1,132 @@
+"""
+Tiempo de arranque: desde que arranca el intérprete hasta el primer request
+atendido, en procesos nuevos (mediana de varias corridas).
+
+Sin GOOGLE_CREDENTIALS la conexión a Google falla en segundo plano y la app
+igual tiene que responder /health y aceptar /webhook. También mide cuánto
+costaría importar al arrancar los módulos que ahora se cargan a demanda.
+
+    python bench/bench_startup.py --runs 5
+    python bench/bench_startup.py --runs 3 --gunicorn
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Se ejecuta en un proceso nuevo; imprime los milisegundos de cada paso
+HIJO = """
+import os, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {raiz!r})
+import app
+t1 = time.perf_counter()
+c = app.app.test_client()
+assert c.get("/health").status_code == 200
+t2 = time.perf_counter()
+r = c.post("/webhook", json={{"data": {{"nombre": "Ana", "correo": "ana@x.com", "productos": "Pizza", "total": "10"}}}})
+assert r.status_code == 202, r.status_code
+t3 = time.perf_counter()
+print((t1 - t0) * 1000, (t2 - t0) * 1000, (t3 - t0) * 1000, flush=True)
+# Salida inmediata: los hilos daemon (conexión a Google, cola) no deben abortar el cierre
+os._exit(0)
+"""
+
+DIFERIDOS = ["gspread", "google.oauth2.service_account", "qrcode"]
+
+
+def entorno(directorio):
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    env.pop("GOOGLE_CREDENTIALS", None)
+    for var, archivo in [("STORAGE_DB", "cupones"), ("JOBS_DB", "jobs"), ("QR_STORE_DB", "qr"),
+                         ("METRICS_DB", "metrics"), ("WEBHOOK_DEDUP_DB", "webhook_dedup")]:
+        env[var] = os.path.join(directorio, f"{archivo}.sqlite3")
+    return env
+
+
+def medir_en_proceso(runs):
+    filas = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as d:
+            salida = subprocess.run(
+                [sys.executable, "-c", HIJO.format(raiz=RAIZ)], env=entorno(d), cwd=d,
+                capture_output=True, text=True, check=True,
+            ).stdout.split()
+        filas.append([float(x) for x in salida[-3:]])
+    return [statistics.median(col) for col in zip(*filas)]
+
+
+def medir_import(modulo, runs):
+    tiempos = []
+    for _ in range(runs):
+        salida = subprocess.run(
+            [sys.executable, "-c", f"import time; t = time.perf_counter(); import {modulo}; "
+                                   "print((time.perf_counter() - t) * 1000)"],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        tiempos.append(float(salida))
+    return statistics.median(tiempos)
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def medir_gunicorn(runs, timeout=30):
+    """Desde lanzar gunicorn hasta el primer 200 de /health"""
+    tiempos = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as d:
+            puerto = puerto_libre()
+            inicio = time.perf_counter()
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "--chdir", RAIZ, "-b", f"127.0.0.1:{puerto}", "app:app"],
+                env=entorno(d), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                while time.perf_counter() - inicio < timeout:
+                    try:
+                        with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/health", timeout=1) as r:
+                            if r.status == 200:
+                                break
+                    except OSError:
+                        time.sleep(0.01)
+                else:
+                    raise RuntimeError("gunicorn no respondió /health a tiempo")
+                tiempos.append((time.perf_counter() - inicio) * 1000)
+            finally:
+                proc.terminate()
+                proc.wait()
+    return statistics.median(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--gunicorn", action="store_true", help="medir también con gunicorn real")
+    args = parser.parse_args()
+
+    importar, health, webhook = medir_en_proceso(args.runs)
+    print(f"import app             {importar:8.1f} ms")
+    print(f"primer /health         {health:8.1f} ms")
+    print(f"primer /webhook (202)  {webhook:8.1f} ms")
+
+    print("\nimports diferidos (costo que ya no se paga al arrancar):")
+    for modulo in DIFERIDOS:
+        print(f"  {modulo:<30}{medir_import(modulo, args.runs):8.1f} ms")
+
+    if args.gunicorn:
+        print(f"\ngunicorn -> /health 200 {medir_gunicorn(args.runs):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Micro-benchmark del extractor de payloads de Wix.
+
+Compara el extractor anterior (tres recorridos recursivos, con lineItems
+visitados dos veces y dedupe con listas) contra wix_payload, sobre los
+payloads grabados en bench/fixtures y sobre carritos grandes sintéticos.
+También verifica que el recorrido genérico dé el mismo resultado que antes
+y que el extractor final dé lo esperado para cada fixture. En los pedidos
+de Wix eCommerce/Stores el camino rápido no coincide con el extractor
+anterior a propósito: toma los lineItems y priceSummary.total en lugar del
+primer "title" o "price" que aparezca en el payload.
+
+    python bench/bench_wix_extract.py --iterations 2000 --cart-sizes 10 100 500
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from wix_payload import _extraer_generico, extract_real_data_from_wix_payload  # noqa: E402
+
+
+def extraer_anterior(data):
+    """Copia del extractor que tenía webhook() antes del recorrido único (sin prints)"""
+    result = {}
+
+    def buscar_productos_en_objeto(obj, productos_list):
+        if isinstance(obj, dict):
+            for key in ['name', 'productName', 'title', 'product', 'itemName', 'productTitle']:
+                if key in obj and obj[key] and isinstance(obj[key], str):
+                    nombre = obj[key].strip()
+                    if nombre and nombre not in ['Nombre del item', 'Nombre del ítem', 'Item Name', '']:
+                        if nombre not in productos_list:
+                            productos_list.append(nombre)
+            for array_key in ['lineItems', 'items', 'products', 'cartItems', 'orderItems']:
+                if array_key in obj and isinstance(obj[array_key], list):
+                    for item in obj[array_key]:
+                        buscar_productos_en_objeto(item, productos_list)
+            for value in obj.values():
+                buscar_productos_en_objeto(value, productos_list)
+        elif isinstance(obj, list):
+            for item in obj:
+                buscar_productos_en_objeto(item, productos_list)
+
+    productos_list = []
+    buscar_productos_en_objeto(data, productos_list)
+    if productos_list:
+        result['productos'] = ', '.join(productos_list)
+
+    def buscar_fecha_en_objeto(obj):
+        if isinstance(obj, dict):
+            for key in ['dateCreated', 'createdDate', 'date', 'orderDate', 'purchaseDate', 'timestamp']:
+                if key in obj and obj[key]:
+                    return obj[key]
+            for value in obj.values():
+                fecha = buscar_fecha_en_objeto(value)
+                if fecha:
+                    return fecha
+        elif isinstance(obj, list):
+            for item in obj:
+                fecha = buscar_fecha_en_objeto(item)
+                if fecha:
+                    return fecha
+        return None
+
+    fecha_encontrada = buscar_fecha_en_objeto(data)
+    if fecha_encontrada:
+        result['fecha'] = fecha_encontrada
+
+    def buscar_total_en_objeto(obj):
+        if isinstance(obj, dict):
+            if 'priceData' in obj and isinstance(obj['priceData'], dict):
+                total = obj['priceData'].get('total') or obj['priceData'].get('subtotal')
+                if total:
+                    return str(total)
+            for key in ['total', 'totalPrice', 'amount', 'price', 'subtotal']:
+                if key in obj and obj[key]:
+                    return str(obj[key])
+            for value in obj.values():
+                total = buscar_total_en_objeto(value)
+                if total:
+                    return total
+        elif isinstance(obj, list):
+            for item in obj:
+                total = buscar_total_en_objeto(item)
+                if total:
+                    return total
+        return None
+
+    total_encontrado = buscar_total_en_objeto(data)
+    if total_encontrado:
+        result['total'] = total_encontrado
+
+    return result
+
+
+# Resultado esperado del extractor final para cada fixture grabado
+ESPERADO = {
+    "wix_automation.json": {
+        "productos": "Cena para dos, Horario, Cupón Car Wash",
+        "fecha": "2024-12-02T14:05:33Z",
+        "total": "TEXT(Valor total)",
+    },
+    # Antes: productos "Entrega digital" (shippingInfo.title) y total el dict
+    # del precio del primer ítem, "{'amount': '12.50', ...}"
+    "wix_ecom_order.json": {
+        "productos": "Cupón 2x1 Pizza Familiar, Spa Day 50% OFF",
+        "fecha": "2024-11-29T18:42:07.512Z",
+        "total": "52.50",
+    },
+    # Antes: total 9.99 (priceData del primer ítem) en lugar del total del pedido
+    "wix_stores_legacy.json": {
+        "productos": "Menú Ejecutivo, Postre del día",
+        "fecha": "2024-10-15T09:12:44Z",
+        "total": "13.49",
+    },
+}
+
+
+def carrito_grande(base, n):
+    """Repite los lineItems del pedido grabado hasta tener n, con opciones anidadas"""
+    payload = copy.deepcopy(base)
+    pedido = payload["data"]["order"]
+    modelo = pedido["lineItems"]
+    items = []
+    for i in range(n):
+        item = copy.deepcopy(modelo[i % len(modelo)])
+        item["id"] = f"item-{i}"
+        item["productName"] = {"original": f"Producto {i}", "translated": f"Producto {i}"}
+        item["descriptionLines"] = [
+            {"name": {"original": f"Opción {j}"}, "plainText": {"original": f"Valor {j}"},
+             "modifiers": [{"title": f"Extra {i}-{j}-{k}", "price": {"amount": "1"}} for k in range(3)]}
+            for j in range(3)
+        ]
+        items.append(item)
+    pedido["lineItems"] = items
+    return payload
+
+
+def medir(funcion, payload, iteraciones):
+    inicio = time.perf_counter()
+    for _ in range(iteraciones):
+        funcion(payload)
+    return (time.perf_counter() - inicio) / iteraciones * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--cart-sizes", type=int, nargs="+", default=[10, 100, 500])
+    args = parser.parse_args()
+
+    casos = []
+    for ruta in sorted(glob.glob(os.path.join(RAIZ, "bench", "fixtures", "wix_*.json"))):
+        with open(ruta, encoding="utf-8") as f:
+            casos.append((os.path.basename(ruta), json.load(f)))
+    base = dict(casos).get("wix_ecom_order.json")
+    if base:
+        for n in args.cart_sizes:
+            casos.append((f"carrito sintético x{n}", carrito_grande(base, n)))
+
+    print(f"{'payload':<28}{'anterior µs':>13}{'genérico µs':>13}{'final µs':>11}{'x':>7}"
+          f"  genérico == anterior  final == esperado")
+    distinto = False
+    for nombre, payload in casos:
+        iteraciones = max(10, args.iterations // max(1, len(json.dumps(payload)) // 2000))
+        anterior = medir(extraer_anterior, payload, iteraciones)
+        generico = medir(_extraer_generico, payload, iteraciones)
+        final = medir(extract_real_data_from_wix_payload, payload, iteraciones)
+        igual = _extraer_generico(payload) == extraer_anterior(payload)
+        esperado = ESPERADO.get(nombre)
+        correcto = "-" if esperado is None else extract_real_data_from_wix_payload(payload) == esperado
+        distinto |= not igual or correcto is False
+        print(f"{nombre:<28}{anterior:>13.1f}{generico:>13.1f}{final:>11.1f}{anterior / final:>7.1f}"
+              f"  {str(igual):<21} {correcto}")
+    sys.exit(1 if distinto else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Dobles de Google Sheets y SendGrid para los benchmarks.
+
+- FakeWorksheet: hoja en memoria con las llamadas que usa la app (get,
+  get_all_values, append_rows, update_cell, batch_update), una latencia fija
+  por llamada y el conteo de llamadas. Con quota_error_rate, esa proporción
+  de las escrituras falla con el 429 de cuota de Google (APIError). Vive en
+  un solo proceso: con varios workers de gunicorn cada uno tiene su propia hoja.
+- SendGridSink: responde 202 a todo con la latencia indicada; con
+  throttle_rate, esa proporción de los envíos recibe un 429 con Retry-After.
+- instalar(hoja, sendgrid_latency, sendgrid_throttle_rate): reemplaza la
+  conexión a Google (sheets_client.abrir_hoja) y el transporte HTTP de
+  requests por el SendGridSink. Hay que llamarla antes de importar app.
+
+Los errores se sortean con un random.Random(seed) propio: con la misma
+semilla y el mismo orden de llamadas fallan las mismas.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+ENCABEZADO = ["Nombre", "Correo", "Productos", "Codigo", "Total", "-", "Fecha", "Canjeado"]
+
+
+def a1_a_fila_columna(celda, fila_por_defecto=None):
+    """'D2' -> (2, 4); 'H' -> (fila_por_defecto, 8)"""
+    letras, numero = re.match(r"([A-Z]*)(\d*)", celda).groups()
+    columna = 0
+    for letra in letras:
+        columna = columna * 26 + ord(letra) - ord("A") + 1
+    return (int(numero) if numero else fila_por_defecto), columna
+
+
+def error_de_cuota():
+    """El APIError que levanta gspread cuando Google responde 429 por cuota"""
+    import requests
+    from gspread.exceptions import APIError
+
+    respuesta = requests.Response()
+    respuesta.status_code = 429
+    respuesta._content = json.dumps({"error": {
+        "code": 429, "status": "RESOURCE_EXHAUSTED",
+        "message": "Quota exceeded for quota metric 'Write requests' (simulado)",
+    }}).encode()
+    return APIError(respuesta)
+
+
+class FakeWorksheet:
+    def __init__(self, filas=(), latency=0.0, quota_error_rate=0.0, seed=None):
+        self.filas = [list(ENCABEZADO)] + [list(f) for f in filas]
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.llamadas = Counter()
+        self.errores = Counter()
+        self._azar = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _llamada(self, nombre, escritura=False):
+        with self._lock:
+            self.llamadas[nombre] += 1
+            falla = escritura and self._azar.random() < self.quota_error_rate
+            if falla:
+                self.errores[nombre] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if falla:
+            raise error_de_cuota()
+
+    def get(self, rango, **kwargs):
+        self._llamada("get")
+        inicio, _, fin = rango.split("!")[-1].partition(":")
+        fila0, col0 = a1_a_fila_columna(inicio)
+        fila1, col1 = a1_a_fila_columna(fin or inicio, fila_por_defecto=None)
+        with self._lock:
+            filas = [f[col0 - 1:col1] for f in self.filas[fila0 - 1:fila1]]
+        # Como la API: sin las filas vacías del final
+        while filas and not any(filas[-1]):
+            filas.pop()
+        return filas
+
+    def get_all_values(self, **kwargs):
+        self._llamada("get_all_values")
+        with self._lock:
+            return [list(f) for f in self.filas]
+
+    def append_rows(self, valores, **kwargs):
+        self._llamada("append_rows", escritura=True)
+        with self._lock:
+            primera = len(self.filas) + 1
+            self.filas.extend(list(v) for v in valores)
+            ultima = len(self.filas)
+        return {"updates": {"updatedRange": f"'Hoja 1'!A{primera}:H{ultima}"}}
+
+    def _escribir(self, fila, columna, valor):
+        with self._lock:
+            while len(self.filas) < fila:
+                self.filas.append([""] * len(ENCABEZADO))
+            celdas = self.filas[fila - 1]
+            celdas.extend([""] * (columna - len(celdas)))
+            celdas[columna - 1] = valor
+
+    def update_cell(self, fila, columna, valor):
+        self._llamada("update_cell", escritura=True)
+        self._escribir(fila, columna, valor)
+
+    def batch_update(self, datos, **kwargs):
+        self._llamada("batch_update", escritura=True)
+        for dato in datos:
+            fila, columna = a1_a_fila_columna(dato["range"].split("!")[-1].split(":")[0])
+            self._escribir(fila, columna, dato["values"][0][0])
+        return {}
+
+
+class SendGridSink:
+    """Transporte HTTP falso: cuenta los requests y responde 202 (o 429) tras `latency` segundos"""
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests = Counter()
+        self.throttled = Counter()
+        self._azar = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, adapter, request, **kwargs):
+        import requests
+
+        with self._lock:
+            self.requests[request.url] += 1
+            limitado = self._azar.random() < self.throttle_rate
+            if limitado:
+                self.throttled[request.url] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        respuesta = requests.Response()
+        respuesta.status_code = 429 if limitado else 202
+        if limitado:
+            respuesta.headers["Retry-After"] = str(self.retry_after)
+        respuesta.url = request.url
+        respuesta.request = request
+        respuesta._content = b""
+        return respuesta
+
+
+def instalar(hoja, sendgrid_latency=0.0, sendgrid_throttle_rate=0.0, seed=None):
+    import os
+
+    import requests.adapters
+    import sheets_client
+
+    sumidero = SendGridSink(sendgrid_latency, throttle_rate=sendgrid_throttle_rate, seed=seed)
+    sheets_client.abrir_hoja = lambda spreadsheet_id, pool=None: hoja
+    requests.adapters.HTTPAdapter.send = lambda adapter, request, **kw: sumidero.send(adapter, request, **kw)
+    os.environ.setdefault("SENDGRID_KEY", "bench")
+    os.environ.setdefault("SENDGRID_FROM", "bench@example.com")
+    return sumidero
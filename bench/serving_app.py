@@ -0,0 +1,32 @@
+"""
+La app con Google Sheets y SendGrid simulados, para las pruebas de carga
+(bench_serving.py la levanta con gunicorn serving_app:app).
+
+- BENCH_SHEETS_LATENCY_MS y BENCH_SENDGRID_LATENCY_MS: latencia de cada
+  llamada simulada.
+- BENCH_SHEETS_QUOTA_RATE: proporción de escrituras a la hoja que fallan con
+  429 de cuota.
+- BENCH_SENDGRID_THROTTLE_RATE: proporción de envíos que SendGrid rechaza con 429.
+- BENCH_SEED: semilla de esos errores.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeWorksheet, instalar  # noqa: E402
+
+semilla = os.getenv("BENCH_SEED")
+hoja = FakeWorksheet(
+    latency=float(os.getenv("BENCH_SHEETS_LATENCY_MS", 100)) / 1000,
+    quota_error_rate=float(os.getenv("BENCH_SHEETS_QUOTA_RATE", 0)),
+    seed=semilla,
+)
+sumidero = instalar(
+    hoja,
+    sendgrid_latency=float(os.getenv("BENCH_SENDGRID_LATENCY_MS", 150)) / 1000,
+    sendgrid_throttle_rate=float(os.getenv("BENCH_SENDGRID_THROTTLE_RATE", 0)),
+    seed=semilla,
+)
+
+from app import app  # noqa: E402,F401
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import math
+import secrets
+import threading
+
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Base32 de Crockford: sin I, L, O ni U, así no se confunden al dictar o tipear un código
+ALFABETO = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+# 10 caracteres de 32 símbolos = 50 bits (uuid4()[:8] eran 32 bits de hex)
+LARGO_CODIGO = 10
+
+
+def probabilidad_colision(n, largo=LARGO_CODIGO, alfabeto=ALFABETO):
+    """Probabilidad de al menos una colisión entre n códigos al azar (cumpleaños)"""
+    espacio = len(alfabeto) ** largo
+    return -math.expm1(-n * (n - 1) / (2 * espacio))
+
+
+class BloomFilter:
+    """Conjunto aproximado de tamaño fijo: sin falsos negativos, falsos positivos ~error_rate"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _posiciones(self, clave):
+        # Doble hashing: k posiciones a partir de dos enteros de 64 bits de un solo digest
+        digest = hashlib.blake2b(clave.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, clave):
+        for pos in self._posiciones(clave):
+            self._array[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, clave):
+        return all(self._array[pos >> 3] & (1 << (pos & 7)) for pos in self._posiciones(clave))
+
+
+class CodeAllocator:
+    """
+    Genera códigos de cupón únicos con `secrets` (no predecibles).
+
+    Los códigos ya emitidos se guardan en un Bloom filter escalable: cuando
+    uno se llena se agrega otro del doble de capacidad y la mitad de tasa
+    de error, así el total no pasa de 2 x error_rate. Si el filtro dice
+    que el código no existe, se usa sin consultar nada más. Si dice que
+    "quizás" existe (colisión real o falso positivo), se confirma con
+    `exists(codigo)` contra el almacenamiento. El almacenamiento sigue siendo
+    la autoridad: los códigos que emitan otros workers no están en este
+    filtro, y una colisión al insertar se resuelve con otro código.
+    """
+
+    def __init__(self, exists=None, length=LARGO_CODIGO, alphabet=ALFABETO, capacity=100_000, error_rate=0.001):
+        self.exists = exists
+        self.length = length
+        self.alphabet = alphabet
+        self.error_rate = error_rate
+        self._filtros = [BloomFilter(capacity, error_rate)]
+        self._lock = threading.Lock()
+        self.stats = {"allocated": 0, "bloom_hits": 0, "collisions": 0}
+
+    def generate(self):
+        if 256 % len(self.alphabet) == 0:
+            # Alfabeto de 32: cada byte al azar, módulo 32, da un símbolo uniforme con una sola lectura
+            base = len(self.alphabet)
+            return "".join(self.alphabet[b % base] for b in secrets.token_bytes(self.length))
+        return "".join(secrets.choice(self.alphabet) for _ in range(self.length))
+
+    # --- Códigos emitidos ---
+    def add(self, codigo):
+        with self._lock:
+            filtro = self._filtros[-1]
+            if filtro.count >= filtro.capacity:
+                filtro = BloomFilter(filtro.capacity * 2, filtro.error_rate / 2)
+                self._filtros.append(filtro)
+            filtro.add(codigo)
+
+    def load(self, codigos):
+        n = 0
+        for codigo in codigos:
+            self.add(codigo)
+            n += 1
+        logger.info("Códigos existentes cargados en el filtro: %d", n)
+        return n
+
+    def __contains__(self, codigo):
+        return any(codigo in f for f in self._filtros)
+
+    def __len__(self):
+        return sum(f.count for f in self._filtros)
+
+    # --- Asignación ---
+    def allocate(self):
+        """Un código que no está emitido (según el filtro y, si hace falta, el almacenamiento)"""
+        while True:
+            codigo = self.generate()
+            if codigo in self:
+                self.stats["bloom_hits"] += 1
+                # Sin `exists` no se distingue un falso positivo: se descarta igual
+                if self.exists is None:
+                    continue
+                if self.exists(codigo):
+                    self.stats["collisions"] += 1
+                    metrics.inc("code_collisions_total")
+                    continue
+            self.add(codigo)
+            self.stats["allocated"] += 1
+            return codigo
+
+    def allocate_block(self, n):
+        """n códigos distintos entre sí y con los ya emitidos (para campañas)"""
+        bloque = set()
+        while len(bloque) < n:
+            bloque.add(self.allocate())
+        return list(bloque)
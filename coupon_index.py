@@ -0,0 +1,254 @@
+import logging
+import re
+import threading
+import time
+
+from metrics import metrics, etapa
+
+
+logger = logging.getLogger(__name__)
+
+
+# Estados que devuelve CouponIndex.redeem()
+CANJE_OK = "valid"
+CANJE_YA_CANJEADO = "invalid"
+CANJE_NO_EXISTE = "missing"
+CANJE_ERROR = "error"       # solo en redeem_many: la escritura falló, se puede reintentar
+
+
+def rowcol_to_a1(fila, columna):
+    """Celda en notación A1 (3, 8 -> 'H3'); igual que gspread.utils, sin importar gspread"""
+    letras = ""
+    while columna > 0:
+        columna, resto = divmod(columna - 1, 26)
+        letras = chr(ord("A") + resto) + letras
+    return f"{letras}{fila}"
+
+
+def fila_desde_rango(rango):
+    """Extrae el número de fila de un rango A1 como 'Hoja 1'!A15:H15"""
+    if not rango:
+        return None
+    match = re.search(r"![A-Z]+(\d+)", rango)
+    return int(match.group(1)) if match else None
+
+
+class CouponIndex:
+    """
+    Índice en memoria código -> [fila, canjeado] de la hoja de cupones.
+
+    Se carga una sola vez al arrancar, se mantiene al día con las altas de
+    /webhook y los canjes de /validar, y un hilo en segundo plano trae solo
+    las filas nuevas que hayan agregado otros workers. Cada cierto número de
+    ciclos se hace una resincronización completa de la columna "Canjeado".
+
+    Un código desconocido dispara un refresh incremental (puede ser de otro
+    worker), pero a lo sumo uno cada `miss_refresh_interval` segundos: si no,
+    mandar códigos inventados a /validar agotaría la cuota de lecturas.
+    """
+
+    def __init__(self, sheet, code_col, canjeado_col, refresh_interval=30, full_resync_every=10,
+                 writer=None, write_timeout=30, miss_refresh_interval=3):
+        self.sheet = sheet
+        self.writer = writer          # SheetsWriter opcional para agrupar las escrituras
+        self.write_timeout = write_timeout
+        self.code_col = code_col
+        self.canjeado_col = canjeado_col
+        self.refresh_interval = refresh_interval
+        self.full_resync_every = full_resync_every
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._lock = threading.Lock()
+        self._entries = {}       # codigo -> [fila, canjeado]
+        self._ultima_fila = 1    # última fila leída de la hoja (la 1 es el encabezado)
+        self._ultimo_refresh = 0.0
+        self.loaded = False
+        self._hilo = None
+
+    # --- Lectura de la hoja ---
+    def _leer_filas(self, desde_fila):
+        """Lee las columnas código..canjeado desde `desde_fila` hasta el final (1 llamada)"""
+        inicio = rowcol_to_a1(desde_fila, self.code_col)
+        fin = re.sub(r"\d+", "", rowcol_to_a1(1, self.canjeado_col))
+        with metrics.external("sheets", "get"):
+            return self.sheet.get(f"{inicio}:{fin}")
+
+    def _aplicar_filas(self, filas, desde_fila):
+        offset_canjeado = self.canjeado_col - self.code_col
+        for i, valores in enumerate(filas):
+            fila = desde_fila + i
+            codigo = (valores[0] if valores else "").strip()
+            if codigo:
+                estado = valores[offset_canjeado] if len(valores) > offset_canjeado else ""
+                canjeado = (estado or "").strip().upper() == "SI"
+                entrada = self._entries.get(codigo)
+                # Un canje local que aún no llegó a la hoja no se pisa
+                if entrada and entrada[1] and not canjeado:
+                    continue
+                self._entries[codigo] = [fila, canjeado]
+            self._ultima_fila = max(self._ultima_fila, fila)
+
+    def load(self):
+        """Carga completa del índice (la fila 1 es el encabezado)"""
+        self._ultimo_refresh = time.monotonic()
+        filas = self._leer_filas(2)
+        with self._lock:
+            self._entries = {}
+            self._ultima_fila = 1
+            self._aplicar_filas(filas, 2)
+            self.loaded = True
+        logger.info("Índice de cupones cargado: %d códigos", len(self._entries))
+
+    def refresh(self):
+        """Trae solo las filas agregadas después de la última lectura"""
+        self._ultimo_refresh = time.monotonic()
+        desde = self._ultima_fila + 1
+        filas = self._leer_filas(desde)
+        if filas:
+            with self._lock:
+                self._aplicar_filas(filas, desde)
+
+    def refresh_on_miss(self):
+        """refresh() por un código que no está, salvo que ya haya habido uno hace poco"""
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora - self._ultimo_refresh < self.miss_refresh_interval:
+                metrics.inc("index_miss_refresh_skipped_total")
+                return False
+            # Se marca antes de leer: los demás hilos con el mismo apuro no repiten la llamada
+            self._ultimo_refresh = ahora
+        self.refresh()
+        return True
+
+    # --- Mantenimiento en segundo plano ---
+    def start(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._loop, name="coupon-index", daemon=True)
+            self._hilo.start()
+
+    def _loop(self):
+        ciclo = 0
+        while True:
+            time.sleep(self.refresh_interval)
+            ciclo += 1
+            try:
+                if ciclo % self.full_resync_every == 0:
+                    self.load()
+                else:
+                    self.refresh()
+            except Exception as e:
+                logger.warning("Error refrescando índice de cupones: %s", e)
+
+    # --- Operaciones ---
+    def add(self, codigo, fila, canjeado=False):
+        with self._lock:
+            self._entries[codigo] = [fila, canjeado]
+            self._ultima_fila = max(self._ultima_fila, fila)
+
+    def get(self, codigo):
+        with self._lock:
+            entrada = self._entries.get(codigo)
+            return tuple(entrada) if entrada else None
+
+    def get_many(self, codigos):
+        """Entradas de un lote (None si no existe), con un solo refresh si falta alguno"""
+        with self._lock:
+            faltan = any(c not in self._entries for c in codigos)
+        if faltan:
+            self.refresh_on_miss()
+        with self._lock:
+            return {c: tuple(self._entries[c]) if c in self._entries else None for c in codigos}
+
+    def codes(self):
+        with self._lock:
+            return list(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def redeem(self, codigo):
+        """
+        Marca el código como canjeado con una sola escritura en la hoja.
+        Si no está en el índice se intenta un refresh incremental antes de
+        responder que no existe (puede haberlo creado otro worker).
+        """
+        with etapa("code_lookup"):
+            if self.get(codigo) is None:
+                self.refresh_on_miss()
+
+            with self._lock:
+                entrada = self._entries.get(codigo)
+                if entrada is None:
+                    return CANJE_NO_EXISTE
+                if entrada[1]:
+                    return CANJE_YA_CANJEADO
+                # Se marca antes de escribir para que otro hilo no lo canjee a la vez
+                entrada[1] = True
+                fila = entrada[0]
+
+        try:
+            with etapa("redeem_write"):
+                if self.writer is not None:
+                    # Espera a que el lote con este canje quede confirmado por Google
+                    self.writer.update_cell(fila, self.canjeado_col, "SI").result(timeout=self.write_timeout)
+                else:
+                    with metrics.external("sheets", "update_cell"):
+                        self.sheet.update_cell(fila, self.canjeado_col, "SI")
+        except Exception:
+            with self._lock:
+                entrada[1] = False
+            raise
+        return CANJE_OK
+
+    def redeem_many(self, codigos):
+        """
+        Canjea un lote con una escritura agrupada: con el writer todas las
+        celdas salen en el mismo batch_update; sin él, en un batch_update
+        directo. Devuelve un estado por código, en el orden recibido.
+        """
+        with etapa("code_lookup"):
+            entradas = self.get_many(codigos)
+            marcados = {}
+            with self._lock:
+                for codigo in dict.fromkeys(codigos):
+                    entrada = self._entries.get(codigo)
+                    if entrada is not None and not entrada[1]:
+                        entrada[1] = True
+                        marcados[codigo] = entrada
+
+        fallidos = set()
+        with etapa("redeem_write"):
+            if self.writer is not None:
+                futuros = {c: self.writer.update_cell(e[0], self.canjeado_col, "SI") for c, e in marcados.items()}
+                for codigo, futuro in futuros.items():
+                    try:
+                        futuro.result(timeout=self.write_timeout)
+                    except Exception as e:
+                        logger.warning("No se pudo escribir el canje de %s: %s", codigo, e)
+                        fallidos.add(codigo)
+            elif marcados:
+                celdas = [{"range": rowcol_to_a1(e[0], self.canjeado_col), "values": [["SI"]]} for e in marcados.values()]
+                try:
+                    with metrics.external("sheets", "batch_update"):
+                        self.sheet.batch_update(celdas)
+                except Exception as e:
+                    logger.warning("No se pudo escribir el lote de %d canjes: %s", len(celdas), e)
+                    fallidos.update(marcados)
+
+        with self._lock:
+            for codigo in fallidos:
+                marcados[codigo][1] = False
+
+        estados = []
+        vistos = set()
+        for codigo in codigos:
+            if codigo in fallidos:
+                estados.append(CANJE_ERROR)
+            elif codigo in marcados and codigo not in vistos:
+                estados.append(CANJE_OK)
+            elif entradas[codigo] is None:
+                estados.append(CANJE_NO_EXISTE)
+            else:
+                estados.append(CANJE_YA_CANJEADO)
+            vistos.add(codigo)
+        return estados
@@ -0,0 +1,279 @@
+import base64
+import logging
+import re
+import threading
+import time
+
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+SENDGRID_URL = "https://api.sendgrid.com/v3/mail/send"
+
+# Límite de SendGrid: destinatarios (personalizations) por request a /v3/mail/send
+MAX_PERSONALIZATIONS = 1000
+
+# Campos de cada destinatario que se reemplazan en las plantillas (-campo-)
+CAMPOS = ("nombre", "producto", "monto", "fecha", "codigo", "url_qr", "qr_image_url")
+
+
+class Plantilla:
+    """
+    Texto con etiquetas -campo- compilado una sola vez: se parte en trozos
+    fijos y campos, y render() solo los une. El texto original (con las
+    etiquetas) es el que va a SendGrid en los envíos masivos, que reemplaza
+    las etiquetas por los valores de cada personalization.
+    """
+
+    def __init__(self, texto):
+        self.texto = texto
+        partes = re.split("-(" + "|".join(CAMPOS) + ")-", texto)
+        # Posiciones pares: texto fijo; impares: nombre del campo
+        self._partes = [(i % 2 == 1, p) for i, p in enumerate(partes) if p]
+
+    def render(self, valores):
+        return "".join(str(valores[p]) if es_campo else p for es_campo, p in self._partes)
+
+
+# Asunto sin caracteres especiales para evitar spam
+ASUNTO = Plantilla("Confirmacion de compra - Many Offers - -producto-")
+
+TEXTO = Plantilla("""
+Hola -nombre-,
+
+¡Gracias por tu compra en Many Offers!
+
+Aquí tienes tu código QR para tu cupón de -producto-.
+Cada código es único y válido solo una vez.
+
+Detalles de tu compra:
+- Producto: -producto-
+- Monto: $-monto-
+- Fecha: -fecha-
+- Código: -codigo-
+
+Puedes presentar este código QR en el establecimiento para validar tu descuento.
+
+¡Disfruta tu oferta!
+""")
+
+# La imagen principal va por URL (más confiable que un adjunto inline en muchos clientes)
+HTML = Plantilla("""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+</head>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px; background-color: #ffffff;">
+    <div style="background-color: #ffffff; padding: 20px;">
+        <h2 style="color: #2A0066; margin-top: 0;">¡Gracias por tu compra en Many Offers!</h2>
+
+        <p>Hola -nombre-,</p>
+
+        <p>Aquí tienes tu código QR para tu cupón de <strong>-producto-</strong>.</p>
+        <p style="color: #666; font-size: 14px;">Cada código es único y válido solo una vez.</p>
+
+        <div style="background-color: #f5f5f5; padding: 20px; border-radius: 10px; margin: 20px 0;">
+            <h3 style="margin-top: 0; color: #2A0066;">Detalles de tu compra:</h3>
+            <ul style="list-style: none; padding: 0; margin: 0;">
+                <li style="margin: 10px 0;"><strong>Producto:</strong> -producto-</li>
+                <li style="margin: 10px 0;"><strong>Monto:</strong> $-monto-</li>
+                <li style="margin: 10px 0;"><strong>Fecha:</strong> -fecha-</li>
+                <li style="margin: 10px 0;"><strong>Código:</strong> -codigo-</li>
+            </ul>
+        </div>
+
+        <div style="text-align: center; margin: 30px 0;">
+            <p style="margin-bottom: 15px; font-weight: bold;">Puedes presentar este código QR en el establecimiento para validar tu descuento:</p>
+            <!-- Usar URL directa como fuente principal -->
+            <img src="-qr_image_url-" alt="QR del cupón" style="max-width: 300px; height: auto; border: 2px solid #2A0066; border-radius: 10px; padding: 10px; background-color: white; display: block; margin: 0 auto;" />
+        </div>
+
+        <div style="margin-top: 30px; padding: 15px; background-color: #f0f0f0; border-radius: 5px;">
+            <p style="margin: 0; font-size: 14px;">O usar este enlace directo:</p>
+            <p style="margin: 10px 0 0 0;"><a href="-url_qr-" style="color: #2A0066; word-break: break-all; text-decoration: none;">-url_qr-</a></p>
+        </div>
+
+        <p style="margin-top: 30px; color: #666; font-size: 14px;">¡Disfruta tu oferta!</p>
+
+        <hr style="border: none; border-top: 1px solid #eee; margin: 30px 0;">
+        <p style="font-size: 12px; color: #999; text-align: center;">Este es un correo de confirmación de compra. Si no realizaste esta compra, por favor ignora este mensaje.</p>
+    </div>
+</body>
+</html>
+""")
+
+
+class TokenBucket:
+    """Limita la tasa de requests: `rate` por segundo con ráfagas de hasta `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self._tokens = self.capacity
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n=1):
+        """Bloquea hasta que haya `n` tokens disponibles y los consume"""
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (ahora - self._ultimo) * self.rate)
+                self._ultimo = ahora
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                espera = (n - self._tokens) / self.rate
+            time.sleep(espera)
+
+    def pause(self, segundos):
+        """Vacía el bucket por `segundos` (por ejemplo, ante un 429 con Retry-After)"""
+        with self._lock:
+            self._tokens = min(self._tokens, -segundos * self.rate)
+
+
+class EmailError(Exception):
+    def __init__(self, status, mensaje):
+        super().__init__(f"SendGrid respondió {status}: {mensaje}")
+        self.status = status
+
+
+class EmailDispatcher:
+    """
+    Envío de correos de confirmación por la API v3 de SendGrid.
+
+    - send_one(destinatario): un correo con el QR adjunto inline como respaldo
+      (el camino normal de la cola, un pedido por vez).
+    - send_bulk(destinatarios): reenvíos y recuperación de pendientes. Manda
+      las plantillas una vez por request y un personalization por
+      destinatario (hasta MAX_PERSONALIZATIONS), sin adjunto: la imagen va
+      por URL. Devuelve el resultado de cada destinatario.
+
+    `destinatario` es un dict con `correo` y los CAMPOS. Todos los requests
+    pasan por el token bucket; un 429 pausa el bucket según Retry-After.
+    """
+
+    def __init__(self, session, api_key, from_email, rate=10, burst=None, max_per_request=MAX_PERSONALIZATIONS,
+                 max_throttle_retries=5):
+        self.session = session      # callable que devuelve la sesión HTTP compartida
+        self.api_key = api_key
+        self.from_email = from_email
+        self.bucket = TokenBucket(rate, burst)
+        self.max_per_request = max_per_request
+        self.max_throttle_retries = max_throttle_retries
+        self.stats = {"requests": 0, "sent": 0, "failed": 0, "throttled": 0}
+
+    # --- Armado de mensajes ---
+    def check_config(self):
+        """ValueError si falta la configuración de SendGrid"""
+        if not self.from_email:
+            raise ValueError("SENDGRID_FROM no está configurado")
+        if not self.api_key:
+            raise ValueError("SENDGRID_KEY no está configurado")
+
+    def _base(self, asunto=None):
+        self.check_config()
+        mensaje = {
+            "from": {"email": self.from_email},
+            # Configurar reply-to para evitar spam
+            "reply_to": {"email": self.from_email},
+            "content": [
+                {"type": "text/plain", "value": TEXTO.texto},
+                {"type": "text/html", "value": HTML.texto},
+            ],
+        }
+        if asunto:
+            mensaje["subject"] = asunto
+        return mensaje
+
+    @staticmethod
+    def _personalization(destinatario):
+        return {
+            "to": [{"email": destinatario["correo"]}],
+            "subject": ASUNTO.render(destinatario),
+            "substitutions": {f"-{campo}-": str(destinatario[campo]) for campo in CAMPOS},
+        }
+
+    def _post(self, mensaje, operacion):
+        """Un request a SendGrid respetando la tasa; reintenta los 429"""
+        for _ in range(self.max_throttle_retries + 1):
+            self.bucket.take()
+            self.stats["requests"] += 1
+            with metrics.external("sendgrid", operacion):
+                respuesta = self.session().post(
+                    SENDGRID_URL, json=mensaje,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                )
+            if respuesta.status_code != 429:
+                break
+            self.stats["throttled"] += 1
+            espera = float(respuesta.headers.get("Retry-After") or 1)
+            logger.warning("SendGrid limitó la tasa (429), pausa de %.1fs", espera)
+            self.bucket.pause(espera)
+        if not respuesta.ok:
+            raise EmailError(respuesta.status_code, respuesta.text[:500])
+        return respuesta
+
+    # --- Envíos ---
+    def send_one(self, destinatario, qr_png=None):
+        mensaje = self._base(ASUNTO.render(destinatario))
+        mensaje["personalizations"] = [{"to": [{"email": destinatario["correo"]}]}]
+        mensaje["content"] = [
+            {"type": "text/plain", "value": TEXTO.render(destinatario)},
+            {"type": "text/html", "value": HTML.render(destinatario)},
+        ]
+        if qr_png:
+            # Adjunto inline como respaldo (algunos clientes de correo lo prefieren a la URL)
+            mensaje["attachments"] = [{
+                "content": base64.b64encode(qr_png).decode("ascii"),
+                "type": "image/png",
+                "filename": f"qr_{destinatario['codigo']}.png",
+                "disposition": "inline",
+                "content_id": "qr_cupon",
+            }]
+        respuesta = self._post(mensaje, "send")
+        self.stats["sent"] += 1
+        return respuesta
+
+    def send_bulk(self, destinatarios):
+        """
+        Envía a todos los destinatarios en requests de hasta max_per_request.
+        Devuelve {índice: None si salió, o el error}, con índices de `destinatarios`.
+        """
+        resultados = {}
+        pendientes = list(enumerate(destinatarios))
+        for i in range(0, len(pendientes), self.max_per_request):
+            self._enviar_grupo(pendientes[i:i + self.max_per_request], resultados)
+        enviados = sum(1 for error in resultados.values() if error is None)
+        self.stats["sent"] += enviados
+        self.stats["failed"] += len(resultados) - enviados
+        return resultados
+
+    def _enviar_grupo(self, grupo, resultados):
+        mensaje = self._base()
+        mensaje["personalizations"] = [self._personalization(d) for _, d in grupo]
+        try:
+            self._post(mensaje, "send_bulk")
+        except EmailError as e:
+            # SendGrid rechaza el request entero (400) si un destinatario es inválido: se parte
+            # el grupo en mitades hasta aislarlo y los demás se envían igual. Otros errores
+            # (401/403 de la API key, 429 que siguió después de los reintentos) fallarían igual
+            # en cada mitad: todo el grupo queda con el error
+            if e.status == 400 and len(grupo) > 1:
+                mitad = len(grupo) // 2
+                self._enviar_grupo(grupo[:mitad], resultados)
+                self._enviar_grupo(grupo[mitad:], resultados)
+                return
+            for i, _ in grupo:
+                resultados[i] = e
+            return
+        except Exception as e:
+            # Error de red o del servidor: todo el grupo queda para reintentar
+            for i, _ in grupo:
+                resultados[i] = e
+            return
+        for i, _ in grupo:
+            resultados[i] = None
@@ -0,0 +1,14 @@
+# Configuración de gunicorn; se carga sola desde el directorio de la app (Procfile: gunicorn app:app).
+# Puerto y cantidad de workers siguen saliendo de PORT y WEB_CONCURRENCY, como antes.
+#
+# Los requests casi no usan CPU: esperan escrituras agrupadas a Sheets (futures
+# del SheetsWriter) y SQLite, y el resto (QR, correo, réplica) va por la cola.
+# Con GUNICORN_THREADS > 1 cada worker es "gthread" y atiende esa cantidad de
+# requests en espera a la vez, compartiendo un solo proceso (índice, cachés,
+# pools HTTP). Con 1 queda el worker sync de siempre.
+import os
+
+threads = int(os.getenv("GUNICORN_THREADS", 1))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread" if threads > 1 else "sync")
+# Conexiones keep-alive abiertas por worker en modo gthread (las que esperan no ocupan un hilo)
+worker_connections = int(os.getenv("GUNICORN_CONNECTIONS", 1000))
@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolAdapter(HTTPAdapter):
+    """HTTPAdapter con timeout por defecto y conteo de requests / conexiones nuevas"""
+
+    def __init__(self, host, size, timeout, retries):
+        self.host = host
+        self.size = size
+        self.timeout = timeout
+        self.requests = 0
+        self.connections = 0
+        self._contadas = 0     # conexiones abiertas según urllib3 en la última lectura
+        self._lock = threading.Lock()
+        super().__init__(
+            pool_connections=1,
+            pool_maxsize=size,
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=retries,
+                # Solo se reintentan métodos idempotentes; POST únicamente si no llegó a conectar
+                status_forcelist=(500, 502, 503, 504),
+                backoff_factor=0.5,
+                raise_on_status=False,
+            ),
+        )
+
+    def send(self, request, timeout=None, **kwargs):
+        # gspread pasa timeout=None explícito: se usa el del host
+        respuesta = super().send(request, timeout=timeout or self.timeout, **kwargs)
+        pools = self.poolmanager.pools
+        abiertas = sum(pools[clave].num_connections for clave in pools.keys() if clave in pools)
+        with self._lock:
+            nuevas = max(0, abiertas - self._contadas)
+            self._contadas = abiertas
+            self.requests += 1
+            self.connections += nuevas
+        metrics.inc("http_requests_total", host=self.host)
+        if nuevas:
+            metrics.inc("http_connections_total", nuevas, host=self.host)
+        return respuesta
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "requests": self.requests,
+                "connections": self.connections,
+                "reuse": round(1 - self.connections / self.requests, 3) if self.requests else None,
+            }
+
+
+class HTTPPool:
+    """
+    Conexiones HTTP compartidas por host (keep-alive) para SendGrid y Google.
+
+    `hosts` es {host: {"size": n, "timeout": (conexión, lectura), "retries": n}};
+    cada host tiene su propio pool de urllib3 de hasta `size` conexiones,
+    reutilizadas por todos los hilos del worker. Las sesiones se crean por
+    proceso, así que es seguro con los workers de gunicorn.
+
+    Para dimensionar: http_connections_total / http_requests_total en
+    /metrics. Si la proporción de conexiones nuevas crece con la carga, el
+    pool de ese host es más chico que la cantidad de hilos que lo usan.
+    """
+
+    def __init__(self, hosts, default_timeout=(5, 30)):
+        self.hosts = hosts
+        self.default_timeout = default_timeout
+        self._pid = None
+        self._adapters = {}
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _verificar_fork(self):
+        # Los sockets no se comparten entre procesos: después de un fork se arma todo de nuevo
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._adapters = {
+                host: _PoolAdapter(
+                    host,
+                    size=conf.get("size", 4),
+                    timeout=conf.get("timeout", self.default_timeout),
+                    retries=conf.get("retries", 2),
+                )
+                for host, conf in self.hosts.items()
+            }
+            self._session = None
+
+    def mount(self, session):
+        """Monta los pools compartidos en una sesión (por ejemplo la AuthorizedSession de Google)"""
+        with self._lock:
+            self._verificar_fork()
+            for host, adapter in self._adapters.items():
+                session.mount(f"https://{host}/", adapter)
+        return session
+
+    def session(self):
+        """Sesión requests del proceso, con los pools montados"""
+        with self._lock:
+            self._verificar_fork()
+            if self._session is None:
+                self._session = requests.Session()
+                for host, adapter in self._adapters.items():
+                    self._session.mount(f"https://{host}/", adapter)
+            return self._session
+
+    def stats(self):
+        with self._lock:
+            self._verificar_fork()
+            return {host: adapter.stats() for host, adapter in self._adapters.items()}
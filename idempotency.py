@@ -0,0 +1,106 @@
+import json
+import logging
+import time
+
+from metrics import metrics
+from storage import SQLiteBase
+
+
+logger = logging.getLogger(__name__)
+
+# Resultados de IdempotencyIndex.begin()
+NUEVO = "new"
+DUPLICADO = "duplicate"
+EN_CURSO = "in_flight"
+
+
+class IdempotencyIndex(SQLiteBase):
+    """
+    Índice de entregas de webhook ya procesadas, compartido por los workers.
+
+    begin(clave) reserva la clave con un INSERT sobre la clave primaria: solo
+    una entrega la obtiene. Al terminar, finish() guarda la respuesta que se
+    devolvió, y los reintentos posteriores la reciben tal cual sin volver a
+    crear cupón, QR ni correo. Si el procesamiento falla, abort() libera la
+    clave para que el próximo reintento de Wix lo haga.
+
+    Las claves vencen a los `ttl` segundos; una clave "en curso" con más de
+    `processing_timeout` segundos (worker caído) la puede retomar otra entrega.
+    Cada duplicado suma en `hits`, así la tasa de duplicados sale de la tabla
+    y vale para todos los procesos.
+    """
+
+    def __init__(self, db_path, ttl=72 * 3600, processing_timeout=120, purge_interval=300):
+        super().__init__(db_path)
+        self.ttl = ttl
+        self.processing_timeout = processing_timeout
+        self.purge_interval = purge_interval
+        self._ultima_purga = 0.0
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_dedup (
+                clave TEXT PRIMARY KEY,
+                respuesta TEXT,
+                creado REAL NOT NULL,
+                expira REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS webhook_dedup_expira ON webhook_dedup (expira)")
+
+    def begin(self, clave):
+        """Devuelve (NUEVO, None), (DUPLICADO, respuesta guardada) o (EN_CURSO, None)"""
+        conn = self._conn()
+        ahora = time.time()
+        self._purgar(ahora)
+
+        cur = conn.execute(
+            "INSERT INTO webhook_dedup (clave, creado, expira) VALUES (?, ?, ?) "
+            "ON CONFLICT(clave) DO UPDATE SET creado = excluded.creado, expira = excluded.expira, hits = 0 "
+            "WHERE webhook_dedup.expira < ? OR (webhook_dedup.respuesta IS NULL AND webhook_dedup.creado < ?)",
+            (clave, ahora, ahora + self.ttl, ahora, ahora - self.processing_timeout),
+        )
+        if cur.rowcount == 1:
+            metrics.inc("webhook_dedup_total", result=NUEVO)
+            return NUEVO, None
+
+        conn.execute("UPDATE webhook_dedup SET hits = hits + 1 WHERE clave = ?", (clave,))
+        row = conn.execute("SELECT respuesta FROM webhook_dedup WHERE clave = ?", (clave,)).fetchone()
+        if row is None or row["respuesta"] is None:
+            metrics.inc("webhook_dedup_total", result=EN_CURSO)
+            return EN_CURSO, None
+        metrics.inc("webhook_dedup_total", result=DUPLICADO)
+        return DUPLICADO, json.loads(row["respuesta"])
+
+    def finish(self, clave, respuesta):
+        self._conn().execute(
+            "UPDATE webhook_dedup SET respuesta = ? WHERE clave = ?",
+            (json.dumps(respuesta, ensure_ascii=False), clave),
+        )
+
+    def abort(self, clave):
+        self._conn().execute("DELETE FROM webhook_dedup WHERE clave = ? AND respuesta IS NULL", (clave,))
+
+    def _purgar(self, ahora):
+        # Limpieza oportunista de claves vencidas, como mucho una vez por purge_interval
+        if ahora - self._ultima_purga < self.purge_interval:
+            return
+        self._ultima_purga = ahora
+        borradas = self._conn().execute("DELETE FROM webhook_dedup WHERE expira < ?", (ahora,)).rowcount
+        if borradas:
+            logger.info("Claves de idempotencia vencidas eliminadas: %d", borradas)
+
+    def stats(self):
+        """Claves vigentes, duplicados recibidos y tasa de duplicados (sobre la ventana del TTL)"""
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS claves, COALESCE(SUM(hits), 0) AS duplicados FROM webhook_dedup WHERE expira >= ?",
+            (time.time(),),
+        ).fetchone()
+        total = row["claves"] + row["duplicados"]
+        return {
+            "keys": row["claves"],
+            "duplicates": row["duplicados"],
+            "duplicate_rate": round(row["duplicados"] / total, 4) if total else 0.0,
+        }
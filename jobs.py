@@ -0,0 +1,276 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Estados de un trabajo
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Cola de trabajos persistente en SQLite con un pool de hilos.
+
+    Cada trabajo recorre una lista fija de etapas (por ejemplo qr -> email).
+    Si una etapa falla se reintenta sola con backoff exponencial, sin
+    repetir las etapas que ya terminaron. Al agotar los intentos el trabajo
+    queda en "failed" para revisarlo desde /jobs.
+
+    Los trabajos terminados guardan el payload del pedido (nombre y correo del
+    comprador), así que se borran pasados `retention` segundos; los "failed"
+    se conservan hasta que alguien los revise.
+
+    Varios workers de gunicorn pueden compartir el mismo archivo: la toma de
+    un trabajo es un UPDATE condicional, así que solo un proceso lo ejecuta.
+    """
+
+    def __init__(self, db_path, stages, workers=2, max_attempts=5, backoff_base=2.0,
+                 backoff_max=300.0, poll_interval=0.5, lease_seconds=300,
+                 retention=7 * 86400, purge_interval=3600):
+        self.db_path = db_path
+        self.stages = list(stages)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._ultima_purga = 0.0
+
+        self._handlers = {}
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._hilos = []
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT,
+                payload TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run REAL NOT NULL,
+                locked_until REAL,
+                last_error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, next_run)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_updated ON jobs (status, updated)")
+        conn.commit()
+
+    def _conn(self):
+        # Una conexión por hilo; sqlite3 no comparte conexiones entre hilos
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    # --- Registro y alta ---
+    def register(self, stage, handler):
+        """handler(payload) recibe el dict del trabajo y puede modificarlo"""
+        self._handlers[stage] = handler
+
+    def enqueue(self, payload, key=None):
+        ahora = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO jobs (key, payload, stage, status, next_run, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, json.dumps(payload, ensure_ascii=False), self.stages[0], QUEUED, ahora, ahora, ahora),
+        )
+        self._wakeup.set()
+        return cur.lastrowid
+
+    # --- Ejecución ---
+    def start(self):
+        if self._hilos:
+            return
+        for i in range(self.workers):
+            hilo = threading.Thread(target=self._loop, name=f"jobs-{i}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def _loop(self):
+        while True:
+            try:
+                if not self.run_once():
+                    self._purgar(time.time())
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+            except Exception as e:
+                logger.exception("Error en el worker de trabajos: %s", e)
+                time.sleep(self.poll_interval)
+
+    def _claim(self):
+        """Toma el siguiente trabajo listo. Los trabajos 'running' con lease vencido se recuperan."""
+        conn = self._conn()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND next_run <= ?) "
+                "OR (status = ? AND locked_until < ?) ORDER BY next_run LIMIT 1",
+                (QUEUED, ahora, RUNNING, ahora),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, locked_until = ?, updated = ? WHERE id = ?",
+                (RUNNING, ahora + self.lease_seconds, ahora, row["id"]),
+            )
+            conn.execute("COMMIT")
+            return row
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def run_once(self):
+        """Ejecuta las etapas pendientes de un trabajo. Devuelve False si no había nada."""
+        row = self._claim()
+        if row is None:
+            return False
+
+        payload = json.loads(row["payload"])
+        stage = row["stage"]
+        attempts = row["attempts"]
+        tiempos = {}
+
+        while True:
+            handler = self._handlers[stage]
+            inicio = time.perf_counter()
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.exception(
+                    "Trabajo %s falló en etapa '%s' (intento %d): %s", row["id"], stage, attempts + 1, e,
+                    extra={"job_id": row["id"], "key": row["key"], "stage": stage, "attempts": attempts + 1},
+                )
+                self.fail_stage(row["id"], payload, stage, attempts, e)
+                return True
+
+            tiempos[stage] = round((time.perf_counter() - inicio) * 1000, 2)
+
+            # Etapa terminada: se guarda el avance para no repetirla en un reintento
+            stage = self.complete_stage(row["id"], payload, stage)
+            if stage is None:
+                logger.info("Trabajo %s terminado", row["id"],
+                            extra={"job_id": row["id"], "key": row["key"], "stages": tiempos})
+                return True
+            attempts = 0
+
+    def complete_stage(self, job_id, payload, stage):
+        """Guarda el avance de un trabajo tras terminar `stage`. Devuelve la etapa siguiente o None si terminó."""
+        siguiente = self.stages.index(stage) + 1
+        if siguiente >= len(self.stages):
+            self._conn().execute(
+                "UPDATE jobs SET payload = ?, status = ?, locked_until = NULL, updated = ? WHERE id = ?",
+                (json.dumps(payload, ensure_ascii=False), DONE, time.time(), job_id),
+            )
+            return None
+        stage = self.stages[siguiente]
+        self._conn().execute(
+            "UPDATE jobs SET payload = ?, stage = ?, attempts = 0, updated = ? WHERE id = ?",
+            (json.dumps(payload, ensure_ascii=False), stage, time.time(), job_id),
+        )
+        return stage
+
+    def fail_stage(self, job_id, payload, stage, attempts, error):
+        """Registra un intento fallido: vuelve a la cola con backoff o queda en 'failed' al agotar intentos"""
+        attempts += 1
+        if attempts >= self.max_attempts:
+            status, next_run = FAILED, time.time()
+        else:
+            status = QUEUED
+            next_run = time.time() + min(self.backoff_max, self.backoff_base ** attempts)
+        self._conn().execute(
+            "UPDATE jobs SET payload = ?, stage = ?, status = ?, attempts = ?, next_run = ?, "
+            "locked_until = NULL, last_error = ?, updated = ? WHERE id = ?",
+            (json.dumps(payload, ensure_ascii=False), stage, status, attempts, next_run,
+             f"{stage}: {error}", time.time(), job_id),
+        )
+        return status
+
+    def claim_batch(self, stage, limit, include_failed=False):
+        """
+        Toma hasta `limit` trabajos que esperan en `stage`, aunque su backoff no
+        haya vencido (para procesarlos en bloque, por ejemplo correos
+        pendientes después de una caída). Devuelve [(id, key, payload, attempts)].
+        """
+        conn = self._conn()
+        ahora = time.time()
+        estados = (QUEUED, FAILED) if include_failed else (QUEUED,)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT id, key, payload, attempts FROM jobs WHERE stage = ? "
+                f"AND status IN ({', '.join('?' * len(estados))}) ORDER BY id LIMIT ?",
+                (stage, *estados, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, locked_until = ?, updated = ? WHERE id = ?",
+                [(RUNNING, ahora + self.lease_seconds, ahora, r["id"]) for r in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(r["id"], r["key"], json.loads(r["payload"]), r["attempts"]) for r in rows]
+
+    def _purgar(self, ahora):
+        # Limpieza oportunista de trabajos terminados, como mucho una vez por purge_interval
+        if ahora - self._ultima_purga < self.purge_interval:
+            return
+        self._ultima_purga = ahora
+        borrados = self.purge(ahora - self.retention)
+        if borrados:
+            logger.info("Trabajos terminados eliminados: %d", borrados)
+
+    def purge(self, antes_de):
+        """Borra los trabajos 'done' sin cambios desde `antes_de`. Devuelve cuántos borró."""
+        return self._conn().execute(
+            "DELETE FROM jobs WHERE status = ? AND updated < ?", (DONE, antes_de),
+        ).rowcount
+
+    # --- Inspección ---
+    def counts(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        resultado = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        resultado.update({r["status"]: r["n"] for r in rows})
+        return resultado
+
+    def list(self, status=None, limit=50):
+        sql = "SELECT id, key, stage, status, attempts, next_run, last_error, created, updated FROM jobs"
+        params = ()
+        if status:
+            sql += " WHERE status = ?"
+            params = (status,)
+        sql += " ORDER BY id DESC LIMIT ?"
+        rows = self._conn().execute(sql, params + (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def retry(self, job_id):
+        """Vuelve a encolar un trabajo fallido desde la etapa en que quedó"""
+        cur = self._conn().execute(
+            "UPDATE jobs SET status = ?, attempts = 0, next_run = ?, updated = ? WHERE id = ? AND status = ?",
+            (QUEUED, time.time(), time.time(), job_id, FAILED),
+        )
+        self._wakeup.set()
+        return cur.rowcount == 1
@@ -0,0 +1,119 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+
+# Atributos estándar de LogRecord; todo lo demás que llegue por `extra` va al JSON
+_ATRIBUTOS_RECORD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+logger = logging.getLogger("app.request")
+
+
+class JSONFormatter(logging.Formatter):
+    """Una línea JSON por registro, con los campos de `extra` al mismo nivel"""
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_RECORD and not clave.startswith("_"):
+                data[clave] = valor
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Todas las líneas emitidas dentro de un request llevan su id
+        if not hasattr(record, "request_id"):
+            rid = request_id()
+            if rid:
+                record.request_id = rid
+        # Solo se arma el mensaje; el JSON lo hace el hilo del listener
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(level=None):
+    """
+    Configura el logging de la app: nivel por LOG_LEVEL (INFO por defecto),
+    salida JSON a stdout y un QueueHandler para que los workers no se
+    bloqueen escribiendo; la escritura la hace un hilo aparte.
+    """
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(JSONFormatter())
+
+    cola = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    raiz = logging.getLogger()
+    raiz.handlers = [_QueueHandler(cola)]
+    raiz.setLevel(level)
+    return listener
+
+
+# --- Log por request ---
+def init_app(app):
+    """Registra un request id y escribe una línea JSON por request con los tiempos por etapa"""
+
+    @app.before_request
+    def _inicio_request():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:12]
+        g.inicio_request = time.perf_counter()
+        g.etapas = {}
+
+    @app.after_request
+    def _fin_request(response):
+        inicio = getattr(g, "inicio_request", None)
+        if inicio is None:
+            return response
+        response.headers["X-Request-ID"] = g.request_id
+        nivel = logging.WARNING if response.status_code >= 500 else logging.INFO
+        logger.log(
+            nivel, "%s %s %s", request.method, request.path, response.status_code,
+            extra={
+                "request_id": g.request_id,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "ms": round((time.perf_counter() - inicio) * 1000, 2),
+                "stages": g.etapas,
+            },
+        )
+        return response
+
+
+def request_id():
+    return getattr(g, "request_id", None) if has_request_context() else None
+
+
+def should_capture_payload():
+    """El payload completo solo se registra en DEBUG o en una muestra (LOG_PAYLOAD_SAMPLE_RATE)"""
+    if logger.isEnabledFor(logging.DEBUG):
+        return True
+    tasa = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0") or 0)
+    return tasa > 0 and random.random() < tasa
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = "botmanyoffers_"
+
+# Límites de los buckets de los histogramas, en segundos
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+AYUDA = {
+    "stage_seconds": "Duración de cada etapa del procesamiento (segundos)",
+    "external_seconds": "Duración de las llamadas a APIs externas (segundos)",
+    "external_calls_total": "Llamadas a APIs externas",
+    "external_errors_total": "Llamadas a APIs externas que fallaron",
+    "http_requests_total": "Requests HTTP salientes por host",
+    "http_connections_total": "Conexiones HTTP nuevas por host (el resto reutiliza keep-alive)",
+    "code_collisions_total": "Códigos de cupón generados que ya existían (se generó otro)",
+    "webhook_dedup_total": "Entregas del webhook según idempotencia (new, duplicate, in_flight)",
+    "offline_snapshots_total": "Snapshots servidos al validador sin conexión (full, delta)",
+    "offline_redemptions_total": "Canjes sincronizados desde el validador sin conexión por resultado",
+    "index_miss_refresh_skipped_total": "Códigos desconocidos que no releyeron la hoja (hubo un refresh hace poco)",
+}
+
+
+def _clave(nombre, labels):
+    return nombre, tuple(sorted(labels.items()))
+
+
+def _formatear_labels(labels, extra=None):
+    pares = list(labels) + ([extra] if extra else [])
+    if not pares:
+        return ""
+    texto = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pares)
+    return "{" + texto + "}"
+
+
+class Metrics:
+    """
+    Contadores e histogramas en memoria, con exportación en formato de texto
+    de Prometheus.
+
+    Cada worker de gunicorn acumula sus valores y los vuelca cada
+    `flush_interval` segundos a un archivo SQLite compartido (una fila por
+    proceso y métrica). /metrics suma las filas de todos los procesos, así
+    que el resultado no depende de qué worker atiende el scrape. Los valores
+    de procesos que ya terminaron se conservan: los contadores no retroceden.
+    """
+
+    def __init__(self):
+        self.db_path = None
+        self.flush_interval = 5
+        self._pid = os.getpid()
+        self.proceso = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._contadores = {}    # (nombre, labels) -> valor
+        self._histogramas = {}   # (nombre, labels) -> [conteo por bucket..., +Inf, suma]
+        self._local = threading.local()
+        self._hilo = None
+
+    def configure(self, db_path, flush_interval=5):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS metricas (
+                proceso TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                clave TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                PRIMARY KEY (proceso, tipo, clave)
+            )
+        """)
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._loop, name="metrics-flush", daemon=True)
+            self._hilo.start()
+
+    def _verificar_fork(self):
+        # Si el proceso se bifurcó (gunicorn --preload) el hijo empieza de cero con su propio id
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self.proceso = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+            self._contadores, self._histogramas = {}, {}
+            self._local = threading.local()
+            self._hilo = None
+            if self.db_path is not None:
+                self.configure(self.db_path, self.flush_interval)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    # --- Registro ---
+    def inc(self, nombre, valor=1, **labels):
+        clave = _clave(nombre, labels)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observe(self, nombre, segundos, **labels):
+        clave = _clave(nombre, labels)
+        with self._lock:
+            hist = self._histogramas.get(clave)
+            if hist is None:
+                hist = self._histogramas[clave] = [0] * (len(BUCKETS) + 2)
+            for i, limite in enumerate(BUCKETS):
+                if segundos <= limite:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(BUCKETS)] += 1
+            hist[-1] += segundos
+
+    @contextmanager
+    def external(self, servicio, operacion):
+        """Cuenta y mide una llamada a una API externa (Sheets, SendGrid...)"""
+        self.inc("external_calls_total", service=servicio, op=operacion)
+        inicio = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("external_errors_total", service=servicio, op=operacion)
+            raise
+        finally:
+            self.observe("external_seconds", time.perf_counter() - inicio, service=servicio, op=operacion)
+
+    # --- Agregación entre procesos ---
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("No se pudieron guardar las métricas: %s", e)
+
+    def flush(self):
+        if self.db_path is None:
+            return
+        self._verificar_fork()
+        with self._lock:
+            filas = [("counter", json.dumps(k), json.dumps(v)) for k, v in self._contadores.items()]
+            filas += [("histogram", json.dumps(k), json.dumps(v)) for k, v in self._histogramas.items()]
+        if filas:
+            self._conn().executemany(
+                "INSERT OR REPLACE INTO metricas (proceso, tipo, clave, valor) VALUES (?, ?, ?, ?)",
+                [(self.proceso,) + f for f in filas],
+            )
+
+    def _agregado(self):
+        if self.db_path is None:
+            with self._lock:
+                return dict(self._contadores), {k: list(v) for k, v in self._histogramas.items()}
+        self.flush()
+        contadores, histogramas = {}, {}
+        for tipo, clave, valor in self._conn().execute("SELECT tipo, clave, valor FROM metricas"):
+            nombre, labels = json.loads(clave)
+            clave = (nombre, tuple(tuple(par) for par in labels))
+            valor = json.loads(valor)
+            if tipo == "counter":
+                contadores[clave] = contadores.get(clave, 0) + valor
+            else:
+                acumulado = histogramas.setdefault(clave, [0] * len(valor))
+                for i, v in enumerate(valor):
+                    acumulado[i] += v
+        return contadores, histogramas
+
+    def render(self, gauges=None):
+        """
+        Texto para /metrics. `gauges` es opcional: {nombre: (ayuda, [(labels_dict, valor), ...])}
+        con valores que se leen al momento (por ejemplo, el estado de la cola).
+        """
+        contadores, histogramas = self._agregado()
+        lineas = []
+
+        def encabezado(nombre, tipo):
+            lineas.append(f"# HELP {PREFIJO}{nombre} {AYUDA.get(nombre, nombre)}")
+            lineas.append(f"# TYPE {PREFIJO}{nombre} {tipo}")
+
+        for nombre in sorted({n for n, _ in contadores}):
+            encabezado(nombre, "counter")
+            for (n, labels), valor in sorted(contadores.items()):
+                if n == nombre:
+                    lineas.append(f"{PREFIJO}{nombre}{_formatear_labels(labels)} {valor}")
+
+        for nombre in sorted({n for n, _ in histogramas}):
+            encabezado(nombre, "histogram")
+            for (n, labels), hist in sorted(histogramas.items()):
+                if n != nombre:
+                    continue
+                acumulado = 0
+                for limite, conteo in zip(BUCKETS, hist):
+                    acumulado += conteo
+                    lineas.append(f"{PREFIJO}{nombre}_bucket{_formatear_labels(labels, ('le', limite))} {acumulado}")
+                total = acumulado + hist[len(BUCKETS)]
+                lineas.append(f"{PREFIJO}{nombre}_bucket{_formatear_labels(labels, ('le', '+Inf'))} {total}")
+                lineas.append(f"{PREFIJO}{nombre}_sum{_formatear_labels(labels)} {hist[-1]:.6f}")
+                lineas.append(f"{PREFIJO}{nombre}_count{_formatear_labels(labels)} {total}")
+
+        for nombre, (ayuda, valores) in sorted((gauges or {}).items()):
+            lineas.append(f"# HELP {PREFIJO}{nombre} {ayuda}")
+            lineas.append(f"# TYPE {PREFIJO}{nombre} gauge")
+            for labels, valor in valores:
+                lineas.append(f"{PREFIJO}{nombre}{_formatear_labels(sorted(labels.items()))} {valor}")
+
+        return "\n".join(lineas) + "\n"
+
+
+# Registro compartido por todos los módulos del proceso
+metrics = Metrics()
+
+
+@contextmanager
+def etapa(nombre):
+    """
+    Mide una etapa: la registra en el histograma stage_seconds y, si hay un
+    request en curso, en los tiempos por etapa de su línea de log.
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        metrics.observe("stage_seconds", segundos, stage=nombre)
+        if has_request_context() and hasattr(g, "etapas"):
+            g.etapas[nombre] = round(segundos * 1000, 2)
@@ -0,0 +1,190 @@
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Igual a qrcode.constants.ERROR_CORRECT_M; qrcode se importa recién al generar el primer QR
+ERROR_CORRECT_M = 0
+
+
+class QRRenderer:
+    """
+    Generador de QR sin pasar por PIL.
+
+    Todas las URL de cupones comparten prefijo y largo, así que la versión
+    alcanza con calcularla una vez por largo de datos. La máscara también
+    queda fija por largo: es la mejor para el primer dato de ese largo, no
+    para cada uno (qrcode.make prueba las 8 máscaras en cada imagen). Los QR
+    son válidos y se leen igual, pero no son idénticos píxel a píxel a los de
+    qrcode.make: coinciden solo cuando la mejor máscara es la misma. La matriz
+    de módulos se escribe directo a un PNG de 1 bit o a un SVG, del mismo
+    tamaño que daba qrcode.make (box_size 10, borde 4).
+    """
+
+    def __init__(self, box_size=10, border=4, error_correction=ERROR_CORRECT_M):
+        self.box_size = box_size
+        self.border = border
+        self.error_correction = error_correction
+        self._config = {}   # largo de los datos -> (version, mask_pattern)
+        self._lock = threading.Lock()
+
+    def _configuracion(self, data):
+        clave = len(data.encode("utf-8"))
+        config = self._config.get(clave)
+        if config is None:
+            import qrcode
+            qr = qrcode.QRCode(error_correction=self.error_correction, border=0)
+            qr.add_data(data)
+            qr.make(fit=True)
+            config = (qr.version, qr.mask_pattern if qr.mask_pattern is not None else qr.best_mask_pattern())
+            with self._lock:
+                self._config[clave] = config
+        return config
+
+    def matrix(self, data):
+        """Matriz de módulos (True = oscuro) incluyendo el borde"""
+        import qrcode
+        version, mask = self._configuracion(data)
+        qr = qrcode.QRCode(
+            version=version, error_correction=self.error_correction,
+            border=self.border, mask_pattern=mask,
+        )
+        qr.add_data(data)
+        qr.make(fit=False)
+        return qr.get_matrix()
+
+    def png(self, data):
+        matriz = self.matrix(data)
+        box = self.box_size
+        ancho = len(matriz) * box
+
+        # PNG en escala de grises de 1 bit: 0 = negro, 1 = blanco.
+        # Cada fila de módulos se arma una vez y se repite box_size veces.
+        relleno = (-ancho) % 8
+        filas = []
+        for fila in matriz:
+            bits = "".join("0" * box if modulo else "1" * box for modulo in fila) + "0" * relleno
+            linea = b"\x00" + int(bits, 2).to_bytes(len(bits) // 8, "big")
+            filas.append(linea * box)
+        datos = zlib.compress(b"".join(filas), 6)
+
+        def chunk(tipo, contenido):
+            return (struct.pack(">I", len(contenido)) + tipo + contenido
+                    + struct.pack(">I", zlib.crc32(tipo + contenido) & 0xFFFFFFFF))
+
+        return (b"\x89PNG\r\n\x1a\n"
+                + chunk(b"IHDR", struct.pack(">IIBBBBB", ancho, ancho, 1, 0, 0, 0, 0))
+                + chunk(b"IDAT", datos)
+                + chunk(b"IEND", b""))
+
+    def svg(self, data):
+        matriz = self.matrix(data)
+        n = len(matriz)
+        # Un segmento horizontal por cada tramo de módulos oscuros seguidos
+        trazos = []
+        for y, fila in enumerate(matriz):
+            x = 0
+            while x < n:
+                if fila[x]:
+                    inicio = x
+                    while x < n and fila[x]:
+                        x += 1
+                    trazos.append(f"M{inicio} {y}h{x - inicio}v1h-{x - inicio}z")
+                else:
+                    x += 1
+        lado = n * self.box_size
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{lado}" height="{lado}" '
+            f'viewBox="0 0 {n} {n}" shape-rendering="crispEdges">'
+            f'<rect width="{n}" height="{n}" fill="#fff"/>'
+            f'<path fill="#000" d="{"".join(trazos)}"/></svg>'
+        ).encode("utf-8")
+
+
+# Instancia compartida del módulo (también la usan los procesos del modo masivo)
+renderer = QRRenderer()
+
+
+def render_png(data):
+    return renderer.png(data)
+
+
+def render_svg(data):
+    return renderer.svg(data)
+
+
+def render_many(datos, formato="png", processes=None, chunksize=64):
+    """
+    Genera muchos QR en paralelo (precarga de campañas). Devuelve los bytes
+    en el mismo orden que `datos`.
+    """
+    funcion = render_svg if formato == "svg" else render_png
+    datos = list(datos)
+    if processes == 1 or len(datos) < chunksize:
+        return [funcion(d) for d in datos]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(funcion, datos, chunksize=chunksize))
+
+
+class RenderPool:
+    """
+    Genera los PNG en procesos aparte para no retener el GIL: en un worker
+    de gunicorn con muchos hilos, cada render (~2 ms de CPU) frena a todos
+    los demás requests del proceso. El pool se crea al primer uso en cada
+    proceso (después del fork de gunicorn), con "forkserver" para no heredar
+    los locks de los hilos de la app. Con processes=0 se genera en el hilo.
+
+    Si un render tarda más de `timeout` (por ejemplo, el primer arranque del
+    servidor de procesos), ese QR se genera en el hilo y el pool sigue. Si
+    el pool se rompe (murió un proceso), se cierra y el worker sigue
+    generando en el hilo.
+    """
+
+    def __init__(self, processes=0, timeout=30):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    contexto = multiprocessing.get_context("forkserver")
+                    # Los procesos nuevos reimportan el __main__: tiene que estar protegido
+                    # con `if __name__ == "__main__"` (gunicorn lo está)
+                    contexto.set_forkserver_preload([__name__])
+                    self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=contexto)
+                    self._pid = pid
+        return self._pool
+
+    def png(self, data):
+        if not self.processes:
+            return render_png(data)
+        pool = self._executor()
+        try:
+            futuro = pool.submit(render_png, data)
+            return futuro.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # En 3.9 no es el TimeoutError de Python (en 3.11 sí, y es un OSError): va primero
+            futuro.cancel()
+            logger.warning("Render QR en el pool tardó más de %ss, se genera en el hilo", self.timeout)
+            return render_png(data)
+        except BrokenProcessPool as e:
+            logger.warning("Pool de render QR roto, se genera en el hilo: %s", e)
+            self.processes = 0
+            pool.shutdown(wait=False)
+            return render_png(data)
+        except RuntimeError:
+            # Otro hilo cerró el pool roto entre _executor() y submit()
+            if self.processes:
+                raise
+            return render_png(data)
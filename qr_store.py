@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import etapa
+from qr_render import render_many
+from storage import SQLiteBase
+
+
+logger = logging.getLogger(__name__)
+
+
+# Cambiar la versión si cambia el formato de la imagen (invalida los ETag viejos)
+QR_RENDER_VERSION = "v1"
+
+
+class QRStore(SQLiteBase):
+    """
+    Almacén de imágenes QR direccionado por contenido.
+
+    La imagen depende solo de la URL de validación, así que el ETag se
+    calcula sin tocar los bytes y un If-None-Match se puede responder con 304
+    sin leer nada. Los PNG viven en una caché LRU en memoria con tope de
+    bytes, respaldada por una tabla de blobs en SQLite que comparten todos los
+    workers; si no están en ninguna de las dos se regeneran con `render`.
+    """
+
+    def __init__(self, db_path, render, url_for, max_bytes=8 * 1024 * 1024):
+        super().__init__(db_path)
+        self.render = render        # render(url) -> bytes PNG (ver qr_render.render_png)
+        self.url_for = url_for      # url_for(codigo) -> URL codificada en el QR
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # codigo -> (etag, png)
+        self._bytes = 0
+        self.stats = {"memory_hits": 0, "blob_hits": 0, "renders": 0, "evictions": 0}
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS qr_blobs (
+                etag TEXT PRIMARY KEY,
+                png BLOB NOT NULL,
+                creado REAL NOT NULL
+            )
+        """)
+
+    def etag(self, codigo):
+        contenido = f"{QR_RENDER_VERSION}|{self.url_for(codigo)}"
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()[:32]
+
+    # --- Caché en memoria ---
+    def _cache_get(self, codigo):
+        with self._lock:
+            entrada = self._cache.get(codigo)
+            if entrada is not None:
+                self._cache.move_to_end(codigo)
+            return entrada
+
+    def _cache_put(self, codigo, etag, png):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._cache.pop(codigo, None)
+            if anterior is not None:
+                self._bytes -= len(anterior[1])
+            self._cache[codigo] = (etag, png)
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes:
+                _, (_, viejo) = self._cache.popitem(last=False)
+                self._bytes -= len(viejo)
+                self.stats["evictions"] += 1
+
+    # --- API ---
+    def get(self, codigo):
+        """Devuelve (etag, png). Genera y guarda la imagen si no existía."""
+        entrada = self._cache_get(codigo)
+        if entrada is not None:
+            self.stats["memory_hits"] += 1
+            return entrada
+
+        etag = self.etag(codigo)
+        row = self._conn().execute("SELECT png FROM qr_blobs WHERE etag = ?", (etag,)).fetchone()
+        if row is not None:
+            self.stats["blob_hits"] += 1
+            png = bytes(row["png"])
+        else:
+            png = self.put(codigo, etag=etag)
+            return etag, png
+
+        self._cache_put(codigo, etag, png)
+        return etag, png
+
+    def put(self, codigo, etag=None):
+        """Genera la imagen del código y la guarda en el blob store y en memoria"""
+        etag = etag or self.etag(codigo)
+        with etapa("qr_render"):
+            png = self.render(self.url_for(codigo))
+        self.stats["renders"] += 1
+        try:
+            self._conn().execute(
+                "INSERT OR IGNORE INTO qr_blobs (etag, png, creado) VALUES (?, ?, ?)",
+                (etag, sqlite3.Binary(png), time.time()),
+            )
+        except sqlite3.Error as e:
+            # Sin blob store igual se puede servir desde memoria
+            logger.warning("No se pudo guardar el QR en el blob store: %s", e)
+        self._cache_put(codigo, etag, png)
+        return png
+
+    def preload(self, codigos, processes=None):
+        """
+        Pre-genera los QR de muchos códigos (campañas) en un pool de procesos
+        y los guarda en el blob store en una sola transacción. No llena la
+        caché en memoria: se calienta sola con los pedidos reales.
+        """
+        codigos = list(codigos)
+        etags = [self.etag(c) for c in codigos]
+        conn = self._conn()
+        existentes = set()
+        for i in range(0, len(etags), 500):
+            lote = etags[i:i + 500]
+            marcas = ",".join("?" * len(lote))
+            existentes.update(
+                r["etag"] for r in conn.execute(f"SELECT etag FROM qr_blobs WHERE etag IN ({marcas})", lote)
+            )
+
+        pendientes = [(c, e) for c, e in zip(codigos, etags) if e not in existentes]
+        imagenes = render_many([self.url_for(c) for c, _ in pendientes], processes=processes)
+        self.stats["renders"] += len(imagenes)
+
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO qr_blobs (etag, png, creado) VALUES (?, ?, ?)",
+                [(e, sqlite3.Binary(png), ahora) for (_, e), png in zip(pendientes, imagenes)],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(pendientes)
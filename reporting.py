@@ -0,0 +1,92 @@
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+
+# Columnas de la exportación, en orden
+COLUMNAS = ("codigo", "nombre", "correo", "productos", "total", "fecha", "canjeado", "canjeado_en", "creado")
+
+# Filas por bloque entregado al servidor: un bloque por fila serían demasiadas escrituras chicas
+FILAS_POR_BLOQUE = 500
+
+AGRUPACIONES = ("day", "product", "day_product")
+
+
+def _hora(epoch):
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _valores(cupon, columnas):
+    valores = dict(cupon, canjeado_en=_hora(cupon.get("canjeado_en")), creado=_hora(cupon.get("creado")))
+    return [valores.get(c) for c in columnas]
+
+
+def csv_stream(cupones, columnas=COLUMNAS):
+    """Genera el CSV de a FILAS_POR_BLOQUE filas; `cupones` puede ser un generador"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    for i, cupon in enumerate(cupones, 1):
+        valores = _valores(cupon, columnas)
+        if "canjeado" in columnas:
+            # Igual que en la hoja
+            posicion = columnas.index("canjeado")
+            valores[posicion] = "SI" if valores[posicion] else "NO"
+        escritor.writerow(valores)
+        if i % FILAS_POR_BLOQUE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_stream(cupones, columnas=COLUMNAS):
+    """Un objeto JSON por línea, de a FILAS_POR_BLOQUE líneas"""
+    bloque = []
+    for cupon in cupones:
+        bloque.append(json.dumps(dict(zip(columnas, _valores(cupon, columnas))), ensure_ascii=False))
+        if len(bloque) == FILAS_POR_BLOQUE:
+            yield "\n".join(bloque) + "\n"
+            bloque = []
+    if bloque:
+        yield "\n".join(bloque) + "\n"
+
+
+def _indicadores(pedidos, ingresos, canjes, canjes_medidos, segundos_canje):
+    return {
+        "orders": pedidos,
+        "revenue": round(ingresos, 2),
+        "redemptions": canjes,
+        "redemption_rate": round(canjes / pedidos, 4) if pedidos else 0.0,
+        "avg_time_to_redeem_s": round(segundos_canje / canjes_medidos, 1) if canjes_medidos else None,
+    }
+
+
+def resumir(filas, agrupar="day_product"):
+    """
+    Arma el reporte a partir de las filas de resumen_diario (ya sumadas al
+    escribir): totales y un grupo por día, por producto o por ambos.
+    """
+    if agrupar not in AGRUPACIONES:
+        raise ValueError(f"group debe ser uno de {', '.join(AGRUPACIONES)}")
+    campos = ("pedidos", "ingresos", "canjes", "canjes_medidos", "segundos_canje")
+    grupos = {}
+    totales = dict.fromkeys(campos, 0)
+    for fila in filas:
+        clave = {"day": (fila["dia"],), "product": (fila["producto"],)}.get(agrupar, (fila["dia"], fila["producto"]))
+        suma = grupos.setdefault(clave, dict.fromkeys(campos, 0))
+        for campo in campos:
+            suma[campo] += fila[campo]
+            totales[campo] += fila[campo]
+
+    nombres = {"day": ("day",), "product": ("product",)}.get(agrupar, ("day", "product"))
+    return {
+        "totals": _indicadores(*(totales[c] for c in campos)),
+        "groups": [
+            dict(zip(nombres, clave), **_indicadores(*(suma[c] for c in campos)))
+            for clave, suma in sorted(grupos.items())
+        ],
+    }
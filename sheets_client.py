@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+
+def abrir_hoja(spreadsheet_id, pool=None):
+    """
+    Autentica con la cuenta de servicio y abre la primera hoja (llamadas de red).
+    Con `pool` (HTTPPool) las llamadas a Google y la renovación del token usan
+    sus conexiones persistentes.
+    """
+    # gspread y google-auth se importan recién acá: tardan en cargar y no hacen falta para arrancar
+    import gspread
+    from google.auth.transport.requests import AuthorizedSession, Request
+    from google.oauth2.service_account import Credentials
+
+    # Cargar credenciales desde la variable de entorno en Render
+    json_creds = os.environ.get("GOOGLE_CREDENTIALS")
+    if not json_creds:
+        raise RuntimeError("GOOGLE_CREDENTIALS no está configurado")
+    creds = Credentials.from_service_account_info(json.loads(json_creds), scopes=SCOPE)
+
+    if pool is not None:
+        sesion = pool.mount(AuthorizedSession(creds, auth_request=Request(pool.session())))
+    else:
+        sesion = AuthorizedSession(creds)
+    client = gspread.authorize(None, session=sesion)
+    with metrics.external("sheets", "open_by_key"):
+        return client.open_by_key(spreadsheet_id).sheet1
+
+
+class LazyWorksheet:
+    """
+    Hoja de Google Sheets que se conecta la primera vez que se usa.
+
+    Se comporta como el worksheet de gspread (delega los atributos), así que
+    SheetsWriter, CouponIndex y SheetsMirror la usan igual. Importar la app
+    ya no espera a Google ni falla si Google no responde: warm_up() intenta
+    conectar en segundo plano con backoff y `ready` indica si ya se pudo.
+    """
+
+    def __init__(self, factory, max_backoff=60):
+        self._factory = factory
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._hoja = None
+        self._hilo = None
+        self.last_error = None
+
+    @property
+    def ready(self):
+        return self._hoja is not None
+
+    def connect(self):
+        hoja = self._hoja
+        if hoja is not None:
+            return hoja
+        with self._lock:
+            if self._hoja is None:
+                try:
+                    self._hoja = self._factory()
+                    self.last_error = None
+                    logger.info("Conectado a Google Sheets")
+                except Exception as e:
+                    self.last_error = str(e)
+                    raise
+            return self._hoja
+
+    def __getattr__(self, nombre):
+        # Solo se llama para atributos que no son del proxy (get, append_rows, batch_update...)
+        return getattr(self.connect(), nombre)
+
+    def warm_up(self):
+        """Conecta en segundo plano, reintentando hasta lograrlo"""
+        if self._hilo is not None:
+            return
+
+        def conectar():
+            espera = 1
+            while self._hoja is None:
+                try:
+                    self.connect()
+                except Exception as e:
+                    logger.warning("Google Sheets no disponible, reintento en %ds: %s", espera, e)
+                    time.sleep(espera)
+                    espera = min(self._max_backoff, espera * 2)
+
+        self._hilo = threading.Thread(target=conectar, name="sheets-connect", daemon=True)
+        self._hilo.start()
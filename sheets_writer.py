@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from coupon_index import fila_desde_rango, rowcol_to_a1
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def es_error_de_cuota(error):
+    """True si Google respondió 429 (cuota de escrituras por minuto agotada)"""
+    respuesta = getattr(error, "response", None)
+    return getattr(respuesta, "status_code", None) == 429
+
+
+class SheetsWriter:
+    """
+    Buffer de escritura diferida para Google Sheets.
+
+    Junta los append_row y update_cell pendientes y los envía cada
+    `flush_interval_ms` (o en cuanto haya `max_batch` operaciones) como un
+    único append_rows y un único batch_update. Así el número de llamadas de
+    escritura a la API se mantiene constante aunque suba la tasa de pedidos.
+
+    Cada operación devuelve un Future que se resuelve cuando la escritura
+    quedó confirmada por Google: append() con el número de fila asignado y
+    update_cell() con None. Ante un 429 las operaciones vuelven a la cola y el
+    intervalo entre envíos se duplica hasta `max_backoff`; con cada envío
+    exitoso vuelve a bajar.
+    """
+
+    def __init__(self, sheet, flush_interval_ms=500, max_batch=200, max_backoff=60.0):
+        self.sheet = sheet
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._appends = []   # [(valores, future)]
+        self._updates = []   # [(fila, columna, valor, future)]
+        self._hay_datos = threading.Event()
+        self._lleno = threading.Event()
+        self._backoff = 0.0
+        self._hilo = None
+
+        self.stats = {"appends": 0, "updates": 0, "flushes": 0, "api_calls": 0, "throttled": 0}
+
+    # --- API para quien escribe ---
+    def append(self, valores):
+        future = Future()
+        with self._lock:
+            self._appends.append((list(valores), future))
+            if len(self._appends) + len(self._updates) >= self.max_batch:
+                self._lleno.set()
+        self._hay_datos.set()
+        return future
+
+    def update_cell(self, fila, columna, valor):
+        future = Future()
+        with self._lock:
+            self._updates.append((fila, columna, valor, future))
+            if len(self._appends) + len(self._updates) >= self.max_batch:
+                self._lleno.set()
+        self._hay_datos.set()
+        return future
+
+    def pending(self):
+        with self._lock:
+            return len(self._appends) + len(self._updates)
+
+    # --- Envío ---
+    def start(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._loop, name="sheets-writer", daemon=True)
+            self._hilo.start()
+
+    def _loop(self):
+        while True:
+            self._hay_datos.wait()
+            if self._backoff:
+                # Tras un 429 la espera se cumple entera aunque el lote ya esté lleno
+                time.sleep(self._backoff)
+            # Esperar el intervalo (o hasta llenar el lote) para juntar más operaciones
+            self._lleno.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            appends = self._appends[:self.max_batch]
+            self._appends = self._appends[self.max_batch:]
+            restantes = self.max_batch - len(appends)
+            updates = self._updates[:restantes]
+            self._updates = self._updates[restantes:]
+            if not self._appends and not self._updates:
+                self._hay_datos.clear()
+            self._lleno.clear()
+
+        if not appends and not updates:
+            return
+
+        self.stats["flushes"] += 1
+        throttled = False
+        if appends:
+            throttled |= self._flush_appends(appends)
+        if updates:
+            throttled |= self._flush_updates(updates)
+
+        if throttled:
+            self.stats["throttled"] += 1
+            self._backoff = min(self.max_backoff, max(1.0, self._backoff * 2))
+            logger.warning("Cuota de Sheets agotada (429), próximo envío en %.1fs", self._backoff)
+        else:
+            self._backoff = self._backoff / 2 if self._backoff > 0.5 else 0.0
+
+    def _reencolar(self, appends=(), updates=()):
+        with self._lock:
+            self._appends[:0] = appends
+            self._updates[:0] = updates
+        self._hay_datos.set()
+
+    def _flush_appends(self, appends):
+        try:
+            self.stats["api_calls"] += 1
+            with metrics.external("sheets", "append_rows"):
+                respuesta = self.sheet.append_rows([valores for valores, _ in appends])
+        except Exception as e:
+            if es_error_de_cuota(e):
+                self._reencolar(appends=appends)
+                return True
+            for _, future in appends:
+                future.set_exception(e)
+            return False
+
+        primera = fila_desde_rango((respuesta or {}).get("updates", {}).get("updatedRange"))
+        for i, (_, future) in enumerate(appends):
+            future.set_result(primera + i if primera else None)
+        self.stats["appends"] += len(appends)
+        return False
+
+    def _flush_updates(self, updates):
+        data = [
+            {"range": rowcol_to_a1(fila, columna), "values": [[valor]]}
+            for fila, columna, valor, _ in updates
+        ]
+        try:
+            self.stats["api_calls"] += 1
+            with metrics.external("sheets", "batch_update"):
+                self.sheet.batch_update(data)
+        except Exception as e:
+            if es_error_de_cuota(e):
+                self._reencolar(updates=updates)
+                return True
+            for *_, future in updates:
+                future.set_exception(e)
+            return False
+
+        for *_, future in updates:
+            future.set_result(None)
+        self.stats["updates"] += len(updates)
+        return False
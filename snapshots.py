@@ -0,0 +1,175 @@
+import hashlib
+import hmac
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Hex de SHA-256 que se publica por código (48 bits): el validador calcula el mismo.
+# No protege los códigos: son de ~50 bits, y una sola pasada de fuerza bruta los saca todos
+LARGO_HASH = 12
+
+# Canjes por request de sincronización
+MAX_CANJES_SYNC = 500
+
+# Campos de la cabecera que cubre la firma
+CAMPOS_FIRMADOS = ("version", "since", "producto", "full", "issued", "digest", "hash_len")
+
+
+def hash_codigo(codigo):
+    return hashlib.sha256(codigo.encode("utf-8")).hexdigest()[:LARGO_HASH]
+
+
+class RedemptionSnapshots:
+    """
+    Snapshots de cupones sin canjear para el validador sin conexión.
+
+    build(since, producto) devuelve el snapshot completo (since=0) o solo
+    los hashes a agregar y a quitar desde la versión `since`. La versión es
+    el último seq del registro `cambios` de SQLiteStorage; si `since` ya se
+    purgó del registro se manda el completo. Se publican hashes truncados
+    para que la copia sea chica, pero no ocultan los códigos: el espacio de
+    códigos es chico (~2^50) y los hashes no tienen sal, así que el snapshot
+    vale lo mismo que la lista de cupones sin canjear. Solo se entrega a
+    validadores con token (VALIDATOR_TOKEN en app.py).
+
+    La cabecera va firmada con HMAC-SHA256. El validador la devuelve al
+    sincronizar; si la firma verifica, la hora de cada escaneo se acota
+    entre la emisión del snapshot y la recepción, y se usa para resolver
+    los canjes dobles (gana el primero). Sin firma válida se toma la hora
+    de recepción.
+    """
+
+    def __init__(self, storage, secret, log_days=7, cache_size=8, purge_interval=3600):
+        self.storage = storage
+        self._secret = secret.encode("utf-8") if isinstance(secret, str) else secret
+        self.log_days = log_days
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+        self._cache = OrderedDict()     # (versión, producto) -> snapshot completo
+        self._lock = threading.Lock()
+        self._ultima_purga = 0.0
+
+    # --- Firma ---
+    def _firma(self, cabecera):
+        mensaje = json.dumps({k: cabecera[k] for k in CAMPOS_FIRMADOS}, sort_keys=True, separators=(",", ":"))
+        return hmac.new(self._secret, mensaje.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def verify(self, cabecera):
+        try:
+            esperada = self._firma(cabecera)
+        except (KeyError, TypeError):
+            return False
+        return hmac.compare_digest(esperada, str(cabecera.get("sig", "")))
+
+    def _firmado(self, version, since, producto, agregar, quitar):
+        snapshot = {
+            "version": version,
+            "since": since,
+            "producto": producto,
+            "full": since == 0,
+            "issued": int(time.time()),
+            "digest": hashlib.sha256(json.dumps([agregar, quitar], separators=(",", ":")).encode()).hexdigest(),
+            "hash_len": LARGO_HASH,
+        }
+        snapshot["sig"] = self._firma(snapshot)
+        snapshot["add"] = agregar
+        snapshot["remove"] = quitar
+        return snapshot
+
+    # --- Snapshots ---
+    def build(self, since=0, producto=None):
+        producto = (producto or "").strip()
+        snapshot = self._delta(since, producto) if since else None
+        if snapshot is None:
+            snapshot = self._completo(producto)
+        self._purgar()
+        metrics.inc("offline_snapshots_total", kind="full" if snapshot["full"] else "delta")
+        return snapshot
+
+    def _delta(self, since, producto):
+        cambios = self.storage.changes_since(since, producto or None)
+        if cambios is None:
+            return None
+        version, filas = cambios
+        # Se aplican en orden: un cupón emitido y canjeado dentro del delta solo queda en "remove"
+        agregar, quitar = set(), set()
+        for codigo, tipo in filas:
+            h = hash_codigo(codigo)
+            if tipo == "alta":
+                agregar.add(h)
+                quitar.discard(h)
+            else:
+                quitar.add(h)
+                agregar.discard(h)
+        return self._firmado(version, since, producto, sorted(agregar), sorted(quitar))
+
+    def _completo(self, producto):
+        clave = (self.storage.change_version(), producto)
+        with self._lock:
+            if clave in self._cache:
+                self._cache.move_to_end(clave)
+                return self._cache[clave]
+        version, codigos = self.storage.unredeemed_codes(producto or None)
+        snapshot = self._firmado(version, 0, producto, sorted(hash_codigo(c) for c in codigos), [])
+        with self._lock:
+            self._cache[(version, producto)] = snapshot
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return snapshot
+
+    def _purgar(self):
+        ahora = time.time()
+        if ahora - self._ultima_purga < self.purge_interval:
+            return
+        self._ultima_purga = ahora
+        borrados = self.storage.prune_changes(ahora - self.log_days * 86400)
+        if borrados:
+            logger.info("Cambios antiguos del registro de snapshots eliminados: %d", borrados)
+
+    # --- Sincronización ---
+    def sync(self, dispositivo, canjes, snapshot=None):
+        """
+        Aplica los canjes hechos sin conexión ([{"id", "codigo", "at"}]) y
+        devuelve el resultado de cada uno, en el mismo orden.
+        """
+        if len(canjes) > MAX_CANJES_SYNC:
+            raise ValueError(f"Como máximo {MAX_CANJES_SYNC} canjes por sincronización")
+        ahora = time.time()
+        emitido = snapshot["issued"] if snapshot and self.verify(snapshot) else None
+        if snapshot and emitido is None:
+            logger.warning("Sincronización de '%s' con un snapshot sin firma válida", dispositivo)
+
+        # Se valida todo el lote antes de aplicar nada
+        pendientes = []
+        for canje in canjes:
+            id_canje = str(canje.get("id") or "").strip()[:64]
+            codigo = str(canje.get("codigo") or "").strip()
+            if not id_canje or not codigo:
+                raise ValueError("Cada canje necesita id y codigo")
+            if emitido is None:
+                escaneado = ahora
+            else:
+                try:
+                    escaneado = float(canje.get("at") or ahora)
+                except (TypeError, ValueError):
+                    escaneado = math.nan
+                # "NaN" o "inf" pasan por float() pero no se pueden guardar como hora de canje
+                if not math.isfinite(escaneado):
+                    raise ValueError(f"Hora de canje inválida en {id_canje}")
+                escaneado = min(max(escaneado, emitido), ahora)
+            pendientes.append((id_canje, codigo, escaneado))
+
+        resultados = []
+        for id_canje, codigo, escaneado in pendientes:
+            resultado = self.storage.redeem_offline(id_canje, codigo, dispositivo, escaneado)
+            metrics.inc("offline_redemptions_total", result=resultado["status"])
+            resultados.append({"id": id_canje, "codigo": codigo, **resultado})
+        return resultados
@@ -0,0 +1,965 @@
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from coupon_index import CouponIndex, CANJE_OK, CANJE_YA_CANJEADO, CANJE_NO_EXISTE, CANJE_ERROR, rowcol_to_a1
+from metrics import metrics, etapa
+
+
+logger = logging.getLogger(__name__)
+
+
+# Orden de las columnas en la hoja (el mismo que usaba append_row)
+COLUMNAS_SHEET = ["nombre", "correo", "productos", "codigo", "total", "-", "fecha", "canjeado"]
+CODE_COL = COLUMNAS_SHEET.index("codigo") + 1          # 4
+CANJEADO_COL = COLUMNAS_SHEET.index("canjeado") + 1    # 8
+
+
+def fila_sheet(pedido, canjeado=False):
+    """Convierte un pedido en la fila que se guarda en Google Sheets"""
+    return [
+        pedido.get("nombre", ""), pedido.get("correo", ""), pedido.get("productos", ""),
+        pedido["codigo"], pedido.get("total", ""), "-", pedido.get("fecha", ""),
+        "SI" if canjeado else "NO",
+    ]
+
+
+# Parámetros por sentencia en las consultas con IN (...) (el límite viejo de SQLite es 999)
+MAX_PARAMETROS = 500
+
+
+def _partes(valores, tamano=MAX_PARAMETROS):
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+def _estados_en_orden(codigos, canjeados, existentes, errores=()):
+    """Estado de cada código del lote; un código repetido solo se canjea en su primera aparición"""
+    vistos = set()
+    estados = []
+    for codigo in codigos:
+        if codigo in errores:
+            estados.append(CANJE_ERROR)
+        elif codigo in canjeados and codigo not in vistos:
+            estados.append(CANJE_OK)
+        elif codigo in existentes or codigo in canjeados:
+            estados.append(CANJE_YA_CANJEADO)
+        else:
+            estados.append(CANJE_NO_EXISTE)
+        vistos.add(codigo)
+    return estados
+
+
+# Expresiones del resumen de ventas (triggers y reconstrucción). {t} es NEW o la tabla cupones.
+# Día de la venta: la fecha del pedido si es AAAA-MM-DD..., si no la fecha de alta (UTC)
+_DIA_SQL = ("CASE WHEN {t}.fecha GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*' "
+            "THEN substr({t}.fecha, 1, 10) ELSE date({t}.creado, 'unixepoch') END")
+_PRODUCTO_SQL = "COALESCE({t}.productos, '')"
+# total se guarda como texto "1,234.50"
+_MONTO_SQL = "COALESCE(CAST(REPLACE(REPLACE({t}.total, ',', ''), '$', '') AS REAL), 0)"
+
+# El tiempo hasta el canje solo se mide en los cupones vendidos por la app: en los importados
+# de la hoja "creado" es la hora de la importación, no la de la venta
+_TRIGGER_RESUMEN_CANJE = f"""
+    CREATE TRIGGER IF NOT EXISTS resumen_canje AFTER UPDATE OF canjeado ON cupones
+    WHEN NEW.canjeado = 1 AND OLD.canjeado = 0
+    BEGIN
+        UPDATE resumen_diario SET
+            canjes = canjes + 1,
+            canjes_medidos = canjes_medidos + (NEW.canjeado_en IS NOT NULL AND NEW.importado = 0),
+            segundos_canje = segundos_canje + CASE WHEN NEW.importado = 0
+                THEN COALESCE(MAX(NEW.canjeado_en - NEW.creado, 0), 0) ELSE 0 END
+        WHERE dia = {_DIA_SQL.format(t="NEW")} AND producto = {_PRODUCTO_SQL.format(t="NEW")};
+    END
+"""
+
+
+# Resultado de redeem_offline() cuando el cupón ya lo había canjeado otro dispositivo
+CANJE_CONFLICTO = "conflict"
+
+
+class DuplicateCodeError(Exception):
+    """El código del pedido ya existe (lo emitió otro worker): hay que asignar otro"""
+
+
+class Storage:
+    """
+    Operaciones sobre pedidos/cupones que necesita la app.
+
+    - append_order(pedido): guarda un pedido nuevo (dict con nombre, correo,
+      productos, codigo, total y fecha).
+    - lookup(codigo): dict con los datos del cupón o None si no existe.
+    - redeem(codigo): marca el cupón como canjeado y devuelve CANJE_OK,
+      CANJE_YA_CANJEADO o CANJE_NO_EXISTE. Es un compare-and-set: aunque
+      varios workers de gunicorn canjeen el mismo código a la vez, solo uno
+      recibe CANJE_OK.
+    - redeem_many(codigos) / lookup_many(codigos): lo mismo para un lote, con
+      una sola pasada por el índice y una escritura agrupada. redeem_many
+      devuelve un estado por código, en el orden recibido (un código repetido
+      en el lote se canjea una vez; las demás apariciones dan CANJE_YA_CANJEADO;
+      CANJE_ERROR si no se pudo escribir y hay que reintentar).
+    - ready(): True cuando el motor puede atender canjes (para /ready).
+    - exists(codigo) / codes(): para el asignador de códigos (coupon_codes).
+    - reserve_codes(codigos, bloque): reserva códigos para una campaña; devuelve
+      los que no se pudieron reservar porque ya existían.
+    - change_version() / unredeemed_codes() / changes_since(seq) /
+      prune_changes(antes_de) / redeem_offline(...): snapshots y
+      sincronización del validador sin conexión (snapshots.py).
+    - iter_coupons(desde, hasta, producto): generador de cupones para exportar
+      sin cargar todo en memoria; report_summary() / report_totals(): resumen
+      de ventas y canjes mantenido al escribir (reporting.py).
+    """
+
+    def start(self):
+        pass
+
+    def ready(self):
+        return True
+
+    def append_order(self, pedido):
+        raise NotImplementedError
+
+    def lookup(self, codigo):
+        raise NotImplementedError
+
+    def redeem(self, codigo):
+        raise NotImplementedError
+
+    def redeem_many(self, codigos):
+        return [self.redeem(codigo) for codigo in codigos]
+
+    def lookup_many(self, codigos):
+        return {codigo: self.lookup(codigo) for codigo in codigos}
+
+    def exists(self, codigo):
+        return self.lookup(codigo) is not None
+
+    def codes(self):
+        raise NotImplementedError
+
+    def reserve_codes(self, codigos, bloque):
+        raise NotImplementedError
+
+    def change_version(self):
+        raise NotImplementedError
+
+    def unredeemed_codes(self, producto=None):
+        raise NotImplementedError
+
+    def changes_since(self, seq, producto=None):
+        raise NotImplementedError
+
+    def prune_changes(self, antes_de):
+        raise NotImplementedError
+
+    def redeem_offline(self, id_canje, codigo, dispositivo, escaneado):
+        raise NotImplementedError
+
+    def offline_conflicts(self, limit=100):
+        raise NotImplementedError
+
+    def iter_coupons(self, desde=None, hasta=None, producto=None):
+        raise NotImplementedError
+
+    def report_summary(self, desde=None, hasta=None, producto=None):
+        raise NotImplementedError
+
+    def report_totals(self):
+        raise NotImplementedError
+
+
+class SQLiteBase:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _conn(self):
+        # Una conexión por hilo; sqlite3 no comparte conexiones entre hilos
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class RedemptionLocks(SQLiteBase):
+    """
+    Tabla local de canjes compartida por todos los workers de la instancia.
+    La clave primaria sobre el código hace que solo un proceso pueda
+    reclamar cada cupón, aunque sus índices en memoria estén desfasados.
+    """
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS canjes_lock (
+                codigo TEXT PRIMARY KEY,
+                creado REAL NOT NULL
+            )
+        """)
+
+    def claim(self, codigo):
+        try:
+            self._conn().execute(
+                "INSERT INTO canjes_lock (codigo, creado) VALUES (?, ?)", (codigo, time.time())
+            )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def claim_many(self, codigos):
+        """Reclama todos los códigos en una transacción; devuelve los que obtuvo"""
+        conn = self._conn()
+        ahora = time.time()
+        obtenidos = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for codigo in codigos:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO canjes_lock (codigo, creado) VALUES (?, ?)", (codigo, ahora)
+                )
+                if cur.rowcount == 1:
+                    obtenidos.append(codigo)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return obtenidos
+
+    def release(self, codigo):
+        self._conn().execute("DELETE FROM canjes_lock WHERE codigo = ?", (codigo,))
+
+
+class SheetsStorage(Storage):
+    """
+    Motor sobre Google Sheets: índice en memoria + escrituras agrupadas.
+    Con `locks` (RedemptionLocks) el canje es seguro entre procesos; sin él
+    solo lo es dentro de un mismo worker.
+    """
+
+    def __init__(self, sheet, writer, refresh_interval=30, write_timeout=60, locks=None):
+        self.sheet = sheet
+        self.writer = writer
+        self.locks = locks
+        self.write_timeout = write_timeout
+        self.index = CouponIndex(
+            sheet, CODE_COL, CANJEADO_COL,
+            refresh_interval=refresh_interval,
+            writer=writer,
+            write_timeout=write_timeout,
+        )
+
+    def start(self):
+        # La carga del índice espera a Google: se hace en segundo plano para no demorar el arranque
+        threading.Thread(target=self._cargar_indice, name="coupon-index-load", daemon=True).start()
+
+    def _cargar_indice(self):
+        espera = 1
+        while not self.index.loaded:
+            try:
+                self.index.load()
+            except Exception as e:
+                logger.warning("No se pudo cargar el índice de cupones, reintento en %ds: %s", espera, e)
+                time.sleep(espera)
+                espera = min(60, espera * 2)
+        self.index.start()
+
+    def ready(self):
+        return self.index.loaded
+
+    def append_order(self, pedido):
+        fila = self.writer.append(fila_sheet(pedido)).result(timeout=self.write_timeout)
+        if fila:
+            self.index.add(pedido["codigo"], fila)
+        return fila
+
+    def codes(self):
+        return self.index.codes()
+
+    def lookup(self, codigo):
+        entrada = self.index.get(codigo)
+        if entrada is None:
+            return None
+        fila, canjeado = entrada
+        return {"codigo": codigo, "canjeado": canjeado, "fila": fila}
+
+    def redeem(self, codigo):
+        if self.locks is None:
+            return self.index.redeem(codigo)
+
+        if self.index.get(codigo) is None:
+            self.index.refresh_on_miss()
+        entrada = self.index.get(codigo)
+        if entrada is None:
+            return CANJE_NO_EXISTE
+        if entrada[1]:
+            return CANJE_YA_CANJEADO
+        # Otro worker ya lo reclamó aunque nuestro índice todavía no lo sepa
+        if not self.locks.claim(codigo):
+            return CANJE_YA_CANJEADO
+
+        try:
+            return self.index.redeem(codigo)
+        except Exception:
+            self.locks.release(codigo)
+            raise
+
+    def iter_coupons(self, desde=None, hasta=None, producto=None, pagina=1000):
+        """Lee la hoja de a `pagina` filas (una llamada por página) y va entregando los cupones"""
+        fila = 2
+        while True:
+            with metrics.external("sheets", "get"):
+                filas = self.sheet.get(f"A{fila}:{rowcol_to_a1(fila + pagina - 1, len(COLUMNAS_SHEET))}")
+            for valores in filas:
+                datos = dict(zip(COLUMNAS_SHEET, list(valores) + [""] * (len(COLUMNAS_SHEET) - len(valores))))
+                if not (datos["codigo"] or "").strip():
+                    continue
+                dia = (datos["fecha"] or "")[:10]
+                if (desde and dia < desde) or (hasta and dia > hasta):
+                    continue
+                if producto and producto not in (datos["productos"] or ""):
+                    continue
+                yield {
+                    "codigo": datos["codigo"].strip(), "nombre": datos["nombre"], "correo": datos["correo"],
+                    "productos": datos["productos"], "total": datos["total"], "fecha": datos["fecha"],
+                    "canjeado": (datos["canjeado"] or "").strip().upper() == "SI",
+                    "canjeado_en": None, "creado": None,
+                }
+            if len(filas) < pagina:
+                return
+            fila += pagina
+
+    def lookup_many(self, codigos):
+        entradas = self.index.get_many(codigos)
+        return {
+            codigo: None if entrada is None else {"codigo": codigo, "canjeado": entrada[1], "fila": entrada[0]}
+            for codigo, entrada in entradas.items()
+        }
+
+    def redeem_many(self, codigos):
+        if self.locks is None:
+            return self.index.redeem_many(codigos)
+
+        entradas = self.index.get_many(codigos)
+        candidatos = list(dict.fromkeys(c for c, e in entradas.items() if e is not None and not e[1]))
+        # Un solo INSERT por lote en la tabla compartida; lo que ya reclamó otro worker queda afuera
+        reclamados = self.locks.claim_many(candidatos) if candidatos else []
+        try:
+            estados = dict(zip(reclamados, self.index.redeem_many(reclamados)))
+        except Exception:
+            for codigo in reclamados:
+                self.locks.release(codigo)
+            raise
+        for codigo, estado in estados.items():
+            if estado == CANJE_ERROR:
+                self.locks.release(codigo)
+        canjeados = {c for c, estado in estados.items() if estado == CANJE_OK}
+        existentes = {c for c, e in entradas.items() if e is not None}
+        errores = {c for c, estado in estados.items() if estado == CANJE_ERROR}
+        return _estados_en_orden(codigos, canjeados, existentes, errores)
+
+
+class SQLiteStorage(SQLiteBase, Storage):
+    """
+    Motor local en SQLite (modo WAL) con índice único sobre el código.
+    Es el registro principal; SheetsMirror copia los cambios a la hoja.
+    El canje es un UPDATE condicional (canjeado = 0), atómico entre procesos.
+
+    Con requires_import=True (hay hoja con cupones anteriores) no está listo
+    hasta que algún proceso terminó import_sheet_rows(): antes, un código que
+    no está en SQLite puede existir solo en la hoja.
+    """
+
+    def __init__(self, db_path, requires_import=False):
+        super().__init__(db_path)
+        self.requires_import = requires_import
+        self._importado = False
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cupones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codigo TEXT NOT NULL UNIQUE,
+                nombre TEXT,
+                correo TEXT,
+                productos TEXT,
+                total TEXT,
+                fecha TEXT,
+                canjeado INTEGER NOT NULL DEFAULT 0,
+                canjeado_en REAL,
+                creado REAL NOT NULL,
+                sheet_fila INTEGER,
+                sheet_canje_sync INTEGER NOT NULL DEFAULT 0,
+                importado INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS cupones_sin_sheet ON cupones (sheet_fila) WHERE sheet_fila IS NULL")
+        # Registro de cambios para los snapshots del validador sin conexión (lo llenan triggers,
+        # así que cubre todas las escrituras, de cualquier worker)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cambios (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                codigo TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                creado REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS cambios_alta AFTER INSERT ON cupones WHEN NEW.canjeado = 0
+            BEGIN
+                INSERT INTO cambios (codigo, tipo, creado) VALUES (NEW.codigo, 'alta', NEW.creado);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS cambios_canje AFTER UPDATE OF canjeado ON cupones
+            WHEN NEW.canjeado = 1 AND OLD.canjeado = 0
+            BEGIN
+                INSERT INTO cambios (codigo, tipo, creado)
+                VALUES (NEW.codigo, 'canje', (julianday('now') - 2440587.5) * 86400.0);
+            END
+        """)
+        # Resumen de ventas y canjes por día y producto, mantenido por triggers en la misma
+        # transacción que cada alta o canje: los reportes no recorren la tabla de cupones
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS resumen_diario (
+                dia TEXT NOT NULL,
+                producto TEXT NOT NULL,
+                pedidos INTEGER NOT NULL DEFAULT 0,
+                ingresos REAL NOT NULL DEFAULT 0,
+                canjes INTEGER NOT NULL DEFAULT 0,
+                canjes_medidos INTEGER NOT NULL DEFAULT 0,
+                segundos_canje REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (dia, producto)
+            )
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS resumen_alta AFTER INSERT ON cupones
+            BEGIN
+                INSERT INTO resumen_diario (dia, producto, pedidos, ingresos, canjes)
+                VALUES ({_DIA_SQL.format(t="NEW")}, {_PRODUCTO_SQL.format(t="NEW")}, 1,
+                        {_MONTO_SQL.format(t="NEW")}, NEW.canjeado)
+                ON CONFLICT (dia, producto) DO UPDATE SET
+                    pedidos = pedidos + 1,
+                    ingresos = ingresos + excluded.ingresos,
+                    canjes = canjes + excluded.canjes;
+            END
+        """)
+        conn.execute(_TRIGGER_RESUMEN_CANJE)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS canjes_offline (
+                id TEXT PRIMARY KEY,
+                codigo TEXT NOT NULL,
+                dispositivo TEXT,
+                escaneado REAL NOT NULL,
+                recibido REAL NOT NULL,
+                resultado TEXT NOT NULL,
+                ganador TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS codigos_reservados (
+                codigo TEXT PRIMARY KEY,
+                bloque TEXT NOT NULL,
+                creado REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                nombre TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                hasta REAL NOT NULL
+            )
+        """)
+        # Marcas compartidas entre procesos (por ejemplo, cuándo se importó la hoja)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                clave TEXT PRIMARY KEY,
+                valor TEXT NOT NULL
+            )
+        """)
+        self._migrar_importado()
+        self._completar_resumen()
+
+    def ready(self):
+        if not self.requires_import or self._importado:
+            return True
+        # La importación la hace el proceso con el lease de la réplica: se consulta la marca
+        self._importado = self._conn().execute(
+            "SELECT 1 FROM meta WHERE clave = 'sheet_import'"
+        ).fetchone() is not None
+        return self._importado
+
+    def append_order(self, pedido):
+        try:
+            cur = self._conn().execute(
+                "INSERT INTO cupones (codigo, nombre, correo, productos, total, fecha, creado) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (pedido["codigo"], pedido.get("nombre"), pedido.get("correo"), pedido.get("productos"),
+                 pedido.get("total"), pedido.get("fecha"), time.time()),
+            )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateCodeError(pedido["codigo"]) from e
+        return cur.lastrowid
+
+    def exists(self, codigo):
+        return self._conn().execute(
+            "SELECT 1 FROM cupones WHERE codigo = ? UNION ALL SELECT 1 FROM codigos_reservados WHERE codigo = ?",
+            (codigo, codigo),
+        ).fetchone() is not None
+
+    def codes(self):
+        for (codigo,) in self._conn().execute(
+            "SELECT codigo FROM cupones UNION ALL SELECT codigo FROM codigos_reservados"
+        ):
+            yield codigo
+
+    def reserve_codes(self, codigos, bloque):
+        """Reserva todos los códigos en una transacción; devuelve los que ya existían"""
+        conn = self._conn()
+        ahora = time.time()
+        rechazados = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for codigo in codigos:
+                if conn.execute("SELECT 1 FROM cupones WHERE codigo = ?", (codigo,)).fetchone():
+                    rechazados.append(codigo)
+                    continue
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO codigos_reservados (codigo, bloque, creado) VALUES (?, ?, ?)",
+                    (codigo, bloque, ahora),
+                )
+                if cur.rowcount == 0:
+                    rechazados.append(codigo)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rechazados
+
+    def lookup(self, codigo):
+        row = self._conn().execute(
+            "SELECT codigo, nombre, correo, productos, total, fecha, canjeado, canjeado_en "
+            "FROM cupones WHERE codigo = ?",
+            (codigo,),
+        ).fetchone()
+        if row is None:
+            return None
+        resultado = dict(row)
+        resultado["canjeado"] = bool(resultado["canjeado"])
+        return resultado
+
+    def redeem(self, codigo):
+        conn = self._conn()
+        # Búsqueda y escritura son el mismo UPDATE; solo si no canjeó se consulta por qué
+        with etapa("redeem_write"):
+            cur = conn.execute(
+                "UPDATE cupones SET canjeado = 1, canjeado_en = ? WHERE codigo = ? AND canjeado = 0",
+                (time.time(), codigo),
+            )
+        if cur.rowcount == 1:
+            return CANJE_OK
+        with etapa("code_lookup"):
+            existe = conn.execute("SELECT 1 FROM cupones WHERE codigo = ?", (codigo,)).fetchone()
+        return CANJE_YA_CANJEADO if existe else CANJE_NO_EXISTE
+
+    def redeem_many(self, codigos):
+        """Todo el lote en una transacción: un UPDATE ... RETURNING por cada MAX_PARAMETROS códigos"""
+        conn = self._conn()
+        unicos = list(dict.fromkeys(codigos))
+        canjeados, existentes = set(), set()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            with etapa("redeem_write"):
+                for parte in _partes(unicos):
+                    marcas = ",".join("?" * len(parte))
+                    canjeados.update(r[0] for r in conn.execute(
+                        f"UPDATE cupones SET canjeado = 1, canjeado_en = ? "
+                        f"WHERE canjeado = 0 AND codigo IN ({marcas}) RETURNING codigo",
+                        (ahora, *parte),
+                    ))
+            with etapa("code_lookup"):
+                restantes = [c for c in unicos if c not in canjeados]
+                for parte in _partes(restantes):
+                    marcas = ",".join("?" * len(parte))
+                    existentes.update(r[0] for r in conn.execute(
+                        f"SELECT codigo FROM cupones WHERE codigo IN ({marcas})", parte
+                    ))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return _estados_en_orden(codigos, canjeados, existentes)
+
+    def lookup_many(self, codigos):
+        encontrados = {}
+        for parte in _partes(list(dict.fromkeys(codigos))):
+            marcas = ",".join("?" * len(parte))
+            for row in self._conn().execute(
+                "SELECT codigo, nombre, correo, productos, total, fecha, canjeado, canjeado_en "
+                f"FROM cupones WHERE codigo IN ({marcas})",
+                parte,
+            ):
+                resultado = dict(row)
+                resultado["canjeado"] = bool(resultado["canjeado"])
+                encontrados[resultado["codigo"]] = resultado
+        return {codigo: encontrados.get(codigo) for codigo in codigos}
+
+    # --- Reportes ---
+    def _migrar_importado(self):
+        # Bases creadas antes de la columna "importado": se marcan los cupones que trajo
+        # import_sheet_rows (todos con la hora de la importación) y se rehace el resumen
+        conn = self._conn()
+        if any(c["name"] == "importado" for c in conn.execute("PRAGMA table_info(cupones)")):
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not any(c["name"] == "importado" for c in conn.execute("PRAGMA table_info(cupones)")):
+                conn.execute("ALTER TABLE cupones ADD COLUMN importado INTEGER NOT NULL DEFAULT 0")
+                marca = conn.execute("SELECT valor FROM meta WHERE clave = 'sheet_import'").fetchone()
+                if marca is not None:
+                    conn.execute("UPDATE cupones SET importado = 1 WHERE creado = ?", (float(marca["valor"]),))
+                conn.execute("DROP TRIGGER IF EXISTS resumen_canje")
+                conn.execute(_TRIGGER_RESUMEN_CANJE)
+                self.rebuild_report(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _completar_resumen(self):
+        # Bases creadas antes del resumen: se calcula una vez desde los cupones existentes
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            vacio = conn.execute("SELECT 1 FROM resumen_diario LIMIT 1").fetchone() is None
+            if vacio and conn.execute("SELECT 1 FROM cupones LIMIT 1").fetchone():
+                self.rebuild_report(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def rebuild_report(self, conn=None):
+        """Recalcula resumen_diario recorriendo todos los cupones (dentro de una transacción)"""
+        conn = conn or self._conn()
+        conn.execute("DELETE FROM resumen_diario")
+        conn.execute(f"""
+            INSERT INTO resumen_diario (dia, producto, pedidos, ingresos, canjes, canjes_medidos, segundos_canje)
+            SELECT {_DIA_SQL.format(t="cupones")}, {_PRODUCTO_SQL.format(t="cupones")}, COUNT(*),
+                   SUM({_MONTO_SQL.format(t="cupones")}), SUM(canjeado),
+                   SUM(canjeado = 1 AND canjeado_en IS NOT NULL AND importado = 0),
+                   SUM(CASE WHEN canjeado = 1 AND importado = 0
+                       THEN COALESCE(MAX(canjeado_en - creado, 0), 0) ELSE 0 END)
+            FROM cupones GROUP BY 1, 2
+        """)
+        logger.info("Resumen de ventas reconstruido desde los cupones")
+
+    def iter_coupons(self, desde=None, hasta=None, producto=None, pagina=500):
+        """Cupones en orden de alta, leídos de a `pagina` filas del cursor"""
+        condiciones, params = [], []
+        dia = _DIA_SQL.format(t="cupones")
+        if desde:
+            condiciones.append(f"{dia} >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append(f"{dia} <= ?")
+            params.append(hasta)
+        if producto:
+            condiciones.append("productos LIKE ?")
+            params.append(f"%{producto}%")
+        where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+        cur = self._conn().execute(
+            # En los importados de la hoja "creado" es la hora de la importación, no la de la venta
+            "SELECT codigo, nombre, correo, productos, total, fecha, canjeado, canjeado_en, "
+            f"CASE WHEN importado = 1 THEN NULL ELSE creado END AS creado FROM cupones{where} ORDER BY id",
+            params,
+        )
+        try:
+            while True:
+                filas = cur.fetchmany(pagina)
+                if not filas:
+                    return
+                for row in filas:
+                    resultado = dict(row)
+                    resultado["canjeado"] = bool(resultado["canjeado"])
+                    yield resultado
+        finally:
+            cur.close()
+
+    def report_summary(self, desde=None, hasta=None, producto=None):
+        condiciones, params = [], []
+        if desde:
+            condiciones.append("dia >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append("dia <= ?")
+            params.append(hasta)
+        if producto:
+            condiciones.append("producto LIKE ?")
+            params.append(f"%{producto}%")
+        where = " WHERE " + " AND ".join(condiciones) if condiciones else ""
+        rows = self._conn().execute(
+            f"SELECT * FROM resumen_diario{where} ORDER BY dia, producto", params
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def report_totals(self):
+        row = self._conn().execute(
+            "SELECT COALESCE(SUM(pedidos), 0) AS pedidos, COALESCE(SUM(ingresos), 0) AS ingresos, "
+            "COALESCE(SUM(canjes), 0) AS canjes FROM resumen_diario"
+        ).fetchone()
+        return dict(row)
+
+    # --- Snapshots para el validador sin conexión ---
+    def _version(self, conn):
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cambios'").fetchone()
+        return row[0] if row else 0
+
+    def change_version(self):
+        return self._version(self._conn())
+
+    def unredeemed_codes(self, producto=None):
+        """(versión, códigos sin canjear), leídos en la misma transacción"""
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            version = self._version(conn)
+            sql, params = "SELECT codigo FROM cupones WHERE canjeado = 0", ()
+            if producto:
+                sql, params = sql + " AND productos LIKE ?", (f"%{producto}%",)
+            codigos = [r[0] for r in conn.execute(sql, params)]
+        finally:
+            conn.execute("COMMIT")
+        return version, codigos
+
+    def changes_since(self, seq, producto=None):
+        """
+        (versión, cambios posteriores a `seq` como [(codigo, tipo)]) o None si
+        esos cambios ya se purgaron y hace falta un snapshot completo.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            version = self._version(conn)
+            minimo = conn.execute("SELECT MIN(seq) FROM cambios").fetchone()[0] or version + 1
+            if seq > version or seq < minimo - 1:
+                return None
+            sql = "SELECT c.codigo, c.tipo FROM cambios c"
+            params = (seq,)
+            if producto:
+                sql += " JOIN cupones u ON u.codigo = c.codigo WHERE u.productos LIKE ? AND"
+                params = (f"%{producto}%", seq)
+            else:
+                sql += " WHERE"
+            cambios = conn.execute(sql + " c.seq > ? ORDER BY c.seq", params).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        return version, [(r[0], r[1]) for r in cambios]
+
+    def prune_changes(self, antes_de):
+        return self._conn().execute("DELETE FROM cambios WHERE creado < ?", (antes_de,)).rowcount
+
+    def redeem_offline(self, id_canje, codigo, dispositivo, escaneado):
+        """
+        Aplica un canje hecho sin conexión. Es idempotente por `id_canje` (el
+        reenvío de un lote devuelve el mismo resultado). Si el cupón ya estaba
+        canjeado gana el primer escaneo: la fecha de canje queda en la más
+        temprana y el conflicto se registra para revisarlo.
+        """
+        conn = self._conn()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previo = conn.execute(
+                "SELECT resultado, ganador FROM canjes_offline WHERE id = ?", (id_canje,)
+            ).fetchone()
+            if previo is not None:
+                conn.execute("COMMIT")
+                return {"status": previo["resultado"], "winner": previo["ganador"]}
+
+            ganador = None
+            cur = conn.execute(
+                "UPDATE cupones SET canjeado = 1, canjeado_en = ? WHERE codigo = ? AND canjeado = 0",
+                (escaneado, codigo),
+            )
+            if cur.rowcount == 1:
+                resultado = CANJE_OK
+            else:
+                row = conn.execute("SELECT canjeado_en FROM cupones WHERE codigo = ?", (codigo,)).fetchone()
+                if row is None:
+                    resultado = CANJE_NO_EXISTE
+                else:
+                    resultado = CANJE_CONFLICTO
+                    anterior = row["canjeado_en"]
+                    if anterior is None or escaneado < anterior:
+                        ganador = "this"
+                        conn.execute("UPDATE cupones SET canjeado_en = ? WHERE codigo = ?", (escaneado, codigo))
+                    else:
+                        ganador = "other"
+            conn.execute(
+                "INSERT INTO canjes_offline (id, codigo, dispositivo, escaneado, recibido, resultado, ganador) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (id_canje, codigo, dispositivo, escaneado, ahora, resultado, ganador),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"status": resultado, "winner": ganador}
+
+    def offline_conflicts(self, limit=100):
+        rows = self._conn().execute(
+            "SELECT id, codigo, dispositivo, escaneado, recibido, ganador FROM canjes_offline "
+            "WHERE resultado = ? ORDER BY recibido DESC LIMIT ?",
+            (CANJE_CONFLICTO, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    # --- Soporte para la réplica en Sheets ---
+    def take_lease(self, nombre, owner, segundos):
+        """Lease entre procesos: solo un worker de gunicorn replica a la vez"""
+        ahora = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO leases (nombre, owner, hasta) VALUES (?, ?, ?) "
+            "ON CONFLICT(nombre) DO UPDATE SET owner = excluded.owner, hasta = excluded.hasta "
+            "WHERE leases.owner = excluded.owner OR leases.hasta < ?",
+            (nombre, owner, ahora + segundos, ahora),
+        )
+        return cur.rowcount == 1
+
+    def pending_appends(self, limit):
+        rows = self._conn().execute(
+            "SELECT codigo, nombre, correo, productos, total, fecha, canjeado FROM cupones "
+            "WHERE sheet_fila IS NULL ORDER BY id LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def pending_redemptions(self, limit):
+        rows = self._conn().execute(
+            "SELECT codigo, sheet_fila FROM cupones "
+            "WHERE canjeado = 1 AND sheet_canje_sync = 0 AND sheet_fila > 0 LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def set_sheet_row(self, codigo, fila, canje_sync=False):
+        self._conn().execute(
+            "UPDATE cupones SET sheet_fila = ?, sheet_canje_sync = MAX(sheet_canje_sync, ?) WHERE codigo = ?",
+            (fila, 1 if canje_sync else 0, codigo),
+        )
+
+    def set_redemption_synced(self, codigo):
+        self._conn().execute("UPDATE cupones SET sheet_canje_sync = 1 WHERE codigo = ?", (codigo,))
+
+    def import_sheet_rows(self, filas):
+        """
+        Trae a SQLite los cupones que ya existen en la hoja (filas sin encabezado,
+        empezando en la fila 2). Es idempotente: no pisa datos locales y solo
+        marca canjeados los que la hoja dice "SI". Quedan con importado = 1:
+        no se sabe cuándo se vendieron.
+        """
+        conn = self._conn()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for i, valores in enumerate(filas):
+                valores = list(valores) + [""] * (len(COLUMNAS_SHEET) - len(valores))
+                datos = dict(zip(COLUMNAS_SHEET, valores))
+                codigo = (datos["codigo"] or "").strip()
+                if not codigo:
+                    continue
+                canjeado = 1 if (datos["canjeado"] or "").strip().upper() == "SI" else 0
+                conn.execute(
+                    "INSERT OR IGNORE INTO cupones (codigo, nombre, correo, productos, total, fecha, "
+                    "canjeado, creado, sheet_fila, sheet_canje_sync, importado) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)",
+                    (codigo, datos["nombre"], datos["correo"], datos["productos"], datos["total"],
+                     datos["fecha"], canjeado, ahora, i + 2, canjeado),
+                )
+                conn.execute(
+                    "UPDATE cupones SET sheet_fila = COALESCE(sheet_fila, ?), "
+                    "canjeado = MAX(canjeado, ?), sheet_canje_sync = MAX(sheet_canje_sync, ?) WHERE codigo = ?",
+                    (i + 2, canjeado, canjeado, codigo),
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (clave, valor) VALUES ('sheet_import', ?)", (str(ahora),)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class SheetsMirror:
+    """
+    Réplica asíncrona SQLite -> Google Sheets para el equipo de negocio.
+
+    Al arrancar importa los cupones que ya estaban en la hoja. Después, cada
+    `interval` segundos agrega las filas nuevas y marca "SI" los canjes
+    pendientes usando el SheetsWriter (un append_rows y un batch_update por
+    ciclo). Un lease en SQLite garantiza que solo un proceso replique.
+    """
+
+    def __init__(self, storage, sheet, writer, interval=5, batch=200, write_timeout=60):
+        self.storage = storage
+        self.sheet = sheet
+        self.writer = writer
+        self.interval = interval
+        self.batch = batch
+        self.write_timeout = write_timeout
+        self.owner = uuid.uuid4().hex
+        self._hilo = None
+
+    def import_existing(self):
+        with metrics.external("sheets", "get_all_values"):
+            filas = self.sheet.get_all_values()[1:]   # sin encabezado
+        self.storage.import_sheet_rows(filas)
+        logger.info("Cupones importados desde Google Sheets: %d filas", len(filas))
+
+    def start(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._loop, name="sheets-mirror", daemon=True)
+            self._hilo.start()
+
+    def _loop(self):
+        importado = False
+        while True:
+            try:
+                if self.storage.take_lease("sheets-mirror", self.owner, self.interval * 6):
+                    if not importado:
+                        self.import_existing()
+                        importado = True
+                    self.sync_once()
+            except Exception as e:
+                logger.warning("Error replicando cupones en Google Sheets: %s", e)
+            time.sleep(self.interval)
+
+    def sync_once(self):
+        altas = self.storage.pending_appends(self.batch)
+        futuros = [(p, self.writer.append(fila_sheet(p, canjeado=p["canjeado"]))) for p in altas]
+
+        canjes = self.storage.pending_redemptions(self.batch)
+        futuros_canje = [
+            (c["codigo"], self.writer.update_cell(c["sheet_fila"], CANJEADO_COL, "SI"))
+            for c in canjes
+        ]
+
+        for pedido, futuro in futuros:
+            fila = futuro.result(timeout=self.write_timeout)
+            # Fila 0 = ya está en la hoja pero Google no informó el número; no se vuelve a agregar
+            self.storage.set_sheet_row(pedido["codigo"], fila or 0, canje_sync=pedido["canjeado"])
+        for codigo, futuro in futuros_canje:
+            futuro.result(timeout=self.write_timeout)
+            self.storage.set_redemption_synced(codigo)
+
+        return len(altas), len(canjes)
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import re
+
+
+# Campos que se revisan en cada objeto del payload
+CAMPOS_PRODUCTO = ('name', 'productName', 'title', 'product', 'itemName', 'productTitle')
+LISTAS_PRODUCTO = ('lineItems', 'items', 'products', 'cartItems', 'orderItems')
+CAMPOS_FECHA = ('dateCreated', 'createdDate', 'date', 'orderDate', 'purchaseDate', 'timestamp')
+CAMPOS_TOTAL = ('total', 'totalPrice', 'amount', 'price', 'subtotal')
+PLACEHOLDERS_PRODUCTO = {'Nombre del item', 'Nombre del ítem', 'Item Name', ''}
+CAMPOS_ID_PEDIDO = ('orderId', 'order_id')
+CAMPOS_ID_EVENTO = ('eventId', 'event_id', 'webhookId')
+
+
+def clean_wix_value(value):
+    """Limpia los valores que llegan desde Wix con funciones como JOIN(), TEXT(), etc."""
+    if not isinstance(value, str):
+        return value
+
+    # Si es algo como JOIN(Nombre del ítem, ", ")
+    if value.startswith("JOIN("):
+        inner = re.findall(r"JOIN\((.*)\)", value)
+        if inner:
+            inner = inner[0]
+            # eliminar comillas y paréntesis internos
+            inner = inner.replace("'", "").replace('"', "").replace(",", ", ")
+            return inner.strip()
+
+    # Si es algo como TEXT(Valor total) o TEXT(Fecha...)
+    if value.startswith("TEXT("):
+        inner = re.findall(r"TEXT\((.*)\)", value)
+        if inner:
+            return inner[0].replace("'", "").replace('"', "").strip()
+
+    return value.strip()
+
+
+def extract_real_data_from_wix_payload(data):
+    """
+    Intenta extraer los datos reales (productos, fecha y total) del payload de Wix.
+    Primero prueba el esquema conocido de pedidos de Wix eCommerce; si el payload
+    no lo sigue, recorre el objeto completo una sola vez.
+    """
+    return _extraer_pedido_wix(data) or _extraer_generico(data)
+
+
+def idempotency_key(data):
+    """
+    Clave para reconocer reintentos de Wix: el id del pedido si viene (el
+    mismo pedido siempre genera un solo cupón), si no el id del evento, y
+    si no un hash del payload normalizado (un reintento reenvía el mismo cuerpo).
+    """
+    if isinstance(data, dict):
+        anidado = data.get("data") if isinstance(data.get("data"), dict) else {}
+        pedidos = [n[k] for n in (anidado, data) for k in ("order", "orderInfo") if isinstance(n.get(k), dict)]
+
+        candidatos = [(p, ("id",) + CAMPOS_ID_PEDIDO, "order") for p in pedidos]
+        candidatos += [(n, CAMPOS_ID_PEDIDO, "order") for n in (anidado, data)]
+        candidatos += [(n, CAMPOS_ID_EVENTO, "event") for n in (anidado, data)]
+        for nivel, campos, tipo in candidatos:
+            for campo in campos:
+                valor = nivel.get(campo)
+                if isinstance(valor, (str, int)) and str(valor).strip():
+                    return f"{tipo}:{str(valor).strip()}"
+
+    normalizado = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return "sha256:" + hashlib.sha256(normalizado.encode("utf-8")).hexdigest()
+
+
+# --- Camino rápido: pedido de Wix eCommerce / Wix Stores ---
+def _texto(valor):
+    """productName puede venir como texto o como {"original": ..., "translated": ...}"""
+    if isinstance(valor, dict):
+        valor = valor.get("original") or valor.get("translated")
+    return valor.strip() if isinstance(valor, str) else ""
+
+
+def _monto(valor):
+    """Los montos vienen como "10.00", 10 o {"amount": "10.00", "formattedAmount": ...}"""
+    if isinstance(valor, dict):
+        valor = valor.get("amount") or valor.get("value")
+    return str(valor) if valor not in (None, "", 0) else None
+
+
+def _extraer_pedido_wix(data):
+    if not isinstance(data, dict):
+        return None
+    pedido = data.get("data", data)
+    if isinstance(pedido, dict) and isinstance(pedido.get("order"), dict):
+        pedido = pedido["order"]
+    if not isinstance(pedido, dict):
+        return None
+    items = pedido.get("lineItems")
+    if not isinstance(items, list) or not items or not all(isinstance(i, dict) for i in items):
+        return None
+
+    productos = {}
+    for item in items:
+        nombre = _texto(item.get("productName")) or _texto(item.get("name")) or _texto(item.get("title"))
+        if nombre and nombre not in PLACEHOLDERS_PRODUCTO:
+            productos.setdefault(nombre, None)
+
+    resumen = pedido.get("priceSummary") or pedido.get("totals") or pedido.get("priceData") or {}
+    total = _monto(resumen.get("total")) if isinstance(resumen, dict) else None
+
+    fecha = None
+    for clave in ("createdDate", "_createdDate", "dateCreated", "purchasedDate"):
+        if pedido.get(clave):
+            fecha = pedido[clave]
+            break
+
+    # Si falta algo el esquema no es el esperado: se usa el recorrido genérico
+    if not productos or not total or not fecha:
+        return None
+    return {'productos': ', '.join(productos), 'fecha': fecha, 'total': total}
+
+
+# --- Recorrido genérico ---
+def _extraer_generico(data):
+    """
+    Junta productos, fecha y total de un payload con forma desconocida, con
+    recorridos iterativos (sin recursión). Da el mismo resultado que el
+    extractor anterior, pero visita cada nodo una sola vez, dedupe con un
+    dict y el recorrido de fecha y total corta en cuanto tiene los dos.
+    """
+    result = {}
+    productos = _buscar_productos(data)
+    fecha, total = _buscar_fecha_y_total(data)
+    if productos:
+        result['productos'] = ', '.join(productos)
+    if fecha:
+        result['fecha'] = fecha
+    if total:
+        result['total'] = total
+    return result
+
+
+def _buscar_productos(data):
+    """
+    Nombres de producto en el orden de antes: en cada objeto, primero sus
+    propios campos, después el contenido de las listas de productos
+    (lineItems, items, ...) y al final el resto de los valores.
+    """
+    productos = {}
+    pila = [data]
+    while pila:
+        obj = pila.pop()
+        if isinstance(obj, dict):
+            for key in CAMPOS_PRODUCTO:
+                valor = obj.get(key)
+                if valor and isinstance(valor, str):
+                    nombre = valor.strip()
+                    if nombre not in PLACEHOLDERS_PRODUCTO:
+                        productos.setdefault(nombre, None)
+
+            # La pila saca el último primero: se apila al revés, y las listas
+            # de productos al final para que salgan antes que el resto
+            hay_listas = False
+            for key, valor in reversed(obj.items()):
+                if isinstance(valor, (dict, list)):
+                    if key in LISTAS_PRODUCTO and isinstance(valor, list):
+                        hay_listas = True
+                    else:
+                        pila.append(valor)
+            if hay_listas:
+                for key in reversed(LISTAS_PRODUCTO):
+                    valor = obj.get(key)
+                    if isinstance(valor, list):
+                        pila.append(valor)
+
+        elif isinstance(obj, list):
+            for item in reversed(obj):
+                if isinstance(item, (dict, list)):
+                    pila.append(item)
+    return productos
+
+
+def _buscar_fecha_y_total(data):
+    """Primera fecha y primer total en preorden"""
+    fecha = None
+    total = None
+    pila = [data]
+    while pila:
+        obj = pila.pop()
+        if isinstance(obj, dict):
+            if fecha is None:
+                for key in CAMPOS_FECHA:
+                    if obj.get(key):
+                        fecha = obj[key]
+                        break
+
+            if total is None:
+                price_data = obj.get('priceData')
+                if isinstance(price_data, dict):
+                    valor = price_data.get('total') or price_data.get('subtotal')
+                    if valor:
+                        total = str(valor)
+                if total is None:
+                    for key in CAMPOS_TOTAL:
+                        if obj.get(key):
+                            total = str(obj[key])
+                            break
+
+            if fecha is not None and total is not None:
+                break
+            for valor in reversed(obj.values()):
+                if isinstance(valor, (dict, list)):
+                    pila.append(valor)
+
+        elif isinstance(obj, list):
+            for item in reversed(obj):
+                if isinstance(item, (dict, list)):
+                    pila.append(item)
+    return fecha, total